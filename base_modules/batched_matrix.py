@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+""" Batched multiplication of many small matrices """
+
+"""
+Batched multiply
+
+Each call to par_matrix_multiply pays for starting processes and copying operands into shared memory. For a 4x4
+or a 32x32 product the cost model always says this is not worth it, so every product runs sequentially. A workload
+of hundreds of thousands of tiny products then gets no parallelism, and it also pays the Python function call and
+list-of-lists overhead once per product.
+
+The batched API takes the whole stack at once. A is a stack of n x m matrices and B a stack of m x p matrices. Each
+stack is either a 3D ndarray or one flat row-major buffer with the shape given separately. Every pair is
+multiplied, and the products come back as one stacked batch x n x p result.
+
+The batch is split into contiguous chunks, one per worker. A single task per worker carries the shared memory names
+and the chunk bounds, so dispatch and pickling costs are paid once per worker rather than once per product. Inside a
+chunk the products are computed in a vectorized way: with NumPy, one np.matmul call over the whole chunk; without
+it, a loop over the pairs whose inner work is a list comprehension of sum(map(mul, row, column)) dot products.
+
+Whether to use workers at all is decided by the calibrated cost model of this machine, with the cost per
+multiply-add of the chunk kernel measured on first use.
+"""
+
+import math
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from operator import mul
+
+from base_modules.calibration import MatmulCostModel, _time_once, load_profile, save_profile
+from base_modules.parallelism import effective_cpu_count
+from base_modules.shared_arrays import SharedArray, result_view
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; chunks are computed with the pure-Python kernel without it
+    np = None
+
+PROFILE_SECTION = 'batched_matmul'
+
+
+def stack_pairs(pairs):
+    """ packs an iterable of (A, B) list-of-lists pairs into two flat stacks
+        returns (A_stack, B_stack, (n, m, p)) ready for seq_batched_multiply and par_batched_multiply """
+    A_stack, B_stack = array('d'), array('d')
+    shape = None
+    for A, B in pairs:
+        pair_shape = (len(A), len(A[0]), len(B[0]))
+        if len(A[0]) != len(B):
+            raise ArithmeticError(
+                f"Invalid dimensions; Cannot multiply {len(A)}x{len(A[0])}*{len(B)}x{len(B[0])}")
+        if shape is None:
+            shape = pair_shape
+        elif pair_shape != shape:
+            raise ValueError(f'every pair in a batch must have the same shape, got {pair_shape} and {shape}')
+        A_stack.extend(chain.from_iterable(A))
+        B_stack.extend(chain.from_iterable(B))
+    return A_stack, B_stack, shape
+
+
+def _batch_shape(A, B, shape):
+    """ returns (batch, n, m, p) for 3D ndarray stacks, or for flat stacks with shape=(n, m, p) """
+    if shape is None:
+        if np is None or not isinstance(A, np.ndarray) or A.ndim != 3:
+            raise ValueError('flat stacks need shape=(n, m, p)')
+        (batch, n, m), (batch_B, num_rows_B, p) = A.shape, B.shape
+        if num_rows_B != m:
+            raise ArithmeticError(f"Invalid dimensions; Cannot multiply {n}x{m}*{num_rows_B}x{p}")
+        if batch_B != batch:
+            raise ValueError(f'A holds {batch} matrices but B holds {batch_B}')
+        return batch, n, m, p
+    n, m, p = shape
+    batch = len(A) // (n * m) if n * m else 0
+    if len(A) != batch * n * m or len(B) != batch * m * p:
+        raise ValueError(f'stacks of {len(A)} and {len(B)} elements do not hold the same number of '
+                         f'{n}x{m} and {m}x{p} matrices')
+    return batch, n, m, p
+
+
+def _matmul_chunk(A, B, C, n, m, p, start, end):
+    """ pure-Python kernel: C[b] = A[b]*B[b] for every b in start..end-1 of flat row-major stacks """
+    for b in range(start, end):
+        A_b = A[b * n * m:(b + 1) * n * m].tolist()
+        B_b = B[b * m * p:(b + 1) * m * p].tolist()
+        B_cols = [B_b[j::p] for j in range(p)]
+        C[b * n * p:(b + 1) * n * p] = array('d', [sum(map(mul, A_b[i * m:(i + 1) * m], B_col))
+                                                   for i in range(n) for B_col in B_cols])
+
+
+def _par_worker(A, B, C, n, m, p, start, end):
+    if np is not None:
+        A_nd, B_nd, C_nd = A.as_ndarray((-1, n, m)), B.as_ndarray((-1, m, p)), C.as_ndarray((-1, n, p))
+        np.matmul(A_nd[start:end], B_nd[start:end], out=C_nd[start:end])
+        del A_nd, B_nd, C_nd
+    else:
+        _matmul_chunk(A.view, B.view, C.view, n, m, p, start, end)
+
+
+def _flat(M):
+    """ a flat buffer of doubles over a stack, copying only when it is not one already """
+    if np is not None:
+        return np.ascontiguousarray(M, dtype=np.float64).ravel()
+    return M if isinstance(M, array) and M.typecode == 'd' else array('d', M)
+
+
+def seq_batched_multiply(A, B, shape=None, as_list=False):
+    """ multiplies every pair of the stacks A and B in this process
+        A and B are 3D ndarrays, or flat row-major buffers with shape=(n, m, p) """
+    batch, n, m, p = _batch_shape(A, B, shape)
+    if np is not None:
+        C = np.matmul(_flat(A).reshape(batch, n, m), _flat(B).reshape(batch, m, p))
+        return result_view(C.ravel(), (batch, n, p), as_list)
+    C = array('d', bytes(8 * batch * n * p))
+    _matmul_chunk(memoryview(_flat(A)), memoryview(_flat(B)), memoryview(C), n, m, p, 0, batch)
+    return result_view(C, (batch, n, p), as_list)
+
+
+def par_batched_multiply(A, B, shape=None, as_list=False, workers=None):
+    """ multiplies every pair of the stacks A and B, one contiguous chunk of the batch per worker
+        A and B are 3D ndarrays, or flat row-major buffers with shape=(n, m, p) """
+    batch, n, m, p = _batch_shape(A, B, shape)
+    num_workers = min(workers or effective_cpu_count(), batch) or 1
+    if not batched_cost_model().should_parallelize(batch * n, m, p, num_workers):
+        return seq_batched_multiply(A, B, shape, as_list)
+
+    shared_A, shared_B = SharedArray('d', _flat(A)), SharedArray('d', _flat(B))
+    shared_C = SharedArray('d', batch * n * p)
+    try:
+        chunk_size = math.ceil(batch / num_workers)
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(_par_worker, shared_A, shared_B, shared_C, n, m, p, start,
+                                   min(start + chunk_size, batch)) for start in range(0, batch, chunk_size)]
+            for f in futures:
+                f.result()
+        C = array('d', shared_C.view)
+    finally:
+        for shared in (shared_A, shared_B, shared_C):
+            shared.close()
+    return result_view(C, (batch, n, p), as_list)
+
+
+def batched_cost_model():
+    """ the matmul cost model of this machine with the multiply-add cost of the chunk kernel
+        measures the kernel on a batch of 16x16 products the first time it is needed """
+    model = MatmulCostModel.load()
+    engine = 'numpy' if np is not None else 'python'
+    values = load_profile().get(PROFILE_SECTION, {})
+    if engine not in values:
+        batch, size = 256, 16
+        A = array('d', (random.random() for i in range(batch * size * size)))
+        if np is not None:
+            A_nd = np.frombuffer(A).reshape(batch, size, size)
+            elapsed = min(_time_once(np.matmul, A_nd, A_nd) for i in range(5))
+        else:
+            C = array('d', bytes(8 * len(A)))
+            elapsed = min(_time_once(_matmul_chunk, A, A, C, size, size, size, 0, batch) for i in range(3))
+        values = dict(values, **{engine: elapsed / (batch * size ** 3)})
+        save_profile(PROFILE_SECTION, values)
+    return MatmulCostModel(values[engine], model.copy_cost, model.startup_cost, model.dispatch_cost)
+
+
+if __name__ == '__main__':
+    from base_modules.matrix_multiplier import par_matrix_multiply
+
+    NUM_EVAL_RUNS = 1
+    BATCHES = ((4, 100_000), (16, 20_000), (32, 2_000))
+
+    print('{:>5} {:>8} {:>17} {:>14} {:>14} {:>9}'.format(
+        'size', 'batch', 'per-pair par_mm', 'seq batched', 'par batched', 'speedup'))
+    for size, batch in BATCHES:
+        pairs = [([[random.random() for i in range(size)] for j in range(size)],
+                  [[random.random() for i in range(size)] for j in range(size)]) for b in range(batch)]
+        A_stack, B_stack, shape = stack_pairs(pairs)
+
+        start = time.perf_counter()
+        per_pair_result = [par_matrix_multiply(A, B, as_list=True) for A, B in pairs]
+        per_pair_time = time.perf_counter() - start
+
+        seq_time = par_time = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            seq_result = seq_batched_multiply(A_stack, B_stack, shape, as_list=True)
+            seq_time += time.perf_counter() - start
+            start = time.perf_counter()
+            par_result = par_batched_multiply(A_stack, B_stack, shape, as_list=True)
+            par_time += time.perf_counter() - start
+        seq_time /= NUM_EVAL_RUNS
+        par_time /= NUM_EVAL_RUNS
+
+        if seq_result != par_result or any(abs(x - y) > 1e-9 for C, D in zip(per_pair_result, seq_result)
+                                           for row_C, row_D in zip(C, D) for x, y in zip(row_C, row_D)):
+            raise Exception('per-pair and batched results do not match.')
+        print('{:>5} {:>8} {:>14.2f} ms {:>11.2f} ms {:>11.2f} ms {:>9.2f}'.format(
+            size, batch, per_pair_time * 1000, seq_time * 1000, par_time * 1000, per_pair_time / par_time))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+""" Regression suite for every sequential/parallel implementation pair """
+
+"""
+Benchmark suite
+
+merge_sort.py, matrix_multiplier.py, download_images.py and measure_speedup.py each grew their own copy of the same
+__main__ block: warm up, time the sequential version, time the parallel version, compare, print. Nothing was kept,
+so a change that made par_merge_sort twice as slow went unnoticed unless someone remembered the old numbers.
+
+This module keeps one registry, BENCHMARKS, of named pairs. Each entry has the two functions, an input generator
+and a default size, plus an optional check for results that are not simply ==, and an optional context such as
+the local image server. The runner:
+    1. runs both functions once on copies of the same input and checks that the results agree
+    2. times both with scaling_benchmark.time_runs (warmup, then fresh inputs for each timed run)
+    3. compares the mean times with the baseline stored for this machine and fails any benchmark that got slower
+       than the threshold
+Baselines are a section of the machine profile kept by calibration.py, so they are per machine fingerprint: numbers
+measured on a laptop are never compared with numbers from a build server. A benchmark without a baseline records
+one, and --update-baseline replaces them after an intended change.
+
+    python -m base_modules.benchmark_suite                    # every benchmark
+    python -m base_modules.benchmark_suite merge_sort sum     # some of them
+    python -m base_modules.benchmark_suite --update-baseline
+The exit status is 1 if any benchmark regressed, so the suite can gate a build.
+
+With --memory, each implementation also gets one extra untimed run under memory_profile.profile_memory, and the
+report shows the peak RSS of the parent, the sum and the largest of the child processes' peaks and how many children
+were seen, tracemalloc's peak of traced memory and the top allocation sites next to the times. Children are sampled
+every memory_profile.SAMPLE_INTERVAL seconds, so one that lives shorter than that can be missed, and the traced
+peak is the most Python memory held at once, not the total allocated.
+"""
+
+import argparse
+import contextlib
+import copy
+import random
+import sys
+
+from base_modules.calibration import load_profile, machine_fingerprint, save_profile
+from base_modules.memory_profile import format_bytes, profile_memory
+from base_modules.scaling_benchmark import time_runs
+
+PROFILE_SECTION = 'benchmark_baselines'
+# a mean more than this fraction above its baseline is a regression
+THRESHOLD = 0.25
+NUM_EVAL_RUNS = 3
+
+
+class Benchmark:
+    """ a registered sequential/parallel pair
+        make_input(size) returns the argument tuple, or make_input(size, resource) when the benchmark has a
+        context, a function returning a context manager (for example a server) whose value is the resource """
+
+    def __init__(self, name, seq, par, make_input, size, check=None, context=None, par_kwargs=None):
+        self.name = name
+        self.seq = seq
+        self.par = par
+        self.make_input = make_input
+        self.size = size
+        self.check = check or (lambda sequential_result, parallel_result: sequential_result == parallel_result)
+        self.context = context or contextlib.nullcontext
+        self.par_kwargs = par_kwargs or {}
+
+
+BENCHMARKS = {}
+
+
+def register(name, seq, par, make_input, size, check=None, context=None, par_kwargs=None):
+    """ adds a pair to the registry; returns the Benchmark """
+    BENCHMARKS[name] = Benchmark(name, seq, par, make_input, size, check, context, par_kwargs)
+    return BENCHMARKS[name]
+
+
+# standard input generators
+def random_ints(size, high=10_000):
+    return [random.randint(0, high) for i in range(size)]
+
+
+def random_matrix(num_rows, num_cols):
+    return [[random.random() for i in range(num_cols)] for j in range(num_rows)]
+
+
+def matrices_close(C, D, tolerance=1e-9):
+    return len(C) == len(D) and all(abs(x - y) <= tolerance for row_C, row_D in zip(C, D)
+                                    for x, y in zip(row_C, row_D))
+
+
+def run_benchmark(benchmark, size=None, runs=NUM_EVAL_RUNS, warmup=1, memory=False):
+    """ checks and times one benchmark; returns a record of both summaries and the speedup
+        with memory, the record also holds a memory profile of each implementation """
+    size = size or benchmark.size
+    with benchmark.context() as resource:
+        def make_input(n):
+            return benchmark.make_input(n) if resource is None else benchmark.make_input(n, resource)
+
+        args = make_input(size)
+        sequential_result = benchmark.seq(*copy.deepcopy(args))
+        parallel_result = benchmark.par(*copy.deepcopy(args), **benchmark.par_kwargs)
+        if not benchmark.check(sequential_result, parallel_result):
+            raise Exception(f'{benchmark.name}: sequential_result and parallel_result do not match.')
+        sequential = time_runs(benchmark.seq, make_input, size, runs, warmup)
+        parallel = time_runs(benchmark.par, make_input, size, runs, warmup, **benchmark.par_kwargs)
+        record = {'name': benchmark.name, 'size': size, 'seq': sequential, 'par': parallel,
+                  'speedup': sequential['mean'] / parallel['mean']}
+        if memory:
+            record['seq_memory'] = profile_memory(benchmark.seq, *make_input(size))
+            record['par_memory'] = profile_memory(benchmark.par, *make_input(size), **benchmark.par_kwargs)
+    return record
+
+
+def _baseline_key(record):
+    return f"{record['name']}:{record['size']}"
+
+
+def load_baselines():
+    """ the stored baselines of this machine, keyed by 'name:size' """
+    return load_profile().get(PROFILE_SECTION, {})
+
+
+def save_baselines(records):
+    """ stores the seq and par mean times of records as the baselines of this machine """
+    baselines = dict(load_baselines())
+    for record in records:
+        baselines[_baseline_key(record)] = {'seq': record['seq']['mean'], 'par': record['par']['mean']}
+    save_profile(PROFILE_SECTION, baselines)
+
+
+def regressions(records, baselines, threshold=THRESHOLD):
+    """ messages for every seq or par mean more than threshold above its baseline """
+    messages = []
+    for record in records:
+        baseline = baselines.get(_baseline_key(record))
+        if baseline is None:
+            continue
+        for side in ('seq', 'par'):
+            change = record[side]['mean'] / baseline[side] - 1
+            if change > threshold:
+                messages.append(f"{record['name']} ({side}, size {record['size']:,}): {change:+.0%} against the "
+                                f"baseline of {baseline[side] * 1000:.2f} ms")
+    return messages
+
+
+def report(records, baselines):
+    lines = ['{:>16} {:>12} {:>12} {:>12} {:>9} {:>10}'.format(
+        'benchmark', 'size', 'seq', 'par', 'speedup', 'vs base')]
+    for record in records:
+        baseline = baselines.get(_baseline_key(record))
+        change = '-' if baseline is None else f"{record['par']['mean'] / baseline['par'] - 1:+.1%}"
+        lines.append('{:>16} {:>12,} {:>9.2f} ms {:>9.2f} ms {:>9.2f} {:>10}'.format(
+            record['name'], record['size'], record['seq']['mean'] * 1000, record['par']['mean'] * 1000,
+            record['speedup'], change))
+    memory_records = [record for record in records if 'seq_memory' in record]
+    if memory_records:
+        lines.append('')
+        lines.append('{:>16} {:>5} {:>12} {:>12} {:>12} {:>9} {:>12}   {}'.format(
+            'benchmark', 'side', 'parent rss', 'child rss', 'max child', 'children', 'traced peak',
+            'top allocation site'))
+        for record in memory_records:
+            for side in ('seq', 'par'):
+                profile = record[f'{side}_memory']
+                top_site = '{} ({})'.format(profile['top_sites'][0][0], format_bytes(profile['top_sites'][0][1])) \
+                    if profile['top_sites'] else '-'
+                lines.append('{:>16} {:>5} {:>12} {:>12} {:>12} {:>9} {:>12}   {}'.format(
+                    record['name'], side, format_bytes(profile['parent_peak_rss']),
+                    format_bytes(profile['children_peak_rss']), format_bytes(profile['max_child_peak_rss']),
+                    '-' if profile['num_children'] is None else profile['num_children'],
+                    format_bytes(profile['traced_peak']), top_site))
+    return '\n'.join(lines)
+
+
+def run_suite(names=None, size=None, runs=NUM_EVAL_RUNS, threshold=THRESHOLD, update_baseline=False,
+              memory=False):
+    """ runs the named benchmarks (all by default), prints a report and returns the regression messages
+        benchmarks without a baseline, or all of them with update_baseline, have their results stored """
+    _register_defaults()
+    unknown = [name for name in names or [] if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f'unknown benchmarks {unknown}; expected some of {sorted(BENCHMARKS)}')
+    records = [run_benchmark(BENCHMARKS[name], size, runs, memory=memory) for name in names or BENCHMARKS]
+    baselines = load_baselines()
+    print(f'machine {machine_fingerprint()}')
+    print(report(records, baselines))
+    messages = [] if update_baseline else regressions(records, baselines, threshold)
+    save_baselines([record for record in records if update_baseline or _baseline_key(record) not in baselines])
+    for message in messages:
+        print('REGRESSION', message)
+    return messages
+
+
+def _register_defaults():
+    """ registers the pairs of this project; imported here so that importing the suite stays cheap """
+    if BENCHMARKS:
+        return
+    from base_modules.bsp_stencil import heat_plate, par_heat_diffusion, seq_heat_diffusion
+    from base_modules.divide_and_conquer import pc_recursive_sum, sq_recursive_sum
+    from base_modules.download_images import par_download_images, seq_download_images
+    from base_modules.image_server import ImageServer
+    from base_modules.matrix_multiplier import par_matrix_multiply, seq_matrix_multiply
+    from base_modules.measure_speedup import par_sum, seq_sum
+    from base_modules.merge_sort import par_merge_sort, seq_merge_sort
+    from base_modules.prefix_sum import par_scan, seq_scan
+    from base_modules.radix_sort import par_sort
+
+    register('sum', seq_sum, par_sum, lambda size: (1, size), 100_000_000)
+    register('recursive_sum', sq_recursive_sum, pc_recursive_sum, lambda size: (1, size), 100_000_000)
+    register('merge_sort', seq_merge_sort, par_merge_sort, lambda size: (random_ints(size),), 1_000_000)
+    register('sort', seq_merge_sort, par_sort, lambda size: (random_ints(size),), 1_000_000)
+    register('scan', seq_scan, par_scan, lambda size: (random_ints(size),), 1_000_000,
+             check=lambda sequential_result, parallel_result: list(sequential_result) == list(parallel_result))
+    register('matrix_multiply', seq_matrix_multiply, par_matrix_multiply,
+             lambda size: (random_matrix(size, size), random_matrix(size, size)), 200,
+             check=matrices_close, par_kwargs={'as_list': True})
+    register('heat_diffusion', seq_heat_diffusion, par_heat_diffusion, lambda size: (heat_plate(size, size), 100), 512,
+             check=lambda sequential_result, parallel_result: sequential_result.tolist() == parallel_result.tolist())
+    # the local image server, so the benchmark does not depend on a public host
+    register('download_images', seq_download_images, par_download_images,
+             lambda size, server: (list(range(1, size + 1)), server.base_url), 50,
+             context=lambda: ImageServer(image_size=(20_000, 60_000), latency='broadband'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the seq/par benchmark suite against the baselines of '
+                                                 'this machine.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--size', type=int, help='problem size instead of each benchmark\'s default')
+    parser.add_argument('--runs', type=int, default=NUM_EVAL_RUNS, help='timed runs per implementation')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='allowed slowdown, e.g. 0.25')
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the baselines')
+    parser.add_argument('--memory', action='store_true', help='also profile peak RSS and Python allocations')
+    arguments = parser.parse_args()
+    sys.exit(1 if run_suite(arguments.names, arguments.size, arguments.runs, arguments.threshold,
+                            arguments.update_baseline, arguments.memory) else 0)
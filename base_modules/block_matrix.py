@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+""" Recursive block and Strassen matrix multiplication on a process pool """
+
+"""
+Block decomposition
+
+par_matrix_multiply splits C into bands of rows. That caps the number of tasks at the number of rows, and every
+worker has to read all of B, which on a many-core box means every core streams the same large matrix through its
+cache.
+
+Dividing C into blocks instead, in the same divide and conquer style as divide_and_conquer.pc_recursive_sum, gives
+smaller tasks that each read only the rows of A and the columns of B they need:
+
+    | C11 C12 |   | A11 A12 |   | B11 B12 |        C11 = A11*B11 + A12*B21     C12 = A11*B12 + A12*B22
+    |         | = |         | * |         |        C21 = A21*B11 + A22*B21     C22 = A21*B12 + A22*B22
+    | C21 C22 |   | A21 A22 |   | B21 B22 |
+
+The quadrants of C are split again and again until a block is no larger than the leaf size. Each leaf block of C
+becomes one task on the process pool. It reads a band of rows of A and a band of columns of B and writes its block
+of C straight into shared memory. Leaf blocks of C are disjoint, so no synchronization is needed.
+
+Strassen's algorithm
+--------------------
+Strassen noticed that the four quadrants of C can be computed with 7 quadrant products instead of 8, at the cost of
+extra additions:
+
+    M1 = (A11 + A22)(B11 + B22)     M5 = (A11 + A12) B22          C11 = M1 + M4 - M5 + M7
+    M2 = (A21 + A22) B11            M6 = (A21 - A11)(B11 + B12)   C12 = M3 + M5
+    M3 = A11 (B12 - B22)            M7 = (A12 - A22)(B21 + B22)   C21 = M2 + M4
+    M4 = A22 (B21 - B11)                                          C22 = M1 - M2 + M3 + M6
+
+Each level saves one eighth of the multiplications but adds 18 quadrant additions, so it only pays off above a
+machine-dependent size. tune_strassen_threshold() measures that crossover and stores it in the machine profile.
+
+While the blocks are larger than the threshold, the planner applies Strassen steps. Each one turns a product into
+7 products whose operands are signed sums of quadrants. The planner only records these sums as lists of
+(coefficient, row offset, column offset) terms; no intermediate matrix is ever built. The remaining products are
+split into leaf blocks as above. Each leaf task builds its operand bands from the terms, multiplies them and
+writes the product into its own slot of a shared scratch buffer. A final parallel pass over bands of rows of C adds
+every slot into C with the coefficients recorded by the planner.
+
+Strassen's algorithm rounds differently from the standard algorithm, so results agree with seq_matrix_multiply
+to within floating point tolerance rather than bit for bit.
+"""
+
+import math
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from base_modules.calibration import _time_once, load_profile, save_profile
+from base_modules.matrix_kernels import matmul_rows
+from base_modules.parallelism import effective_cpu_count
+from base_modules.shared_arrays import SharedArray, result_view
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the tiled pure-Python kernel is used without it
+    np = None
+
+# leaf blocks are at most LEAF_SIZE x LEAF_SIZE elements of C
+LEAF_SIZE = 256 if np is not None else 64
+# Strassen steps are applied while every dimension of a product is above the threshold
+DEFAULT_STRASSEN_THRESHOLD = 2048 if np is not None else 128
+PROFILE_SECTION = 'block_matmul'
+
+# (A quadrant terms, B quadrant terms, C quadrant terms) of the seven Strassen products;
+# quadrants are (row half, column half) with a coefficient
+_STRASSEN_PRODUCTS = [
+    ([(1, 0, 0), (1, 1, 1)], [(1, 0, 0), (1, 1, 1)], [(1, 0, 0), (1, 1, 1)]),
+    ([(1, 1, 0), (1, 1, 1)], [(1, 0, 0)], [(1, 1, 0), (-1, 1, 1)]),
+    ([(1, 0, 0)], [(1, 0, 1), (-1, 1, 1)], [(1, 0, 1), (1, 1, 1)]),
+    ([(1, 1, 1)], [(1, 1, 0), (-1, 0, 0)], [(1, 0, 0), (1, 1, 0)]),
+    ([(1, 0, 0), (1, 0, 1)], [(1, 1, 1)], [(-1, 0, 0), (1, 0, 1)]),
+    ([(1, 1, 0), (-1, 0, 0)], [(1, 0, 0), (1, 0, 1)], [(1, 1, 1)]),
+    ([(1, 0, 1), (-1, 1, 1)], [(1, 1, 0), (1, 1, 1)], [(1, 0, 0)]),
+]
+
+
+def strassen_threshold():
+    """ the tuned threshold of this machine, or the default if it has not been tuned """
+    return load_profile().get(PROFILE_SECTION, {}).get('strassen_threshold', DEFAULT_STRASSEN_THRESHOLD)
+
+
+def _quadrant(terms, row_half, col_half, num_rows, num_cols):
+    """ shifts (coefficient, row, column) terms to one quadrant of a num_rows x num_cols block """
+    return [(coef, row + row_half * num_rows // 2, col + col_half * num_cols // 2) for coef, row, col in terms]
+
+
+def _plan_strassen(a_terms, b_terms, c_terms, dims, levels, products):
+    """ applies levels Strassen steps and appends the resulting (a_terms, b_terms, c_terms) products """
+    if levels == 0:
+        products.append((a_terms, b_terms, c_terms))
+        return
+    n, m, p = dims
+    for a_quads, b_quads, c_quads in _STRASSEN_PRODUCTS:
+        sub_a = [(sign * coef, row, col) for sign, rh, ch in a_quads
+                 for coef, row, col in _quadrant(a_terms, rh, ch, n, m)]
+        sub_b = [(sign * coef, row, col) for sign, rh, ch in b_quads
+                 for coef, row, col in _quadrant(b_terms, rh, ch, m, p)]
+        sub_c = [(sign * coef, row, col) for sign, rh, ch in c_quads
+                 for coef, row, col in _quadrant(c_terms, rh, ch, n, p)]
+        _plan_strassen(sub_a, sub_b, sub_c, (n // 2, m // 2, p // 2), levels - 1, products)
+
+
+def _plan_blocks(row_start, row_end, col_start, col_end, leaf, blocks):
+    """ recursively splits a block of C into quadrants until it is no larger than leaf x leaf """
+    if row_end - row_start <= leaf and col_end - col_start <= leaf:
+        blocks.append((row_start, row_end, col_start, col_end))
+        return
+    row_mid = (row_start + row_end) // 2 if row_end - row_start > leaf else row_end
+    col_mid = (col_start + col_end) // 2 if col_end - col_start > leaf else col_end
+    for rows in ((row_start, row_mid), (row_mid, row_end)):
+        for cols in ((col_start, col_mid), (col_mid, col_end)):
+            if rows[0] < rows[1] and cols[0] < cols[1]:
+                _plan_blocks(*rows, *cols, leaf, blocks)
+
+
+def _combination(M, stride, terms, row_start, row_end, col_start, col_end):
+    """ rows row_start..row_end-1 and columns col_start..col_end-1 of the signed sum of blocks in terms """
+    if np is not None:
+        M = M.as_ndarray().reshape(-1, stride)
+        total = None
+        for coef, row, col in terms:
+            part = coef * M[row + row_start:row + row_end, col + col_start:col + col_end]
+            total = part if total is None else total + part
+        return total
+    view = M.view
+    out = array('d')
+    for r in range(row_start, row_end):
+        total = None
+        for coef, row, col in terms:
+            start = (row + r) * stride + col
+            segment = view[start + col_start:start + col_end]
+            if total is None:
+                total = segment.tolist() if coef == 1 else [coef * x for x in segment]
+            else:
+                total = [t + coef * x for t, x in zip(total, segment)]
+        out.extend(total)
+    return out
+
+
+def _block_worker(A, B, out, strides, a_terms, b_terms, inner, block, out_origin, out_stride):
+    """ computes one leaf block of a product and writes it to out at out_origin (row, column) """
+    stride_A, stride_B = strides
+    row_start, row_end, col_start, col_end = block
+    X = _combination(A, stride_A, a_terms, row_start, row_end, 0, inner)
+    Y = _combination(B, stride_B, b_terms, 0, inner, col_start, col_end)
+    num_rows, num_cols = row_end - row_start, col_end - col_start
+    out_row, out_col = out_origin
+    if np is not None:
+        out_nd = out.as_ndarray().reshape(-1, out_stride)
+        out_nd[out_row + row_start:out_row + row_end, out_col + col_start:out_col + col_end] = X @ Y
+        del out_nd
+        return
+    P = array('d', bytes(8 * num_rows * num_cols))
+    matmul_rows(X, Y, P, inner, num_cols, 0, num_rows)
+    for i in range(num_rows):
+        start = (out_row + row_start + i) * out_stride + out_col + col_start
+        out.view[start:start + num_cols] = P[i * num_cols:(i + 1) * num_cols]
+
+
+def _combine_worker(scratch, C, products_c_terms, sub_dims, stride_C, band_start, band_end):
+    """ adds every product slot of the scratch buffer into rows band_start..band_end-1 of C """
+    n, p = sub_dims
+    if np is not None:
+        C_nd = C.as_ndarray().reshape(-1, stride_C)
+        scratch_nd = scratch.as_ndarray().reshape(-1, p)
+    for index, c_terms in enumerate(products_c_terms):
+        for coef, row, col in c_terms:
+            start, end = max(band_start, row), min(band_end, row + n)
+            if start >= end:
+                continue
+            slot_row = index * n + start - row
+            if np is not None:
+                C_nd[start:end, col:col + p] += coef * scratch_nd[slot_row:slot_row + end - start]
+                continue
+            for r in range(start, end):
+                C_seg = C.view[r * stride_C + col:r * stride_C + col + p]
+                P_row = scratch.view[(slot_row + r - start) * p:(slot_row + r - start + 1) * p]
+                C_seg[:] = array('d', [c + coef * x for c, x in zip(C_seg, P_row)])
+    if np is not None:
+        del C_nd, scratch_nd
+
+
+def _padded(M, num_rows, num_cols, num_rows_pad, num_cols_pad):
+    """ flat row-major copy of M with zero padding on the right and at the bottom """
+    if np is not None:
+        padded = np.zeros((num_rows_pad, num_cols_pad))
+        padded[:num_rows, :num_cols] = M
+        return padded
+    padding = [0.0] * (num_cols_pad - num_cols)
+    flat = array('d')
+    for row in M:
+        flat.extend(row)
+        flat.extend(padding)
+    flat.extend([0.0] * (num_cols_pad * (num_rows_pad - num_rows)))
+    return flat
+
+
+def par_block_matrix_multiply(A, B, as_list=False, workers=None, leaf=LEAF_SIZE, strassen=True, threshold=None):
+    """ C = A*B by recursive block decomposition, with Strassen steps above the threshold
+        returns a 2D view like par_matrix_multiply, or a list-of-lists if as_list=True """
+    num_rows_A, num_cols_A = len(A), len(A[0])
+    num_rows_B, num_cols_B = len(B), len(B[0])
+    if num_cols_A != num_rows_B:
+        raise ArithmeticError(
+            f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
+    threshold = threshold or strassen_threshold()
+    levels = 0
+    if strassen:
+        while min(num_rows_A, num_cols_A, num_cols_B) >> levels > max(threshold, leaf):
+            levels += 1
+    # Strassen steps halve every dimension, so pad each one to a multiple of 2**levels
+    n, m, p = (math.ceil(dim / 2 ** levels) * 2 ** levels for dim in (num_rows_A, num_cols_A, num_cols_B))
+    sub_n, sub_m, sub_p = n >> levels, m >> levels, p >> levels
+
+    products = []
+    _plan_strassen([(1, 0, 0)], [(1, 0, 0)], [(1, 0, 0)], (n, m, p), levels, products)
+    blocks = []
+    _plan_blocks(0, sub_n, 0, sub_p, leaf, blocks)
+
+    num_workers = workers or effective_cpu_count()
+    shared_A = SharedArray('d', _padded(A, num_rows_A, num_cols_A, n, m))
+    shared_B = SharedArray('d', _padded(B, num_rows_B, num_cols_B, m, p))
+    C = SharedArray('d', n * p)
+    # without Strassen steps every leaf block of C is written by exactly one task
+    scratch = SharedArray('d', len(products) * sub_n * sub_p) if levels else None
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = []
+            for index, (a_terms, b_terms, c_terms) in enumerate(products):
+                out, out_origin, out_stride = (scratch, (index * sub_n, 0), sub_p) if levels else (C, (0, 0), p)
+                futures += [pool.submit(_block_worker, shared_A, shared_B, out, (m, p), a_terms, b_terms, sub_m,
+                                        block, out_origin, out_stride) for block in blocks]
+            for f in futures:
+                f.result()
+            if levels:
+                band = math.ceil(n / num_workers)
+                c_terms = [product[2] for product in products]
+                futures = [pool.submit(_combine_worker, scratch, C, c_terms, (sub_n, sub_p), p, row,
+                                       min(row + band, n)) for row in range(0, n, band)]
+                for f in futures:
+                    f.result()
+        C_1D = array('d')
+        for i in range(num_rows_A):
+            C_1D.extend(C.view[i * p:i * p + num_cols_B])
+    finally:
+        for shared in (shared_A, shared_B, C, scratch):
+            if shared is not None:
+                shared.close()
+    return result_view(C_1D, (num_rows_A, num_cols_B), as_list)
+
+
+def _leaf_multiply_time(size, repeats=3):
+    """ seconds for one size x size product with the leaf kernel """
+    if np is not None:
+        X = np.random.random((size, size))
+        multiply = lambda: X @ X
+    else:
+        X = array('d', (random.random() for i in range(size * size)))
+        P = array('d', bytes(8 * size * size))
+        multiply = lambda: matmul_rows(X, X, P, size, size, 0, size)
+    return min(_time_once(multiply) for i in range(repeats))
+
+
+def _add_time(size, repeats=3):
+    """ seconds for adding two size x size blocks the way _combination does """
+    if np is not None:
+        X = np.random.random((size, size))
+        add = lambda: X + X
+    else:
+        X = [random.random() for i in range(size)]
+        add = lambda: [[a + b for a, b in zip(X, X)] for i in range(size)]
+    return min(_time_once(add) for i in range(repeats))
+
+
+def tune_strassen_threshold(candidates=None):
+    """ finds the smallest size where one Strassen step beats the standard block product and stores it
+        one step replaces 8 half-size products with 7 products and 18 half-size additions """
+    candidates = candidates or ((256, 512, 1024, 2048, 4096) if np is not None else (32, 64, 128, 256, 512))
+    threshold = candidates[-1]
+    for size in candidates:
+        half = size // 2
+        if 7 * _leaf_multiply_time(half) + 18 * _add_time(half) < 8 * _leaf_multiply_time(half):
+            threshold = size
+            break
+    save_profile(PROFILE_SECTION, {'strassen_threshold': threshold})
+    return threshold
+
+
+if __name__ == '__main__':
+    from base_modules.matrix_multiplier import par_matrix_multiply
+
+    SIZES = (256, 512, 1024) if np is not None else (128, 256, 384)
+
+    print('Tuning the Strassen threshold...')
+    threshold = tune_strassen_threshold()
+    print('Strassen threshold:', threshold)
+
+    print('{:>6} {:>14} {:>14} {:>14}'.format('size', 'row chunks', 'block', 'block+strassen'))
+    for size in SIZES:
+        A = [[random.random() for i in range(size)] for j in range(size)]
+        B = [[random.random() for i in range(size)] for j in range(size)]
+        timings = []
+        results = []
+        for func, kwargs in ((par_matrix_multiply, {}),
+                             (par_block_matrix_multiply, {'strassen': False}),
+                             (par_block_matrix_multiply, {'threshold': min(threshold, size // 2)})):
+            start = time.perf_counter()
+            results.append(func(A, B, as_list=True, **kwargs))
+            timings.append(time.perf_counter() - start)
+        for result in results[1:]:
+            if any(abs(x - y) > 1e-9 * size for row_x, row_y in zip(results[0], result) for x, y in zip(row_x, row_y)):
+                raise Exception('row chunk and block results do not match.')
+        print('{:>6} '.format(size) + ' '.join('{:>11.2f} ms'.format(t * 1000) for t in timings))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+""" Bulk-synchronous-parallel engine for iterative stencil computations on a grid in shared memory """
+
+"""
+Bulk synchronous parallel
+
+barrier.py shows threads huddling at a threading.Barrier, and the Communication section of pcam_pcomputing.py
+describes tasks that exchange data point-to-point with their neighbours. Iterative stencil computations need
+exactly those two things. Heat diffusion, image filters and the Game of Life update every cell of a grid from its
+neighbours, over and over.
+
+The bulk synchronous parallel (BSP) model runs such a computation as a sequence of supersteps. In each superstep
+every worker
+    1. computes     - updates the cells it owns, reading only its own block of the grid
+    2. communicates - sends the data its neighbours will need in the next superstep
+    3. synchronizes - waits at a barrier until every worker has finished the superstep
+so no worker ever reads a value that is still being written, without any locks around the cells themselves.
+
+BSPEngine splits the interior rows of a grid into one strip per worker process. Each strip is a SharedArray holding
+the strip plus halo ghost rows above and below it, twice: the current buffer the step reads, and the next buffer it
+writes. Communication is a halo exchange. After its step a worker copies its first and last owned rows straight
+into the ghost rows of its neighbours' next buffers, then waits on a multiprocessing.Barrier shared by all workers.
+The current buffer is never written during a superstep, so one barrier per superstep is enough. When the barrier
+releases, the two buffers swap roles.
+
+The step is a plain function step(cur, nxt, row_start). cur and nxt are the two buffers of a strip, as ndarrays of
+shape (rows + 2 * halo, cols), or 2D typed memoryviews without NumPy. row_start is the grid row of cur[0]. The step
+writes nxt[halo:-halo] and may return a number, for example the largest change of any cell. With a tolerance, those
+numbers are reduced to their maximum across the workers after every barrier, and every worker stops once it is
+below the tolerance. The first and last halo rows of the grid are fixed boundary values. So are any columns the
+step does not write, because both buffers start out as copies of the grid.
+
+seq() runs the same supersteps on a single strip in this process, so both versions give identical results.
+jacobi_step, with seq_heat_diffusion and par_heat_diffusion, is the standard example: heat spreading from a hot edge
+across a plate, where every cell becomes the mean of its four neighbours.
+"""
+
+import math
+import multiprocessing as mp
+import threading
+import time
+import traceback
+from array import array
+from collections import namedtuple
+from itertools import chain
+from multiprocessing.connection import wait
+
+from base_modules.parallelism import effective_cpu_count, placed_process
+from base_modules.shared_arrays import SharedArray
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; steps get 2D typed memoryviews without it
+    np = None
+
+BSPResult = namedtuple('BSPResult', 'grid supersteps residual compute_time sync_time')
+# per worker statistics: supersteps run, residual, seconds computing, seconds exchanging and waiting
+_NUM_STATS = 4
+
+
+def split_rows(num_rows, num_parts, halo=1):
+    """ the (start, end) grid rows owned by each of num_parts strips; the first and last halo rows are boundary """
+    interior = num_rows - 2 * halo
+    bounds = [halo + interior * part // num_parts for part in range(num_parts + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _buffer(block, parity, num_rows, num_cols):
+    """ one of the two buffers of a strip as a 2D ndarray, or a 2D typed memoryview without NumPy """
+    size = num_rows * num_cols
+    flat = block.view[parity * size:(parity + 1) * size]
+    if np is not None:
+        return np.frombuffer(flat, dtype=block.typecode).reshape(num_rows, num_cols)
+    return flat.cast('B').cast(block.typecode, [num_rows, num_cols])
+
+
+def _rows(block, parity, first, last, num_rows, num_cols):
+    """ flat view of rows first..last of one buffer of a strip """
+    offset = parity * num_rows * num_cols
+    return block.view[offset + first * num_cols:offset + last * num_cols]
+
+
+def _superstep_loop(step, rank, blocks, strips, num_cols, halo, supersteps, tolerance, barrier, residuals, stats):
+    """ runs the supersteps of one strip; the body of every worker process, and of seq() in this process """
+    start, end = strips[rank]
+    num_rows = end - start + 2 * halo
+    num_workers = len(strips)
+    done, residual, compute_time, sync_time = 0, float('nan'), 0.0, 0.0
+    try:
+        for superstep in range(supersteps):
+            parity = superstep % 2
+            cur, nxt = _buffer(blocks[rank], parity, num_rows, num_cols), _buffer(blocks[rank], 1 - parity,
+                                                                                 num_rows, num_cols)
+            started = time.perf_counter()
+            value = step(cur, nxt, start - halo)
+            del cur, nxt
+            computed = time.perf_counter()
+            # halo exchange: my first and last owned rows become the ghost rows of my neighbours' next buffers
+            if rank > 0:
+                above = strips[rank - 1][1] - strips[rank - 1][0] + 2 * halo
+                _rows(blocks[rank - 1], 1 - parity, above - halo, above, above, num_cols)[:] = \
+                    _rows(blocks[rank], 1 - parity, halo, 2 * halo, num_rows, num_cols)
+            if rank < num_workers - 1:
+                below = strips[rank + 1][1] - strips[rank + 1][0] + 2 * halo
+                _rows(blocks[rank + 1], 1 - parity, 0, halo, below, num_cols)[:] = \
+                    _rows(blocks[rank], 1 - parity, num_rows - 2 * halo, num_rows - halo, num_rows, num_cols)
+            if tolerance is not None:
+                if value is None:
+                    raise ValueError('a step must return a residual when a tolerance is given')
+                # alternate between two sets of slots, so a fast worker never overwrites a value still being read
+                residuals[parity * num_workers + rank] = value
+            barrier.wait()
+            sync_time += time.perf_counter() - computed
+            compute_time += computed - started
+            done = superstep + 1
+            if tolerance is not None:
+                residual = max(residuals.view[parity * num_workers:(parity + 1) * num_workers])
+                if residual < tolerance:
+                    break
+    except BaseException as exc:
+        # drop the views of the strip, here and in the frames of the step, so that its SharedArray can be closed
+        # while the exception propagates
+        cur = nxt = None
+        traceback.clear_frames(exc.__traceback__)
+        # wake up the other workers with a BrokenBarrierError instead of leaving them waiting forever
+        barrier.abort()
+        raise
+    stats.view[rank * _NUM_STATS:(rank + 1) * _NUM_STATS] = array('d', [done, residual, compute_time, sync_time])
+
+
+class BSPEngine:
+    """ runs step(cur, nxt, row_start) over a grid in bulk synchronous supersteps with a halo exchange between
+        neighbouring strips; see the module notes for the contract of step, which must be picklable """
+
+    def __init__(self, step, halo=1):
+        self.step = step
+        self.halo = halo
+
+    def max_workers(self, num_rows):
+        """ the most strips a grid of num_rows rows can be split into; a strip must own at least halo rows """
+        return max(1, (num_rows - 2 * self.halo) // self.halo)
+
+    def seq(self, grid, supersteps, tolerance=None, as_list=False):
+        """ runs up to supersteps supersteps on one strip in this process; returns a BSPResult """
+        return self._run(grid, supersteps, tolerance, 1, None, as_list, inline=True)
+
+    def par(self, grid, supersteps, tolerance=None, workers=None, placement=None, as_list=False):
+        """ runs up to supersteps supersteps with one worker process per strip; returns a BSPResult
+            grid is a list of rows or a 2D ndarray; the result grid is an ndarray, or a 2D typed memoryview
+            without NumPy, or a list of rows if as_list=True. tolerance stops every worker once the largest value
+            a step returned in a superstep is below it. placement pins the worker processes with a
+            parallelism.PLACEMENTS policy """
+        num_workers = min(workers or effective_cpu_count(), self.max_workers(len(grid)))
+        if num_workers < 2:
+            return self.seq(grid, supersteps, tolerance, as_list)
+        return self._run(grid, supersteps, tolerance, num_workers, placement, as_list)
+
+    def _run(self, grid, supersteps, tolerance, num_workers, placement, as_list, inline=False):
+        halo = self.halo
+        num_rows, num_cols = len(grid), len(grid[0])
+        if num_rows < 3 * halo:
+            raise ArithmeticError(f"Invalid dimensions; a {num_rows}x{num_cols} grid has no interior rows "
+                                  f"inside a halo of {halo}")
+        flat = _flatten(grid)
+        strips = split_rows(num_rows, num_workers, halo)
+        blocks = []
+        residuals = SharedArray('d', 2 * num_workers)
+        stats = SharedArray('d', _NUM_STATS * num_workers)
+        try:
+            # both buffers of every strip start as a copy of its rows and ghost rows
+            for start, end in strips:
+                block = SharedArray('d', 2 * (end - start + 2 * halo) * num_cols)
+                blocks.append(block)
+                rows = flat[(start - halo) * num_cols:(end + halo) * num_cols]
+                block.load(rows)
+                block.load(rows, len(block) // 2)
+            args = (blocks, strips, num_cols, halo, supersteps, tolerance)
+            if inline:
+                _superstep_loop(self.step, 0, *args, threading.Barrier(1), residuals, stats)
+            else:
+                self._run_workers(args, placement, residuals, stats)
+            done = int(stats[0])
+            result = _gather(flat, blocks, strips, num_rows, num_cols, halo, done % 2)
+            worker_stats = [stats.view[rank * _NUM_STATS:(rank + 1) * _NUM_STATS] for rank in range(num_workers)]
+            residual = stats[1]
+            compute_time = max(s[2] for s in worker_stats)
+            sync_time = sum(s[3] for s in worker_stats) / num_workers
+            del worker_stats
+        finally:
+            for block in blocks:
+                block.close()
+            residuals.close()
+            stats.close()
+        if as_list:
+            result = result.tolist()
+        return BSPResult(result, done, None if math.isnan(residual) else residual, compute_time, sync_time)
+
+    def _run_workers(self, args, placement, residuals, stats):
+        num_workers = len(args[1])
+        barrier = mp.Barrier(num_workers)
+        # each worker pins itself before its first superstep, so its strip is first touched on its own CPU
+        worker_procs = [placed_process(_superstep_loop, (self.step, rank, *args, barrier, residuals, stats), rank,
+                                       placement)
+                        for rank in range(num_workers)]
+        for w in worker_procs:
+            w.start()
+        # a worker that dies without raising (killed, out of memory) cannot abort the barrier itself
+        pending = list(worker_procs)
+        while pending:
+            finished = wait([w.sentinel for w in pending])
+            for w in [w for w in pending if w.sentinel in finished]:
+                w.join()
+                pending.remove(w)
+                if w.exitcode:
+                    barrier.abort()
+        failed = [rank for rank, w in enumerate(worker_procs) if w.exitcode]
+        if failed:
+            raise RuntimeError(f'BSP workers {failed} failed; see their tracebacks above')
+
+
+def _flatten(grid):
+    """ row-major flattening of a list of rows or a 2D ndarray """
+    if np is not None:
+        return np.ascontiguousarray(grid, dtype='d').ravel()
+    return array('d', chain.from_iterable(grid))
+
+
+def _gather(flat, blocks, strips, num_rows, num_cols, halo, parity):
+    """ the grid assembled from the given buffer of every strip, with the boundary rows of the input """
+    result = array('d', flat) if np is None else flat.copy()
+    target = memoryview(result) if np is None else result
+    for block, (start, end) in zip(blocks, strips):
+        target[start * num_cols:end * num_cols] = _rows(block, parity, halo, end - start + halo,
+                                                        end - start + 2 * halo, num_cols)
+    if np is not None:
+        return result.reshape(num_rows, num_cols)
+    target.release()
+    return memoryview(result).cast('B').cast('d', [num_rows, num_cols])
+
+
+def jacobi_step(cur, nxt, row_start):
+    """ one Jacobi sweep of the heat equation: every interior cell becomes the mean of its four neighbours
+        returns the largest change of any cell """
+    if np is not None:
+        nxt[1:-1, 1:-1] = 0.25 * (cur[:-2, 1:-1] + cur[2:, 1:-1] + cur[1:-1, :-2] + cur[1:-1, 2:])
+        return float(np.abs(nxt[1:-1, 1:-1] - cur[1:-1, 1:-1]).max(initial=0.0))
+    num_rows, num_cols = cur.shape
+    change = 0.0
+    for i in range(1, num_rows - 1):
+        for j in range(1, num_cols - 1):
+            value = 0.25 * (cur[i - 1, j] + cur[i + 1, j] + cur[i, j - 1] + cur[i, j + 1])
+            change = max(change, abs(value - cur[i, j]))
+            nxt[i, j] = value
+    return change
+
+
+HEAT_DIFFUSION = BSPEngine(jacobi_step, halo=1)
+
+
+def heat_plate(num_rows, num_cols, hot=100.0, cold=0.0):
+    """ a plate at temperature cold with its top edge held at hot, as a list of rows """
+    return [[hot] * num_cols] + [[cold] * num_cols for i in range(num_rows - 1)]
+
+
+def seq_heat_diffusion(grid, supersteps, tolerance=None):
+    """ the temperatures after up to supersteps Jacobi sweeps, computed in this process """
+    return HEAT_DIFFUSION.seq(grid, supersteps, tolerance).grid
+
+
+def par_heat_diffusion(grid, supersteps, tolerance=None, workers=None, placement=None):
+    """ the temperatures after up to supersteps Jacobi sweeps, computed by one worker process per strip """
+    return HEAT_DIFFUSION.par(grid, supersteps, tolerance, workers, placement).grid
+
+
+if __name__ == '__main__':
+    import sys
+
+    from base_modules.scaling_benchmark import ascii_chart, report, save_json, strong_scaling, weak_scaling
+
+    # python -m base_modules.bsp_stencil [results.json]
+    JSON_PATH = sys.argv[1] if len(sys.argv) > 1 else 'bsp_stencil.json'
+    NUM_EVAL_RUNS = 3
+    SIZE = 1024 if np is not None else 96
+    SUPERSTEPS = 200 if np is not None else 20
+    NUM_WORKERS = effective_cpu_count()
+
+    def plate_input(num_rows):
+        return heat_plate(num_rows, SIZE), SUPERSTEPS
+
+    # the parallel supersteps must reproduce the sequential ones exactly
+    plate = heat_plate(SIZE, SIZE)
+    sequential = HEAT_DIFFUSION.seq(plate, SUPERSTEPS)
+    parallel = HEAT_DIFFUSION.par(plate, SUPERSTEPS, workers=max(2, NUM_WORKERS))
+    if sequential.grid.tolist() != parallel.grid.tolist():
+        raise Exception('sequential_result and parallel_result do not match.')
+    print(f'{SUPERSTEPS} supersteps on a {SIZE}x{SIZE} plate with {max(2, NUM_WORKERS)} workers: '
+          f'{parallel.compute_time * 1000:.2f} ms computing, {parallel.sync_time * 1000:.2f} ms exchanging halos '
+          f'and waiting at the barrier')
+    converged = HEAT_DIFFUSION.par(heat_plate(SIZE // 8, SIZE // 8), 100_000, tolerance=1e-3, workers=NUM_WORKERS)
+    print(f'a {SIZE // 8}x{SIZE // 8} plate converged to within 1e-3 after {converged.supersteps:,} supersteps')
+    print()
+
+    results = [strong_scaling(seq_heat_diffusion, par_heat_diffusion, plate_input, SIZE, runs=NUM_EVAL_RUNS,
+                              check=False),
+               weak_scaling(seq_heat_diffusion, par_heat_diffusion, plate_input, SIZE // 2, runs=NUM_EVAL_RUNS,
+                            check=False)]
+    for result in results:
+        print(report(result))
+        print(ascii_chart(result))
+        print()
+    save_json(results, JSON_PATH)
+    print('Results written to', JSON_PATH)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+""" Per-machine calibration of the costs that decide when parallelism pays off """
+
+"""
+Calibration
+
+Whether a parallel implementation beats the sequential one depends on the ratio of useful work to overhead, and
+both sides of that ratio depend on the machine. par_matrix_multiply used to fall back to the sequential version
+whenever the result had fewer than 25,000 elements. That is a guess that is too high on some machines and too
+low on others.
+
+This module measures the relevant costs once per machine and stores them as JSON in a profile directory
+(~/.cache/multi_threading_processing, or MTP_PROFILE_DIR if it is set). The file name includes a fingerprint
+of the host, the CPU count and the Python version, so a profile copied to a different machine is ignored rather
+than trusted. The first parallel call on a new machine pays for the calibration, which takes well under a second.
+Every later call, including calls from other processes, reads the stored numbers.
+
+Machine profile
+---------------
+pcam_pcomputing.py describes agglomeration (how big the tasks are) and mapping (how many workers run them), and
+both depend on the same few costs. MachineProfile measures them:
+    dispatch_cost - seconds per task round trip through an already running process pool
+    startup_cost  - seconds to start and join one process
+    ipc_cost      - seconds per byte pickled to a pool worker
+    shm_cost      - seconds per byte copied into a SharedArray
+    element costs - seconds per element of the named kernels in ELEMENT_KERNELS ('sum', 'sort', 'madd', 'scan'),
+                    each measured the first time it is asked for
+
+plan() turns them into a decision for n elements of a kernel. Tasks hold at least MIN_TASK_RATIO dispatch costs of
+work, so dispatching stays a small fraction of the total, and otherwise aim for OVERSUBSCRIPTION tasks per worker.
+The worker count is the one with the lowest predicted time, and if no worker count beats the sequential time the
+plan says to stay sequential. This replaces the fixed chunk sizes and cutoffs the parallel functions used to have.
+Running this module recalibrates everything and prints the profile.
+"""
+
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import random
+import sys
+import time
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from base_modules.parallelism import effective_cpu_count
+
+PROFILE_DIR = os.environ.get('MTP_PROFILE_DIR',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'multi_threading_processing'))
+
+_profile_cache = {}
+
+# tasks per worker a plan aims for, so a slow task does not hold up the others
+OVERSUBSCRIPTION = 4
+# a task computes for at least this many dispatch costs
+MIN_TASK_RATIO = 10
+
+
+def machine_fingerprint():
+    """ short, stable identifier of the machine and interpreter the measurements belong to """
+    description = '|'.join([platform.node(), platform.machine(), platform.processor(), str(mp.cpu_count()),
+                            platform.python_implementation(), '.'.join(map(str, sys.version_info[:2]))])
+    return hashlib.sha1(description.encode()).hexdigest()[:12]
+
+
+def profile_path():
+    return os.path.join(PROFILE_DIR, f'machine-{machine_fingerprint()}.json')
+
+
+def load_profile():
+    """ returns the stored profile of this machine, or an empty dict if there is none """
+    path = profile_path()
+    if path not in _profile_cache:
+        try:
+            with open(path) as f:
+                _profile_cache[path] = json.load(f)
+        except (OSError, ValueError):
+            _profile_cache[path] = {}
+    return _profile_cache[path]
+
+
+def save_profile(section, values):
+    """ stores one section of the machine profile, keeping the other sections """
+    profile = dict(load_profile())
+    profile[section] = values
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path()
+    # write to a temporary file first so that concurrent readers never see half a profile
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    _profile_cache[path] = profile
+    return profile
+
+
+def _noop(data=None):
+    return None
+
+
+def _sum_cost():
+    n = 1_000_000
+    return min(_time_once(sum, range(n)) for i in range(3)) / n
+
+
+def _sort_cost():
+    from base_modules.merge_sort import buffered_merge_sort, np
+
+    n = 100_000 if np is not None else 20_000
+    values = [random.random() for i in range(n)]
+    if np is not None:
+        values = np.array(values)
+        return min(_time_once(np.sort, values) for i in range(3)) / n
+    return min(_time_once(buffered_merge_sort, values.copy()) for i in range(3)) / n
+
+
+def _madd_cost():
+    return MatmulCostModel.measure_madd_cost()
+
+
+def _scan_cost():
+    from base_modules.prefix_sum import np
+
+    n = 1_000_000 if np is not None else 100_000
+    if np is not None:
+        values = np.arange(n)
+        return min(_time_once(np.add.accumulate, values) for i in range(3)) / n
+    return min(_time_once(lambda: list(itertools.accumulate(range(n)))) for i in range(3)) / n
+
+
+# seconds per element of each kernel, measured on first use
+ELEMENT_KERNELS = {'sum': _sum_cost, 'sort': _sort_cost, 'madd': _madd_cost, 'scan': _scan_cost}
+
+
+Plan = namedtuple('Plan', 'parallel workers num_chunks chunk_size seq_time par_time')
+
+
+class MachineProfile:
+    """ the measured overheads and per-element costs of this machine, and the plans derived from them """
+
+    SECTION = 'machine'
+
+    def __init__(self, dispatch_cost, startup_cost, ipc_cost, shm_cost, element_costs=None):
+        self.dispatch_cost = dispatch_cost
+        self.startup_cost = startup_cost
+        self.ipc_cost = ipc_cost
+        self.shm_cost = shm_cost
+        self.element_costs = dict(element_costs or {})
+
+    def to_dict(self):
+        return {'dispatch_cost': self.dispatch_cost, 'startup_cost': self.startup_cost, 'ipc_cost': self.ipc_cost,
+                'shm_cost': self.shm_cost, 'element_costs': dict(self.element_costs)}
+
+    def element_cost(self, kernel):
+        """ seconds per element of a kernel in ELEMENT_KERNELS; measured and stored the first time """
+        if kernel not in self.element_costs:
+            self.element_costs[kernel] = ELEMENT_KERNELS[kernel]()
+            save_profile(self.SECTION, self.to_dict())
+        return self.element_costs[kernel]
+
+    def plan(self, num_elements, element_cost, transfer_cost=0.0, max_workers=None, pooled=False):
+        """ how to run num_elements elements costing element_cost seconds each (or a kernel name) on up to
+            max_workers processes; transfer_cost is the seconds per element of moving data to the workers,
+            and pooled means the workers are already running """
+        cost = self.element_cost(element_cost) if isinstance(element_cost, str) else element_cost
+        max_workers = max_workers or effective_cpu_count()
+        seq_time = num_elements * cost
+        best = Plan(False, 1, 1, num_elements, seq_time, seq_time)
+        if not num_elements or not cost:
+            return best
+        min_chunk = max(1, math.ceil(MIN_TASK_RATIO * self.dispatch_cost / cost))
+        for workers in range(2, max_workers + 1):
+            chunk_size = max(min_chunk, math.ceil(num_elements / (workers * OVERSUBSCRIPTION)))
+            num_chunks = math.ceil(num_elements / chunk_size)
+            if num_chunks < workers:
+                # there is not enough work for more workers
+                break
+            par_time = (seq_time / workers + num_chunks * self.dispatch_cost + num_elements * transfer_cost +
+                        (0 if pooled else workers * self.startup_cost))
+            if par_time < best.par_time:
+                best = Plan(True, workers, num_chunks, chunk_size, seq_time, par_time)
+        return best
+
+    def chunks(self, num_elements, num_workers, element_cost):
+        """ number of tasks for num_elements on exactly num_workers workers """
+        cost = self.element_cost(element_cost) if isinstance(element_cost, str) else element_cost
+        min_chunk = max(1, math.ceil(MIN_TASK_RATIO * self.dispatch_cost / cost)) if cost else num_elements
+        chunk_size = max(min_chunk, math.ceil(num_elements / (num_workers * OVERSUBSCRIPTION)))
+        return max(1, min(num_elements, math.ceil(num_elements / chunk_size)))
+
+    @classmethod
+    def calibrate(cls, repeats=5):
+        """ measures the overheads on this machine; element costs are measured when first needed """
+        from base_modules.shared_arrays import SharedArray
+
+        def start_and_join():
+            p = mp.Process(target=_noop)
+            p.start()
+            p.join()
+        startup_cost = min(_time_once(start_and_join) for i in range(repeats))
+
+        data = bytes(2 ** 20)
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            pool.submit(_noop).result()  # "warm up"
+            dispatch_cost = min(_time_once(lambda: pool.submit(_noop).result()) for i in range(repeats * 4))
+            send_time = min(_time_once(lambda: pool.submit(_noop, data).result()) for i in range(repeats))
+        ipc_cost = max(0.0, send_time - dispatch_cost) / len(data)
+
+        values = array('d', bytes(2 ** 20))
+        shm_cost = min(_time_once(lambda: SharedArray('d', values).close()) for i in range(repeats)) / 2 ** 20
+        return cls(dispatch_cost, startup_cost, ipc_cost, shm_cost)
+
+    @classmethod
+    def load(cls):
+        """ the profile of this machine; calibrates and stores it on first use """
+        values = load_profile().get(cls.SECTION)
+        if values is None:
+            values = cls.calibrate().to_dict()
+            save_profile(cls.SECTION, values)
+        return cls(**values)
+
+
+class MatmulCostModel:
+    """ predicts sequential and parallel matrix multiplication times from calibrated unit costs
+
+        madd_cost     - seconds per multiply-add of the tiled pure-Python kernel
+        copy_cost     - seconds per element copied into shared memory
+        startup_cost  - seconds to start and join one mp.Process
+        dispatch_cost - seconds per task round trip through an already running process pool """
+
+    SECTION = 'matmul'
+
+    def __init__(self, madd_cost, copy_cost, startup_cost, dispatch_cost):
+        self.madd_cost = madd_cost
+        self.copy_cost = copy_cost
+        self.startup_cost = startup_cost
+        self.dispatch_cost = dispatch_cost
+
+    def seq_time(self, num_rows_A, num_cols_A, num_cols_B):
+        return num_rows_A * num_cols_A * num_cols_B * self.madd_cost
+
+    def par_time(self, num_rows_A, num_cols_A, num_cols_B, num_workers, pooled=False):
+        """ predicted time with num_workers processes, or with a warm pool of them if pooled=True """
+        num_workers = max(1, min(num_workers, num_rows_A))
+        compute = self.seq_time(num_rows_A, num_cols_A, num_cols_B) / num_workers
+        copying = (num_rows_A * num_cols_A + num_cols_A * num_cols_B + num_rows_A * num_cols_B) * self.copy_cost
+        overhead = num_workers * (self.dispatch_cost if pooled else self.startup_cost)
+        return compute + copying + overhead
+
+    def should_parallelize(self, num_rows_A, num_cols_A, num_cols_B, num_workers, pooled=False):
+        if num_workers < 2:
+            return False
+        return (self.par_time(num_rows_A, num_cols_A, num_cols_B, num_workers, pooled)
+                < self.seq_time(num_rows_A, num_cols_A, num_cols_B))
+
+    def to_dict(self):
+        return {'madd_cost': self.madd_cost, 'copy_cost': self.copy_cost,
+                'startup_cost': self.startup_cost, 'dispatch_cost': self.dispatch_cost}
+
+    def best_workers(self, num_rows_A, num_cols_A, num_cols_B, max_workers, pooled=False):
+        """ the number of workers, up to max_workers, with the lowest predicted time; 1 means sequential """
+        best, best_time = 1, self.seq_time(num_rows_A, num_cols_A, num_cols_B)
+        for num_workers in range(2, min(max_workers, num_rows_A) + 1):
+            par_time = self.par_time(num_rows_A, num_cols_A, num_cols_B, num_workers, pooled)
+            if par_time < best_time:
+                best, best_time = num_workers, par_time
+        return best
+
+    @staticmethod
+    def measure_madd_cost(size=64, repeats=5):
+        """ seconds per multiply-add of the tiled pure-Python kernel """
+        from base_modules.matrix_kernels import matmul_rows
+
+        A = array('d', (random.random() for i in range(size * size)))
+        C = array('d', bytes(8 * size * size))
+        return min(_time_once(matmul_rows, A, A, C, size, size, 0, size) for i in range(repeats)) / size ** 3
+
+    @classmethod
+    def calibrate(cls, size=64, repeats=5):
+        """ measures the unit costs on this machine; process overheads come from the MachineProfile """
+        from base_modules.shared_arrays import SharedArray
+
+        values = [random.random() for i in range(100_000)]
+        copy_cost = min(_time_once(lambda: SharedArray('d', values).close()) for i in range(repeats)) / len(values)
+        machine = MachineProfile.load()
+        return cls(machine.element_cost('madd'), copy_cost, machine.startup_cost, machine.dispatch_cost)
+
+    @classmethod
+    def load(cls):
+        """ the calibrated model of this machine; calibrates and stores it on first use """
+        values = load_profile().get(cls.SECTION)
+        if values is None:
+            values = cls.calibrate().to_dict()
+            save_profile(cls.SECTION, values)
+        return cls(**values)
+
+
+def _time_once(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    machine = MachineProfile.calibrate()
+    for kernel in ELEMENT_KERNELS:
+        machine.element_costs[kernel] = ELEMENT_KERNELS[kernel]()
+    save_profile(MachineProfile.SECTION, machine.to_dict())
+    model = MatmulCostModel.calibrate()
+    save_profile(MatmulCostModel.SECTION, model.to_dict())
+    print('Saved machine profile to', profile_path())
+    print(f"{'dispatch_cost':>14}: {machine.dispatch_cost * 1e6:12.3f} us per task")
+    print(f"{'startup_cost':>14}: {machine.startup_cost * 1e6:12.3f} us per process")
+    print(f"{'ipc':>14}: {1 / machine.ipc_cost / 2 ** 20 if machine.ipc_cost else float('inf'):12.1f} MB/s")
+    print(f"{'shared memory':>14}: {1 / machine.shm_cost / 2 ** 20:12.1f} MB/s")
+    for kernel, cost in machine.element_costs.items():
+        print(f'{kernel:>14}: {cost * 1e9:12.3f} ns per element')
+    for kernel, size in (('sum', 10 ** 8), ('sort', 10 ** 6), ('sum', 10 ** 5)):
+        plan = machine.plan(size, kernel)
+        print(f'{kernel} of {size:,}: ' + (f'{plan.workers} workers, {plan.num_chunks} chunks of {plan.chunk_size:,}'
+                                          if plan.parallel else 'sequential'))
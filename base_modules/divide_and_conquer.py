@@ -24,55 +24,271 @@ the potential benefits.
 
 Summing together numbers is a cpu intensive operation. So, to get around Python's global interpreter lock, I'll need 
 to implement this using multiple processes. 
+
+The framework
+-------------
+sq_recursive_sum and pc_recursive_sum used to be hand-written recursions with a fixed base case of 100,000
+elements. DivideAndConquer captures the pattern once. A problem plugs in three functions:
+    split(problem)         - returns two or more smaller subproblems
+    solve(problem)         - solves a base case directly; it runs in the worker processes, so it must be picklable
+    combine(left, right)   - combines two neighbouring solutions; it runs in the parent as solutions arrive
+plus size(problem), which measures how big a problem is (span, the length of a (..., start, end) range, by default).
+
+par() takes care of the rest:
+    1. granularity - the problem is split until the pieces hold about size / (workers * OVERSUBSCRIPTION)
+                     elements, so every worker gets several tasks and a slow task does not hold up the others
+    2. fallback    - the first base case is solved in the parent while it is timed. If the predicted parallel
+                     saving does not cover the cost of starting and feeding the pool, the rest is solved right
+                     there as well
+    3. combining   - solutions are combined up the split tree as soon as both children are ready, so combining
+                     overlaps with solving
+    4. cancellation - setting the cancel event, or a failing task, cancels every task that has not started yet
+
+Arrays are passed to the workers as SharedArray ranges (shared, start, end), so a task only pickles a name and two
+indexes. tree_reduce combines a list of solutions as a balanced tree of pairs.
 """
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import heapq
+import math
+import operator
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, wait
+from functools import partial
+
+from base_modules.calibration import OVERSUBSCRIPTION, MachineProfile
+from base_modules.merge_sort import buffered_merge_sort
+from base_modules.parallelism import effective_cpu_count
+from base_modules.shared_arrays import SharedArray
+
+
+def span(problem):
+    """ size of a problem whose last two entries are a start and end index """
+    return problem[-1] - problem[-2]
+
+
+def split_halves(problem):
+    """ splits the (..., start, end) range of a problem in the middle """
+    *head, low, high = problem
+    mid = (low + high) // 2
+    return [(*head, low, mid), (*head, mid, high)]
+
+
+def tree_reduce(combine, values):
+    """ combines neighbouring values pairwise, level by level, until one is left """
+    values = list(values)
+    if not values:
+        raise ValueError('tree_reduce of an empty sequence')
+    while len(values) > 1:
+        values = [combine(values[i], values[i + 1]) if i + 1 < len(values) else values[i]
+                  for i in range(0, len(values), 2)]
+    return values[0]
+
+
+class _Node:
+    """ an inner node of the split tree, waiting for the solutions of its children """
+
+    def __init__(self, parent, index, num_children):
+        self.parent = parent
+        self.index = index
+        self.solutions = [None] * num_children
+        self.pending = num_children
+
+
+class DivideAndConquer:
+    """ a divide and conquer algorithm made of split, solve and combine functions
+
+        range_sum = DivideAndConquer(split_halves, sum_range, operator.add)
+        total = range_sum.par((1, 1_000_000_000)) """
+
+    def __init__(self, split, solve, combine, size=span, min_leaf_size=1):
+        self.split = split
+        self.solve = solve
+        self.combine = combine
+        self.size = size
+        self.min_leaf_size = min_leaf_size
+
+    def seq(self, problem, leaf_size=None):
+        """ sequential recursion; solves problems of up to leaf_size directly (the whole problem by default) """
+        if leaf_size is None or self.size(problem) <= leaf_size:
+            return self.solve(problem)
+        return tree_reduce(self.combine, [self.seq(sub, leaf_size) for sub in self.split(problem)])
+
+    def leaf_size(self, problem, num_workers):
+        """ base case size giving every worker about OVERSUBSCRIPTION tasks """
+        return max(self.min_leaf_size, math.ceil(self.size(problem) / (num_workers * OVERSUBSCRIPTION)))
+
+    def _plan(self, problem, leaf_size, parent, index, leaves):
+        """ splits problem down to leaf_size, appending (parent node, child index, base case) to leaves """
+        subproblems = self.split(problem) if self.size(problem) > leaf_size else []
+        if len(subproblems) < 2:
+            leaves.append((parent, index, problem))
+            return
+        node = _Node(parent, index, len(subproblems))
+        for i, sub in enumerate(subproblems):
+            self._plan(sub, leaf_size, node, i, leaves)
+
+    def _deliver(self, node, index, solution):
+        """ records a solution and combines up the tree as far as possible; returns the root solution if reached """
+        while node is not None:
+            node.solutions[index] = solution
+            node.pending -= 1
+            if node.pending:
+                return None
+            solution = tree_reduce(self.combine, node.solutions)
+            node, index = node.parent, node.index
+        return solution
+
+    def par(self, problem, pool=None, workers=None, leaf_size=None, cancel=None):
+        """ solves problem on a process pool; pass pool to reuse a running ProcessPoolExecutor
+            cancel is an optional threading.Event; setting it cancels the remaining tasks and raises
+            CancelledError """
+        num_workers = workers or effective_cpu_count()
+        leaf_size = leaf_size or self.leaf_size(problem, num_workers)
+        leaves = []
+        self._plan(problem, leaf_size, None, 0, leaves)
+        if num_workers < 2 or len(leaves) < 2:
+            return self.seq(problem, leaf_size)
+
+        # solve the first base case here and use its time to decide whether the pool is worth it
+        start = time.perf_counter()
+        first_solution = self.solve(leaves[0][2])
+        probe_time = time.perf_counter() - start
+        profile = MachineProfile.load()
+        saving = probe_time * (len(leaves) - 1) * (1 - 1 / num_workers)
+        overhead = profile.dispatch_cost * len(leaves) + (profile.startup_cost * num_workers if pool is None else 0)
+        if saving <= overhead:
+            result = self._deliver(leaves[0][0], leaves[0][1], first_solution)
+            for parent, index, sub in leaves[1:]:
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                result = self._deliver(parent, index, self.solve(sub))
+            return result
+
+        own_pool = pool is None
+        if own_pool:
+            pool = ProcessPoolExecutor(max_workers=num_workers)
+        futures = {}
+        try:
+            for parent, index, sub in leaves[1:]:
+                futures[pool.submit(self.solve, sub)] = (parent, index)
+            result = self._deliver(leaves[0][0], leaves[0][1], first_solution)
+            pending = set(futures)
+            while pending:
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                # with a cancel event, wake up regularly to check it
+                done, pending = wait(pending, timeout=None if cancel is None else 0.05,
+                                     return_when=FIRST_COMPLETED)
+                for f in done:
+                    # a failing task raises here, and the finally clause cancels the rest
+                    result = self._deliver(*futures[f], f.result())
+            return result
+        finally:
+            for f in futures:
+                f.cancel()
+            if own_pool:
+                pool.shutdown()
+
+
+# sum of a range of numbers
+def sum_range(problem):
+    low, high = problem
+    return sum(range(low, high))
+
+
+RANGE_SUM = DivideAndConquer(split_halves, sum_range, operator.add)
 
 
 def sq_recursive_sum(low, high):
-    # base case threshold
-    if high - low <= 100_000:
-        return sum(range(low, high))
-    else:
-        # middle index for splitting
-        mid = (low + high) // 2
-        left_half = sq_recursive_sum(low, mid)
-        right_half = sq_recursive_sum(mid, high)
-        return left_half + right_half
+    # base case threshold of 100,000 elements, as before
+    return RANGE_SUM.seq((low, high), leaf_size=100_000)
 
 
 def pc_recursive_sum(low, high, pool=None):
-    # if the pool argument is None, this indicates intial call to the function
-    # if pool is none the condition evaluates to true and we create ProcessPool Executor
-    # not None == Not False == True
-    if not pool:
-        with ProcessPoolExecutor() as executor:
-            futures = pc_recursive_sum(low, high, pool=executor)
-            # Retrive the individual results and sum them
-            # summing over all sub-divided results in the
-            # as_completed() returns a iterator that yields futures from
-            # the list of futures as the complete
-            return sum(f.result() for f in as_completed(futures))
-    else:
-        # base case threshold
-        if high - low <= 100_000:
-            # submitting the sum(range(low, high) to the process pool
-            # this returns a future object. We use list comprehension to return a list
-            # containing future object
-            return [pool.submit(sum, range(low, high))]
-        else:
-            # middle index for splitting
-            mid = (low + high) // 2
-            left_half = pc_recursive_sum(low, mid, pool=pool)
-            right_half = pc_recursive_sum(mid, high, pool=pool)
-            # the base case returns a list and list can be concatenated
-            # hence this returns a list containing all of the subdivided tasks
-            return left_half + right_half
+    # the framework picks the base case size from the number of workers
+    return RANGE_SUM.par((low, high), pool=pool)
+
+
+# problems over a SharedArray range (shared, start, end)
+def sum_array(problem):
+    shared, start, end = problem
+    return sum(shared.view[start:end])
+
+
+def min_max_array(problem):
+    shared, start, end = problem
+    chunk = shared.view[start:end]
+    return min(chunk), max(chunk)
+
+
+def combine_min_max(left, right):
+    return min(left[0], right[0]), max(left[1], right[1])
+
+
+def histogram_array(problem, low, width, num_bins):
+    """ counts of problem's elements in num_bins bins of the given width starting at low """
+    shared, start, end = problem
+    counts = [0] * num_bins
+    for value in shared.view[start:end]:
+        counts[min(num_bins - 1, max(0, int((value - low) // width)))] += 1
+    return counts
+
+
+def combine_counts(left, right):
+    return [a + b for a, b in zip(left, right)]
+
+
+def sort_array(problem):
+    shared, start, end = problem
+    return buffered_merge_sort(shared.view[start:end].tolist())
+
+
+def merge_sorted(left, right):
+    return list(heapq.merge(left, right))
+
+
+ARRAY_SUM = DivideAndConquer(split_halves, sum_array, operator.add)
+ARRAY_MIN_MAX = DivideAndConquer(split_halves, min_max_array, combine_min_max)
+ARRAY_MERGE_SORT = DivideAndConquer(split_halves, sort_array, merge_sorted)
+
+
+def array_histogram(low, high, num_bins):
+    """ histogram of num_bins equal bins over [low, high) """
+    return DivideAndConquer(split_halves, partial(histogram_array, low=low, width=(high - low) / num_bins,
+                                                  num_bins=num_bins), combine_counts)
 
 
 if __name__ == '__main__':
-    total = pc_recursive_sum(1, 1_000_000_000)
-    print('Total sum via pc_recursive_sum is', total)
+    NUM_EVAL_RUNS = 1
+    SUM_HIGH = 100_000_000
+    ARRAY_SIZE = 2_000_000
+    NUM_WORKERS = effective_cpu_count()
+
+    values = [random.randint(0, 10_000) for i in range(ARRAY_SIZE)]
+    shared = SharedArray('q', values)
+    problems = [('range sum', RANGE_SUM, (1, SUM_HIGH)),
+                ('array sum', ARRAY_SUM, (shared, 0, ARRAY_SIZE)),
+                ('min/max', ARRAY_MIN_MAX, (shared, 0, ARRAY_SIZE)),
+                ('histogram', array_histogram(0, 10_001, 16), (shared, 0, ARRAY_SIZE)),
+                ('merge sort', ARRAY_MERGE_SORT, (shared, 0, ARRAY_SIZE))]
 
-    total = sq_recursive_sum(1, 1_000_000_000)
-    print('Total sum via sq_recursive_sum is', total)
+    print('{:>11} {:>14} {:>14} {:>9} {:>11}'.format('problem', 'sequential', 'parallel', 'speedup', 'efficiency'))
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for name, algorithm, problem in problems:
+            sequential_time = parallel_time = 0
+            for i in range(NUM_EVAL_RUNS):
+                start = time.perf_counter()
+                sequential_result = algorithm.seq(problem)
+                sequential_time += time.perf_counter() - start
+                start = time.perf_counter()
+                parallel_result = algorithm.par(problem, pool=pool)
+                parallel_time += time.perf_counter() - start
+            sequential_time /= NUM_EVAL_RUNS
+            parallel_time /= NUM_EVAL_RUNS
+            if sequential_result != parallel_result:
+                raise Exception(f'{name}: sequential_result and parallel_result do not match.')
+            speedup = sequential_time / parallel_time
+            print('{:>11} {:>11.2f} ms {:>11.2f} ms {:>9.2f} {:>10.2f}%'.format(
+                name, sequential_time * 1000, parallel_time * 1000, speedup, 100 * speedup / NUM_WORKERS))
+    shared.close()
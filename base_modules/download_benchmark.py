@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+""" Benchmark matrix for the image download engines """
+
+"""
+Download benchmark matrix
+
+Downloading images is an I/O-bound workload: most of the elapsed time is spent waiting on the network rather than
+executing Python code, which is why threads help even with the global interpreter lock. How much they help depends
+on the link. With a loopback server and no latency, the threads mostly fight over the GIL. With 150 ms of latency per
+request, fifty threads can hide almost all of the waiting.
+
+This module runs every engine registered in download_images.DOWNLOAD_ENGINES against the local image_server for
+each combination of worker count and latency profile, and reports:
+    1. throughput   - images per second and megabytes per second
+    2. tail latency - p50, p95 and p99 of the individual request latencies
+    3. CPU use      - CPU seconds spent by the downloader process divided by the wall-clock time
+
+The image server runs in a separate process so only the CPU used by the downloader is counted.
+"""
+
+import math
+import time
+
+from base_modules.download_images import DOWNLOAD_ENGINES
+from base_modules.image_server import ImageServer, LATENCY_PROFILES
+
+# engines that ignore max_workers only need to run once per latency profile
+SEQUENTIAL_ENGINES = ('sequential',)
+
+
+def _percentile(sorted_values, pct):
+    """ nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_engine(engine, image_numbers, base_url, max_workers, num_eval_runs=1):
+    """ times one engine configuration and returns its metrics as a dict """
+    # "warm up"
+    engine(image_numbers, base_url=base_url, max_workers=max_workers)
+
+    latencies = []
+    total_bytes = 0
+    wall_time = 0
+    cpu_time = 0
+    for i in range(num_eval_runs):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        total_bytes += engine(image_numbers, base_url=base_url, max_workers=max_workers, latencies=latencies)
+        cpu_time += time.process_time() - cpu_start
+        wall_time += time.perf_counter() - wall_start
+
+    latencies.sort()
+    num_images = len(image_numbers) * num_eval_runs
+    return {
+        'images_per_sec': num_images / wall_time,
+        'mb_per_sec': total_bytes / wall_time / 1e6,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'cpu_pct': 100 * cpu_time / wall_time,
+        'wall_sec': wall_time / num_eval_runs,
+    }
+
+
+def run_matrix(engines=None, worker_counts=(1, 4, 16, 64), latency_profiles=('loopback', 'lan', 'broadband'),
+               image_numbers=range(1, 50), image_size=(20_000, 60_000), bandwidth=None, error_rate=0.0,
+               num_eval_runs=1):
+    """ runs every engine x worker count x latency profile combination
+        returns a list of result dicts, one per configuration """
+    engines = engines or DOWNLOAD_ENGINES
+    image_numbers = list(image_numbers)
+    results = []
+    for profile in latency_profiles:
+        with ImageServer(image_size=image_size, latency=LATENCY_PROFILES[profile], bandwidth=bandwidth,
+                         error_rate=error_rate) as server:
+            for name, engine in engines.items():
+                for workers in worker_counts:
+                    if name in SEQUENTIAL_ENGINES and workers != worker_counts[0]:
+                        continue
+                    metrics = run_engine(engine, image_numbers, server.base_url, workers, num_eval_runs)
+                    metrics.update(engine=name, workers=1 if name in SEQUENTIAL_ENGINES else workers,
+                                   profile=profile)
+                    results.append(metrics)
+                    print_result(metrics)
+            server_stats = server.stats
+        print(f"  server: {server_stats['requests']} served, {server_stats['errors']} errors")
+    return results
+
+
+def print_result(metrics):
+    print('{profile:>10} {engine:>12} workers={workers:<3} '
+          '{images_per_sec:8.1f} img/s {mb_per_sec:7.2f} MB/s  '
+          'p50={p50_ms:7.2f} p95={p95_ms:7.2f} p99={p99_ms:7.2f} ms  cpu={cpu_pct:5.1f}%'.format(**metrics))
+
+
+if __name__ == '__main__':
+    run_matrix()
@@ -2,25 +2,34 @@
 """ Challenge: Download a collection of images """
 
 import time
+import urllib.error
 import urllib.request
-import multiprocessing as mp
 import concurrent.futures
 
+from base_modules.parallelism import thread_pool_workers
 
-def seq_download_images(image_numbers):
+
+# public host the images are served from; point base_url at image_server.ImageServer to run offline
+IMAGE_BASE_URL = "http://699340.youcanlearnit.net"
+
+
+def seq_download_images(image_numbers, base_url=IMAGE_BASE_URL, max_workers=None, latencies=None):
     """ sequential implementation of multiple image downloader
-        returns total bytes from downloading all images in image_numbers list """
+        returns total bytes from downloading all images in image_numbers list
+        max_workers is accepted so every engine shares one signature, and ignored """
     total_bytes = 0
     for num in image_numbers:
-        total_bytes += _download_image(num)
+        total_bytes += _download_image(num, base_url, latencies)
     return total_bytes
 
 
-def _download_image(image_number):
-    """ helper function returns number of bytes from downloading image """
+def _download_image(image_number, base_url=IMAGE_BASE_URL, latencies=None):
+    """ helper function returns number of bytes from downloading image
+        appends the request latency in seconds to the latencies list when one is given """
     # force between 1 and 50
     image_number = (abs(image_number) % 50) + 1
-    image_url = f"http://699340.youcanlearnit.net/image{image_number:03d}.jpg"
+    image_url = f"{base_url}/image{image_number:03d}.jpg"
+    start = time.perf_counter()
     try:
         with urllib.request.urlopen(image_url, timeout=60) as conn:
             # number of bytes in downloaded image
@@ -29,44 +38,35 @@ def _download_image(image_number):
         print('HTTPError: Could not retrieve image ', image_number)
     except Exception as e:
         print(e)
+    finally:
+        # list.append is atomic, so worker threads can share one list
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+    # failed downloads contribute no bytes
+    return 0
 
 
-def par_download_images(image_numbers):
+def par_download_images(image_numbers, base_url=IMAGE_BASE_URL, max_workers=None, latencies=None):
     """ parallel implementation of multiple image downloader
         returns total bytes from downloading all images in image_numbers list """
     total_bytes = 0
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        futures = [pool.submit(_download_image, num) for num in image_numbers]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or thread_pool_workers()) as pool:
+        futures = [pool.submit(_download_image, num, base_url, latencies) for num in image_numbers]
         for f in concurrent.futures.as_completed(futures):
             total_bytes += f.result()
     return total_bytes
 
 
-if __name__ == '__main__':
-    NUM_EVAL_RUNS = 1
-    IMAGE_NUMBERS = list(range(1, 50))
+# download engines benchmarked by download_benchmark.py, all sharing the
+# (image_numbers, base_url, max_workers, latencies) signature
+DOWNLOAD_ENGINES = {
+    'sequential': seq_download_images,
+    'threaded': par_download_images,
+}
 
-    print('Evaluating Sequential Implementation...')
-    sequential_result = seq_download_images(IMAGE_NUMBERS)
-    sequential_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        seq_download_images(IMAGE_NUMBERS)
-        sequential_time += time.perf_counter() - start
-    sequential_time /= NUM_EVAL_RUNS
 
-    print('Evaluating Parallel Implementation...')
-    parallel_result = par_download_images(IMAGE_NUMBERS)
-    parallel_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        par_download_images(IMAGE_NUMBERS)
-        parallel_time += time.perf_counter() - start
-    parallel_time /= NUM_EVAL_RUNS
+if __name__ == '__main__':
+    # timed, checked and compared with this machine's baseline by the benchmark suite
+    from base_modules.benchmark_suite import run_suite
 
-    if sequential_result != parallel_result:
-        raise Exception('sequential_result and parallel_result do not match.')
-    print('Average Sequential Time: {:.2f} ms'.format(sequential_time * 1000))
-    print('Average Parallel Time: {:.2f} ms'.format(parallel_time * 1000))
-    print('Speedup: {:.2f}'.format(sequential_time / parallel_time))
-    print('Efficiency: {:.2f}%'.format(100 * (sequential_time / parallel_time) / mp.cpu_count()))
+    run_suite(['download_images'])
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+""" External parallel merge sort for files larger than memory """
+
+"""
+External merge sort
+
+seq_merge_sort needs the whole array in memory, and par_merge_sort needs it twice, once in the input and once in
+shared memory. An external sort only ever holds a bounded part of the data:
+
+    1. run building - the input file (raw binary numbers, or one numeric column of a CSV file) is streamed in
+                      chunks. Each chunk is sent to a worker process, which sorts it and writes it to a temporary
+                      run file. The parent reads the next chunk while the workers sort, and waits whenever every
+                      worker is busy, so only num_workers + 1 chunks are in memory at a time.
+    2. merging      - the sorted runs are memory-mapped and merged k ways with heapq.merge. Each run is read
+                      through a small window of block elements, so memory use depends on the number of runs and
+                      the block size, not on the size of the data. If there are more runs than MAX_FAN_IN, groups of
+                      runs are first merged into longer runs, in parallel on the workers, until few enough are left.
+
+The chunk size and the merge block size are both derived from memory_budget. Run files are written in the binary
+format of the chosen typecode and removed when the sort finishes.
+"""
+
+import csv
+import heapq
+import mmap
+import os
+import random
+import tempfile
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from base_modules.merge_sort import TYPECODES, _InlineExecutor, buffered_merge_sort
+from base_modules.parallelism import effective_cpu_count
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; runs are sorted with buffered_merge_sort without it
+    np = None
+
+MEMORY_BUDGET = 64 * 2 ** 20
+# runs merged at once; more than this are merged in several passes
+MAX_FAN_IN = 64
+# copies of a chunk alive while it is read, pickled to a worker and sorted there
+CHUNK_COPIES = 3
+# bytes of a number once it is unboxed into a Python object inside a list
+BOXED_SIZE = 32
+MIN_BLOCK = 1024
+
+
+def _sort_chunk(data, typecode, path):
+    """ pool worker: sorts the raw bytes of one chunk and writes them to a run file """
+    if np is not None:
+        values = np.frombuffer(data, dtype=typecode).copy()
+        values.sort()
+    else:
+        values = array(typecode)
+        values.frombytes(data)
+        buffered_merge_sort(values)
+    with open(path, 'wb') as f:
+        values.tofile(f)
+    return path
+
+
+def _read_run(path, typecode, block):
+    """ yields the values of a run file, unboxing only block elements at a time """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm).cast(typecode)
+        try:
+            for start in range(0, len(view), block):
+                yield from view[start:start + block].tolist()
+        finally:
+            view.release()
+
+
+def _write_values(values, f, typecode, block, output_format='binary'):
+    """ writes an iterable of values in blocks; returns how many were written """
+    count = 0
+    values = iter(values)
+    while True:
+        chunk = array(typecode, islice(values, block))
+        if not chunk:
+            return count
+        if output_format == 'csv':
+            f.write(''.join(f'{value}\n' for value in chunk).encode())
+        else:
+            chunk.tofile(f)
+        count += len(chunk)
+
+
+def _merge_runs(paths, out_path, typecode, block):
+    """ pool worker: k-way merges run files into one longer run file and removes them """
+    with open(out_path, 'wb') as f:
+        _write_values(heapq.merge(*[_read_run(path, typecode, block) for path in paths]), f, typecode, block)
+    for path in paths:
+        os.remove(path)
+    return out_path
+
+
+def _binary_chunks(path, typecode, chunk_size):
+    """ yields the raw bytes of a binary file, chunk_size numbers at a time """
+    itemsize = array(typecode).itemsize
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size * itemsize)
+            if not data:
+                return
+            if len(data) % itemsize:
+                raise ValueError(f'{path} does not hold a whole number of {itemsize} byte values')
+            yield data
+
+
+def _csv_chunks(path, typecode, chunk_size, column=0, header=True):
+    """ yields one numeric column of a CSV file as raw bytes, chunk_size numbers at a time
+        column is an index, or a name from the header row """
+    parse = float if typecode in 'fd' else int
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        if header:
+            names = next(reader, [])
+            if not isinstance(column, int):
+                column = names.index(column)
+        values = (parse(row[column]) for row in reader if row)
+        while True:
+            chunk = array(typecode, islice(values, chunk_size))
+            if not chunk:
+                return
+            yield chunk.tobytes()
+
+
+def _external_sort(pool, num_workers, input_path, output_path, typecode, input_format, output_format,
+                   memory_budget, column, header, tmp_dir):
+    if typecode not in TYPECODES:
+        raise ValueError(f'typecode must be one of {TYPECODES!r}, not {typecode!r}')
+    if input_format is None:
+        input_format = 'csv' if input_path.endswith('.csv') else 'binary'
+    itemsize = array(typecode).itemsize
+    chunk_size = max(MIN_BLOCK, memory_budget // (CHUNK_COPIES * itemsize * (num_workers + 1)))
+    if input_format == 'csv':
+        chunks = _csv_chunks(input_path, typecode, chunk_size, column, header)
+    else:
+        chunks = _binary_chunks(input_path, typecode, chunk_size)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        # 1. run building: at most num_workers chunks are being sorted while the next one is read
+        runs = []
+        in_flight = set()
+        for number, data in enumerate(chunks):
+            in_flight.add(pool.submit(_sort_chunk, data, typecode, os.path.join(run_dir, f'run-{number}')))
+            if len(in_flight) >= num_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                runs += [f.result() for f in done]
+        runs += [f.result() for f in in_flight]
+        runs.sort(key=lambda path: int(path.rsplit('-', 1)[1]))
+
+        # 2. merge passes until at most MAX_FAN_IN runs are left, each pass merging groups in parallel
+        merge_pass = 0
+        while len(runs) > MAX_FAN_IN:
+            block = max(MIN_BLOCK, memory_budget // (BOXED_SIZE * num_workers * (MAX_FAN_IN + 1)))
+            groups = [runs[g:g + MAX_FAN_IN] for g in range(0, len(runs), MAX_FAN_IN)]
+            futures = [pool.submit(_merge_runs, group, os.path.join(run_dir, f'pass-{merge_pass}-{g}'),
+                                   typecode, block) for g, group in enumerate(groups)]
+            runs = [f.result() for f in futures]
+            merge_pass += 1
+
+        # final k-way merge straight into the output file
+        block = max(MIN_BLOCK, memory_budget // (BOXED_SIZE * (len(runs) + 1)))
+        with open(output_path, 'wb') as f:
+            return _write_values(heapq.merge(*[_read_run(path, typecode, block) for path in runs]),
+                                 f, typecode, block, output_format)
+
+
+def seq_external_sort(input_path, output_path, typecode='q', input_format=None, output_format='binary',
+                      memory_budget=MEMORY_BUDGET, column=0, header=True, tmp_dir=None):
+    """ sorts the numbers of input_path into output_path in this process; returns how many were sorted
+        input_format is 'binary' (raw numbers of the typecode) or 'csv', inferred from the file name by default;
+        for CSV input, column is the index or header name of the numeric column """
+    return _external_sort(_InlineExecutor(), 1, input_path, output_path, typecode, input_format, output_format,
+                          memory_budget, column, header, tmp_dir)
+
+
+def par_external_sort(input_path, output_path, typecode='q', input_format=None, output_format='binary',
+                      memory_budget=MEMORY_BUDGET, column=0, header=True, tmp_dir=None, workers=None):
+    """ sorts the numbers of input_path into output_path, building and merging runs on a process pool
+        takes the same arguments as seq_external_sort; returns how many numbers were sorted """
+    num_workers = workers or effective_cpu_count()
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return _external_sort(pool, num_workers, input_path, output_path, typecode, input_format, output_format,
+                              memory_budget, column, header, tmp_dir)
+
+
+if __name__ == '__main__':
+    NUM_EVAL_RUNS = 1
+    SIZE = 10_000_000 if np is not None else 1_000_000
+    # small enough that the data does not fit in one run
+    BUDGET = 8 * 2 ** 20
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, 'input.bin')
+        print(f'Generating {SIZE:,} random 64-bit integers ({SIZE * 8 / 2 ** 20:.0f} MB)...')
+        with open(input_path, 'wb') as f:
+            for start in range(0, SIZE, 1_000_000):
+                array('q', (random.randint(-2 ** 62, 2 ** 62) for i in range(min(1_000_000, SIZE - start)))).tofile(f)
+
+        times = {}
+        for name, func in (('Sequential', seq_external_sort), ('Parallel', par_external_sort)):
+            print(f'Evaluating {name} Implementation with a {BUDGET / 2 ** 20:.0f} MB budget...')
+            output_path = os.path.join(directory, f'{name}.bin')
+            times[name] = 0
+            for i in range(NUM_EVAL_RUNS):
+                start = time.perf_counter()
+                func(input_path, output_path, memory_budget=BUDGET)
+                times[name] += time.perf_counter() - start
+            times[name] /= NUM_EVAL_RUNS
+
+        with open(os.path.join(directory, 'Sequential.bin'), 'rb') as f:
+            sequential_result = f.read()
+        with open(os.path.join(directory, 'Parallel.bin'), 'rb') as f:
+            parallel_result = f.read()
+        values = array('q', parallel_result)
+        if sequential_result != parallel_result or len(values) != SIZE or \
+                any(values[i] > values[i + 1] for i in range(len(values) - 1)):
+            raise Exception('sequential_result and parallel_result do not match.')
+        print('Average Sequential Time: {:.2f} ms'.format(times['Sequential'] * 1000))
+        print('Average Parallel Time: {:.2f} ms'.format(times['Parallel'] * 1000))
+        print('Speedup: {:.2f}'.format(times['Sequential'] / times['Parallel']))
+        print('Efficiency: {:.2f}%'.format(100 * (times['Sequential'] / times['Parallel']) / effective_cpu_count()))
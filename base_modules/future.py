@@ -23,6 +23,8 @@ has not completed execution yet, then invoking the result method will block and
 from concurrent.futures import ThreadPoolExecutor
 import time
 
+from base_modules.parallelism import thread_pool_workers
+
 
 def how_many_vegetables():
     print('Olivia is counting vegetables...')
@@ -32,7 +34,7 @@ def how_many_vegetables():
 
 if __name__ == '__main__':
     print('Barron asks Olivia how many vegetables are in the pantry.')
-    with ThreadPoolExecutor() as pool:
+    with ThreadPoolExecutor(max_workers=thread_pool_workers()) as pool:
         future = pool.submit(how_many_vegetables)
         print('Barron can do others things while he waits for the result...')
         print('Olivia responded with', future.result())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+""" Local stand-in for the public image host used by download_images.py """
+
+"""
+Image server fixture
+
+Benchmarking the image downloader against a live public host measures the internet as much as it measures our code.
+Latency, bandwidth and failures change from minute to minute, and the offline build boxes cannot reach the host at
+all. This module starts a small HTTP server on the loopback interface that serves synthetic JPEG-looking images at
+the same paths as the public host (/image001.jpg ... /image050.jpg).
+
+Every property that matters for an I/O-bound benchmark is configurable:
+    1. image_size  - bytes per image, either a fixed int or a (min, max) range
+    2. latency     - seconds to wait before answering, plus an optional uniform jitter
+    3. bandwidth   - bytes per second cap applied to every connection (None means unlimited)
+    4. error_rate  - probability that a request is answered with 503 Service Unavailable
+
+The server runs in its own process, so the CPU it burns serving requests does not show up in the CPU use measured
+for the downloader under test. Image contents and sizes are derived from the image number, so every run serves
+exactly the same bytes and the sequential and parallel results can still be compared for equality.
+"""
+
+import http.server
+import multiprocessing as mp
+import random
+import time
+
+IMAGE_COUNT = 50
+JPEG_START = b'\xff\xd8\xff\xe0'
+JPEG_END = b'\xff\xd9'
+CHUNK_SIZE = 16 * 1024
+
+# (latency, jitter) in seconds for a few typical links
+LATENCY_PROFILES = {
+    'loopback': (0.0, 0.0),
+    'lan': (0.002, 0.001),
+    'broadband': (0.030, 0.010),
+    'mobile': (0.150, 0.050),
+}
+
+
+def synthetic_image(image_number, image_size):
+    """ returns deterministic bytes that look like a JPEG for the given image number """
+    rand = random.Random(image_number)
+    if isinstance(image_size, int):
+        size = image_size
+    else:
+        size = rand.randint(*image_size)
+    body_size = max(0, size - len(JPEG_START) - len(JPEG_END))
+    body = rand.getrandbits(8 * body_size).to_bytes(body_size, 'little') if body_size else b''
+    return JPEG_START + body + JPEG_END
+
+
+class _ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    # populated by _serve() in the server process
+    images = {}
+    latency = (0.0, 0.0)
+    bandwidth = None
+    error_rate = 0.0
+    stats = None
+
+    def do_GET(self):
+        base_latency, jitter = self.latency
+        time.sleep(base_latency + random.uniform(0, jitter))
+        image = self.images.get(self.path)
+        if image is None:
+            self._count('errors')
+            self.send_error(404)
+            return
+        if random.random() < self.error_rate:
+            self._count('errors')
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(image)))
+        self.end_headers()
+        for start in range(0, len(image), CHUNK_SIZE):
+            chunk = image[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            # throttle the connection so that it never exceeds the bandwidth cap
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+        self._count('requests', len(image))
+
+    def _count(self, counter, num_bytes=0):
+        with self.stats.get_lock():
+            self.stats[0 if counter == 'requests' else 1] += 1
+            self.stats[2] += num_bytes
+
+    def log_message(self, format, *args):
+        # keep benchmark output readable
+        pass
+
+
+def _serve(conn, stats, image_size, latency, bandwidth, error_rate, image_count, seed):
+    """ entry point of the server process """
+    random.seed(seed)
+    _ImageRequestHandler.images = {f'/image{num:03d}.jpg': synthetic_image(num, image_size)
+                                   for num in range(1, image_count + 1)}
+    _ImageRequestHandler.latency = latency
+    _ImageRequestHandler.bandwidth = bandwidth
+    _ImageRequestHandler.error_rate = error_rate
+    _ImageRequestHandler.stats = stats
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _ImageRequestHandler)
+    server.daemon_threads = True
+    # the port is chosen by the OS, so report it back to the parent
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+class ImageServer:
+    """ serves synthetic images from a background process; use as a context manager
+
+        with ImageServer(image_size=(20_000, 60_000), latency=LATENCY_PROFILES['broadband']) as server:
+            seq_download_images(range(1, 50), base_url=server.base_url)
+    """
+
+    def __init__(self, image_size=50_000, latency=(0.0, 0.0), bandwidth=None, error_rate=0.0,
+                 image_count=IMAGE_COUNT, seed=0):
+        if isinstance(latency, str):
+            latency = LATENCY_PROFILES[latency]
+        elif isinstance(latency, (int, float)):
+            latency = (latency, 0.0)
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError(f"error_rate must be between 0 and 1, got {error_rate}")
+        self.image_size = image_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.image_count = image_count
+        self.seed = seed
+        self.port = None
+        # requests served, errors returned, bytes sent
+        self._stats = mp.Array('q', 3)
+        self._process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def stats(self):
+        with self._stats.get_lock():
+            requests, errors, num_bytes = self._stats[:]
+        return {'requests': requests, 'errors': errors, 'bytes': num_bytes}
+
+    def start(self):
+        parent_conn, child_conn = mp.Pipe(duplex=False)
+        self._process = mp.Process(target=_serve, daemon=True,
+                                   args=(child_conn, self._stats, self.image_size, self.latency,
+                                         self.bandwidth, self.error_rate, self.image_count, self.seed))
+        self._process.start()
+        self.port = parent_conn.recv()
+        parent_conn.close()
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import urllib.request
+
+    with ImageServer(image_size=(20_000, 60_000), latency='lan') as server:
+        print('Serving synthetic images at', server.base_url)
+        with urllib.request.urlopen(f"{server.base_url}/image001.jpg") as conn:
+            print('Downloaded image001.jpg:', len(conn.read()), 'bytes')
+        print('Server stats:', server.stats)
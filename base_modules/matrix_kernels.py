@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+""" Dependency-free, cache-friendly matrix multiplication kernels """
+
+"""
+Tiled i-k-j kernel
+
+The textbook loop order computes one element of C at a time (i-j-k): for every C[i][j] it walks down column j
+of B. Rows are contiguous in memory, so walking down a column touches a different row, and often a different cache
+line, for every k. In pure Python the bigger cost is the interpreter work per step: an index calculation, two
+subscripts, a multiply-add and a store into C, all inside the innermost loop.
+
+Reordering the loops to i-k-j turns the inner loop into "add a[i][k] times row k of B to row i of C". Row k of B is
+read front to back, and the inner loop becomes a list comprehension over zip(), so most of the per-element work
+runs in C instead of in the interpreter. The partial sums are kept in a local list and each finished row of C is
+written to the output once, rather than once per partial product.
+
+Tiling adds two more things:
+    1. row tiles    - a slice of row k of B is fetched once and used for tile_rows rows of A
+    2. column tiles - only tile_cols accumulators are live at a time, so they stay in cache for wide matrices
+
+With transposed_B=True, B is given as its transpose, so column j of B is a contiguous row. Each element of C then
+becomes sum(map(mul, row_of_A, row_of_BT)), which is the fastest dot product the standard library offers.
+
+All kernels work on flat row-major buffers (lists, array.array, memoryviews or ctypes arrays). They add the
+products in the same k order as seq_matrix_multiply, so they return identical results. The one exception is
+transposed_B on Python 3.12 and later, where sum() rounds float sums differently.
+"""
+
+import random
+import time
+from array import array
+from operator import mul
+
+# defaults picked with the benchmark at the bottom of this module
+TILE_ROWS = 8
+TILE_COLS = 512
+
+
+def transpose(B, num_rows_B, num_cols_B):
+    """ returns the transpose of a flat row-major buffer as a flat row-major array('d') """
+    BT = array('d')
+    for j in range(num_cols_B):
+        # column j of B is every num_cols_B-th element starting at j
+        BT.extend(B[j:num_rows_B * num_cols_B:num_cols_B])
+    return BT
+
+
+def matmul_rows(A, B, C, num_cols_A, num_cols_B, row_start, row_end, transposed_B=False,
+                tile_rows=TILE_ROWS, tile_cols=TILE_COLS):
+    """ computes rows row_start..row_end-1 of C = A*B on flat row-major buffers
+        B is the transpose of the right-hand operand when transposed_B=True """
+    for i0 in range(row_start, row_end, tile_rows):
+        i1 = min(i0 + tile_rows, row_end)
+        # finished rows of this tile, written to C once at the end
+        C_rows = [[] for i in range(i0, i1)]
+        A_rows = [A[i * num_cols_A:(i + 1) * num_cols_A] for i in range(i0, i1)]
+        for j0 in range(0, num_cols_B, tile_cols):
+            j1 = min(j0 + tile_cols, num_cols_B)
+            if transposed_B:
+                BT_rows = [B[j * num_cols_A:(j + 1) * num_cols_A] for j in range(j0, j1)]
+                for C_row, A_row in zip(C_rows, A_rows):
+                    C_row.extend([sum(map(mul, A_row, BT_row)) for BT_row in BT_rows])
+            else:
+                # local accumulators for the current row x column tile
+                acc = [[0.0] * (j1 - j0) for i in range(i0, i1)]
+                for k in range(num_cols_A):
+                    B_seg = B[k * num_cols_B + j0:k * num_cols_B + j1]
+                    for r, A_row in enumerate(A_rows):
+                        a = A_row[k]
+                        acc[r] = [c + a * b for c, b in zip(acc[r], B_seg)]
+                for C_row, acc_row in zip(C_rows, acc):
+                    C_row.extend(acc_row)
+        for i, C_row in zip(range(i0, i1), C_rows):
+            C[i * num_cols_B:(i + 1) * num_cols_B] = array('d', C_row)
+
+
+def naive_matmul_rows(A, B, C, num_cols_A, num_cols_B, row_start, row_end):
+    """ the original i-j-k worker loop, kept as the baseline for the benchmark below """
+    for i in range(row_start, row_end):
+        for j in range(num_cols_B):
+            for k in range(num_cols_A):
+                C[i * num_cols_B + j] += A[i * num_cols_A + k] * B[k * num_cols_B + j]
+
+
+def tiled_matrix_multiply(A, B, transposed_B=False, tile_rows=TILE_ROWS, tile_cols=TILE_COLS):
+    """ list-of-lists front end for matmul_rows; returns a list-of-lists """
+    num_rows_A = len(A)
+    num_cols_A = len(A[0])
+    num_rows_B = len(B)
+    num_cols_B = len(B[0])
+    if num_cols_A != num_rows_B:
+        raise ArithmeticError(
+            f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
+    A_1D = [a for row in A for a in row]
+    B_1D = [b for row in B for b in row]
+    if transposed_B:
+        B_1D = transpose(B_1D, num_rows_B, num_cols_B)
+    C_1D = array('d', bytes(8 * num_rows_A * num_cols_B))
+    matmul_rows(A_1D, B_1D, C_1D, num_cols_A, num_cols_B, 0, num_rows_A, transposed_B, tile_rows, tile_cols)
+    return [C_1D[i * num_cols_B:(i + 1) * num_cols_B].tolist() for i in range(num_rows_A)]
+
+
+if __name__ == '__main__':
+    NUM_EVAL_RUNS = 1
+    SIZES = (64, 128, 256, 384)
+
+    def time_it(func, *args, **kwargs):
+        elapsed = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            elapsed += time.perf_counter() - start
+        return elapsed / NUM_EVAL_RUNS
+
+    print('{:>6} {:>14} {:>14} {:>14} {:>9} {:>9}'.format(
+        'size', 'naive worker', 'tiled i-k-j', 'transposed B', 'speedup', 'speedupT'))
+    for size in SIZES:
+        A = array('d', (random.random() for i in range(size * size)))
+        B = array('d', (random.random() for i in range(size * size)))
+        BT = transpose(B, size, size)
+        C_naive = array('d', bytes(8 * size * size))
+        C_tiled = array('d', bytes(8 * size * size))
+        C_trans = array('d', bytes(8 * size * size))
+        naive_time = time_it(naive_matmul_rows, A, B, C_naive, size, size, 0, size)
+        tiled_time = time_it(matmul_rows, A, B, C_tiled, size, size, 0, size)
+        trans_time = time_it(matmul_rows, A, BT, C_trans, size, size, 0, size, transposed_B=True)
+        if NUM_EVAL_RUNS == 1 and C_naive != C_tiled:
+            raise Exception('naive and tiled results do not match.')
+        print('{:>6} {:>11.2f} ms {:>11.2f} ms {:>11.2f} ms {:>9.2f} {:>9.2f}'.format(
+            size, naive_time * 1000, tiled_time * 1000, trans_time * 1000,
+            naive_time / tiled_time, naive_time / trans_time))
@@ -22,13 +22,36 @@ Since these computations are CPU-intensive, we'll be using Python's multi-proces
 separate processes rather than separate threads to get around the limitations of the Global Interpreter Lock. 
 """
 
-import random
-import time
 import math
 import multiprocessing as mp
-
-
-def seq_matrix_multiply(A, B):
+from itertools import chain
+
+from base_modules import matrix_numpy
+from base_modules.calibration import MatmulCostModel
+from base_modules.matrix_kernels import matmul_rows, tiled_matrix_multiply
+from base_modules.parallelism import effective_cpu_count, placed_process
+from base_modules.shared_arrays import SharedArray, flatten_rows, result_view
+
+# engines selectable through the engine argument of seq_matrix_multiply and par_matrix_multiply
+# 'python' - textbook i-j-k loops for seq, tiled i-k-j kernel in worker processes for par
+# 'tiled'  - the dependency-free tiled i-k-j kernel from matrix_kernels.py
+# 'numpy'  - BLAS through NumPy, see matrix_numpy.py
+ENGINES = ('python', 'tiled', 'numpy')
+
+
+def _check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}; expected one of {ENGINES}")
+
+
+def seq_matrix_multiply(A, B, engine='python', as_list=False):
+    """ engine='python' and engine='tiled' return a list-of-lists
+        engine='numpy' accepts lists or ndarrays and returns an ndarray, or a list-of-lists if as_list=True """
+    _check_engine(engine)
+    if engine == 'numpy':
+        return matrix_numpy.np_seq_matrix_multiply(A, B, as_list=as_list)
+    if engine == 'tiled':
+        return tiled_matrix_multiply(A, B)
     # establish a few useful variables
     num_rows_A = len(A)
     num_cols_A = len(A[0])
@@ -47,7 +70,15 @@ def seq_matrix_multiply(A, B):
 
 
 # parallel implementation of matrix multiplication
-def par_matrix_multiply(A, B):
+def par_matrix_multiply(A, B, engine='python', as_list=False, workers=None, placement=None):
+    """ engine='python' and engine='tiled' both run the tiled kernel in worker processes
+        accepts lists or ndarrays and returns a 2D view of the shared result buffer (an ndarray when NumPy is
+        installed, otherwise a typed memoryview), or a list-of-lists if as_list=True
+        placement pins the worker processes with a parallelism.PLACEMENTS policy; with engine='numpy' it runs the
+        blocked mode, whose processes can be pinned """
+    _check_engine(engine)
+    if engine == 'numpy':
+        return matrix_numpy.np_par_matrix_multiply(A, B, as_list=as_list, workers=workers, placement=placement)
     # establish a few useful variables
     num_rows_A = len(A)
     num_cols_A = len(A[0])
@@ -57,14 +88,19 @@ def par_matrix_multiply(A, B):
         raise ArithmeticError(
             f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
 
-    # if the output C will be small enough, simply use the sequential version
-    if num_rows_A * num_cols_B < 25_000:
-        return seq_matrix_multiply(A, B)
+    # use the number of workers the calibrated cost model of this machine predicts to be fastest
+    cost_model = MatmulCostModel.load()
+    num_workers = workers or cost_model.best_workers(num_rows_A, num_cols_A, num_cols_B, effective_cpu_count())
 
-    # create workers to calculate results for subset of rows in C
+    # if the cost model predicts that starting the workers costs more than they would save, simply use the
+    # sequential version
+    if not cost_model.should_parallelize(num_rows_A, num_cols_A, num_cols_B, num_workers):
+        C = seq_matrix_multiply(A, B, engine='tiled')
+        if as_list:
+            return C
+        return result_view(mp.RawArray('d', list(chain.from_iterable(C))), (num_rows_A, num_cols_B))
 
-    # get the number of available processors
-    num_workers = mp.cpu_count()
+    # create workers to calculate results for subset of rows in C
     print(f"get the number of available processors: {num_workers}")
     # divide the rows of the output matrix into roughly equal-sized chunks
     chunk_size = math.ceil(num_rows_A / num_workers)
@@ -85,70 +121,44 @@ def par_matrix_multiply(A, B):
     
     the shared memory array is only one-dimensional. We named it C_1D and treated its contents as a flattened version 
     of the 2D result matrix. Each of the parallel worker processes were assigned a portion of the one-dimensional C 
-    array to fill in with results. And then at the end, we converted the flattened one-dimensional C array into a 
-    two-dimensional list of lists as the final output.
+    array to fill in with results. At the end, we return a two-dimensional view over C_1D (an ndarray when NumPy 
+    is installed, otherwise a typed memoryview), so the result is never copied element by element. 
+    
+    The operands are only ever read, so they are flattened once into multiprocessing.shared_memory blocks. The 
+    workers attach to those blocks by name and read A and B in place, rather than each receiving its own pickled 
+    copy of the input lists.
     """
+    A_1D = SharedArray('d', flatten_rows(A))
+    B_1D = SharedArray('d', flatten_rows(B))
     C_1D = mp.RawArray('d', num_rows_A * num_cols_B)
-    workers = []
-    for w in range(num_workers):
-        row_start_C = min(w * chunk_size, num_rows_A)
-        row_end_C = min((w + 1) * chunk_size, num_rows_A)
-        workers.append(mp.Process(target=_par_worker,
-                                  args=(A, B, C_1D, row_start_C, row_end_C)))
-    for w in workers:
-        w.start()
-    for w in workers:
-        w.join()
-
-    # convert flat resultant matrix C_1D into 2D list-of-lists
-    C_2D = [[0] * num_cols_B for i in range(num_rows_A)]
-    for i in range(num_rows_A):
-        for j in range(num_cols_B):
-            C_2D[i][j] = C_1D[i * num_cols_B + j]
-    return C_2D
+    try:
+        worker_procs = []
+        for w in range(num_workers):
+            row_start_C = min(w * chunk_size, num_rows_A)
+            row_end_C = min((w + 1) * chunk_size, num_rows_A)
+            # each worker pins itself before touching its rows, so they are first touched on its own CPU
+            worker_procs.append(placed_process(_par_worker, (A_1D, B_1D, C_1D, num_cols_A, num_cols_B,
+                                                             row_start_C, row_end_C), w, placement))
+        for w in worker_procs:
+            w.start()
+        for w in worker_procs:
+            w.join()
+    finally:
+        A_1D.close()
+        B_1D.close()
+
+    return result_view(C_1D, (num_rows_A, num_cols_B), as_list)
 
 
 # Parallel worker to calculate results for subset of rows in C
-def _par_worker(A, B, C_1D, row_start_C, row_end_C):
-    # subset of rows in A
-    for i in range(row_start_C, row_end_C):
-        # num_cols_B
-        for j in range(len(B[0])):
-            # num_cols_A, also num_rows_B
-            for k in range(len(A[0])):
-                C_1D[i * len(B[0]) + j] += A[i][k] * B[k][j]
+def _par_worker(A_1D, B_1D, C_1D, num_cols_A, num_cols_B, row_start_C, row_end_C):
+    # A_1D and B_1D are row-major views of the shared operands;
+    # the tiled i-k-j kernel writes each finished row of C once
+    matmul_rows(A_1D.view, B_1D.view, C_1D, num_cols_A, num_cols_B, row_start_C, row_end_C)
 
 
 if __name__ == '__main__':
-    NUM_EVAL_RUNS = 1
-    row_dim = 500
-    col_dim = 500
-    A = [[random.random() for i in range(col_dim)] for j in range(row_dim)]
-    B = [[random.random() for i in range(col_dim)] for j in range(row_dim)]
-
-    print('Evaluating Sequential Implementation...')
-    # "warm up"
-    sequential_result = seq_matrix_multiply(A, B)
-    sequential_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        seq_matrix_multiply(A, B)
-        sequential_time += time.perf_counter() - start
-    sequential_time /= NUM_EVAL_RUNS
-
-    print('Evaluating Parallel Implementation...')
-    # "warm up"
-    parallel_result = par_matrix_multiply(A, B)
-    parallel_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        par_matrix_multiply(A, B)
-        parallel_time += time.perf_counter() - start
-    parallel_time /= NUM_EVAL_RUNS
-
-    if sequential_result != parallel_result:
-        raise Exception('sequential_result and parallel_result do not match.')
-    print('Average Sequential Time: {:.2f} ms'.format(sequential_time * 1000))
-    print('Average Parallel Time: {:.2f} ms'.format(parallel_time * 1000))
-    print('Speedup: {:.2f}'.format(sequential_time / parallel_time))
-    print('Efficiency: {:.2f}%'.format(100 * (sequential_time / parallel_time) / mp.cpu_count()))
+    # timed, checked and compared with this machine's baseline by the benchmark suite
+    from base_modules.benchmark_suite import run_suite
+
+    run_suite(['matrix_multiply'], size=500)
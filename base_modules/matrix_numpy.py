@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+""" NumPy-backed engine for matrix multiplication """
+
+"""
+NumPy engine
+
+The pure-Python implementations in matrix_multiplier.py execute one interpreted multiply-add per inner loop
+iteration, so a 500x500 product costs 125 million trips through the interpreter. NumPy hands the whole product to
+a BLAS library instead, which uses vector instructions, cache blocking and usually its own pool of threads.
+
+When BLAS threading is available, a single call to A @ B already uses every core and there is nothing left for
+Python's multiprocessing to do. Some deployments disable BLAS threading though (OMP_NUM_THREADS=1 and friends),
+typically because many processes share a machine. For that case the blocked mode splits the rows of A into one
+block per worker process and lets each process run a single-threaded BLAS product for its block, which is the
+same row agglomeration that par_matrix_multiply uses. B is placed in shared memory once and read there by every
+worker.
+
+Both functions accept list-of-lists or ndarray operands and return an ndarray, or a list-of-lists when
+as_list=True. They are normally reached through matrix_multiplier.seq_matrix_multiply(A, B, engine='numpy') and
+matrix_multiplier.par_matrix_multiply(A, B, engine='numpy').
+"""
+
+import math
+import os
+import random
+import time
+
+from base_modules.parallelism import effective_cpu_count, placed_process_pool
+from base_modules.shared_arrays import SharedArray
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; matrix_multiplier falls back to the pure-Python engine
+    np = None
+
+# environment variables honoured by the common BLAS builds
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("the 'numpy' matrix engine requires NumPy to be installed")
+
+
+def blas_threads():
+    """ returns the BLAS thread limit set through the environment, or None if BLAS may use every core """
+    limits = [int(os.environ[var]) for var in BLAS_THREAD_VARIABLES if os.environ.get(var, '').isdigit()]
+    return min(limits) if limits else None
+
+
+def _as_operands(A, B):
+    """ converts both operands to float64 ndarrays and checks their dimensions """
+    _require_numpy()
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+    num_rows_A, num_cols_A = A.shape
+    num_rows_B, num_cols_B = B.shape
+    if num_cols_A != num_rows_B:
+        raise ArithmeticError(
+            f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
+    return A, B
+
+
+def np_seq_matrix_multiply(A, B, as_list=False):
+    """ single call into BLAS; uses as many threads as BLAS is allowed to """
+    A, B = _as_operands(A, B)
+    C = A @ B
+    return C.tolist() if as_list else C
+
+
+def np_par_matrix_multiply(A, B, as_list=False, workers=None, mode='auto', placement=None):
+    """ parallel NumPy matrix multiplication
+        mode='blas'    - one BLAS call, parallelised by the BLAS thread pool
+        mode='blocked' - row blocks of A multiplied in separate processes, for when BLAS threading is disabled
+        mode='auto'    - 'blocked' if the environment limits BLAS to one thread or a placement is given,
+                         otherwise 'blas'
+        placement pins the worker processes of the blocked mode with a parallelism.PLACEMENTS policy; the threads
+        of the BLAS library cannot be placed from here """
+    A, B = _as_operands(A, B)
+    if mode == 'auto':
+        mode = 'blocked' if placement is not None or blas_threads() == 1 else 'blas'
+    if mode == 'blas' and placement is not None:
+        raise ValueError("placement needs mode='blocked'; BLAS places its own threads")
+    if mode == 'blas':
+        C = A @ B
+    elif mode == 'blocked' and not A.shape[0]:
+        # no row blocks to hand out
+        C = np.empty((0, B.shape[1]))
+    elif mode == 'blocked':
+        num_workers = workers or effective_cpu_count()
+        chunk_size = math.ceil(A.shape[0] / num_workers)
+        # every worker reads all of B, so it is put in shared memory once instead of being pickled per worker
+        shared_B = SharedArray('d', B)
+        try:
+            with placed_process_pool(num_workers, placement) as pool:
+                blocks = pool.map(_np_block_worker,
+                                  (A[row:row + chunk_size] for row in range(0, A.shape[0], chunk_size)),
+                                  [shared_B] * num_workers, [B.shape] * num_workers)
+                C = np.vstack(list(blocks))
+        finally:
+            shared_B.close()
+    else:
+        raise ValueError(f"Unknown mode {mode!r}; expected 'auto', 'blas' or 'blocked'")
+    return C.tolist() if as_list else C
+
+
+def _np_block_worker(A_block, B, shape_B):
+    """ multiplies one row block of A by the shared B in a worker process """
+    B_nd = B.as_ndarray(shape_B)
+    C_block = A_block @ B_nd
+    del B_nd
+    return C_block
+
+
+if __name__ == '__main__':
+    from base_modules.matrix_multiplier import seq_matrix_multiply, par_matrix_multiply
+
+    NUM_EVAL_RUNS = 1
+    # the pure-Python implementations take minutes beyond a few hundred rows
+    PYTHON_SIZES = (50, 100, 200, 300)
+    NUMPY_SIZES = PYTHON_SIZES + (500, 1000, 2000)
+
+    def time_it(func, *args, **kwargs):
+        func(*args, **kwargs)  # "warm up"
+        elapsed = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            elapsed += time.perf_counter() - start
+        return elapsed / NUM_EVAL_RUNS
+
+    print(f'BLAS thread limit from environment: {blas_threads()}')
+    print('{:>6} {:>14} {:>14} {:>14} {:>14} {:>14}'.format(
+        'size', 'python seq', 'python par', 'numpy seq', 'numpy blas', 'numpy blocked'))
+    for size in NUMPY_SIZES:
+        A = [[random.random() for i in range(size)] for j in range(size)]
+        B = [[random.random() for i in range(size)] for j in range(size)]
+        A_nd, B_nd = np.array(A), np.array(B)
+        timings = []
+        if size in PYTHON_SIZES:
+            timings.append(time_it(seq_matrix_multiply, A, B))
+            timings.append(time_it(par_matrix_multiply, A, B))
+        else:
+            timings.extend([None, None])
+        timings.append(time_it(np_seq_matrix_multiply, A_nd, B_nd))
+        timings.append(time_it(np_par_matrix_multiply, A_nd, B_nd, mode='blas'))
+        timings.append(time_it(np_par_matrix_multiply, A_nd, B_nd, mode='blocked'))
+        print('{:>6} '.format(size) + ' '.join(
+            '{:>11.2f} ms'.format(t * 1000) if t is not None else '{:>14}'.format('-') for t in timings))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+""" Reusable multiplier that keeps a warm pool of worker processes """
+
+"""
+Persistent worker pool
+
+par_matrix_multiply starts a fresh set of processes for every call. Starting a process costs a few milliseconds,
+which is more than the whole computation for a medium-sized matrix. A workload made of many such multiplies ends
+up spending most of its time creating and joining processes.
+
+PooledMatrixMultiplier pays those costs once. It owns:
+    1. a ProcessPoolExecutor whose workers are started up front and reused for every job
+    2. a few scratch slots, each holding shared memory for A, B and C. A slot grows to fit the largest matrix it has
+       seen, so repeated jobs of similar size never allocate
+    3. the calibrated MatmulCostModel of this machine, which sends a job to the pool only when the predicted
+       parallel time beats the sequential time
+
+Jobs are pipelined. submit() copies the operands of the next job into a free slot while the workers are still busy
+with the previous job, and returns a Future immediately. The number of slots (depth) bounds the number of jobs in
+flight. When every slot is busy, submit() waits for one to free up, which gives natural backpressure to a producer
+that streams jobs faster than they can be computed.
+
+Workers keep their attachments to the scratch blocks between jobs, so a job only sends a few names and row
+numbers to each worker.
+"""
+
+import math
+import queue
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from base_modules.calibration import MatmulCostModel
+from base_modules.matrix_kernels import matmul_rows
+from base_modules.parallelism import effective_cpu_count
+from base_modules.shared_arrays import SharedArray, attach, flatten_rows, result_view
+
+# scratch blocks each worker stays attached to; older ones are closed first
+MAX_WORKER_ATTACHMENTS = 16
+_worker_attachments = OrderedDict()
+
+
+def _attach_cached(handle):
+    """ worker side: returns the SharedArray for a handle, attaching only the first time it is seen """
+    name = handle[0]
+    shared = _worker_attachments.get(name)
+    if shared is None:
+        shared = _worker_attachments[name] = attach(handle)
+        while len(_worker_attachments) > MAX_WORKER_ATTACHMENTS:
+            _worker_attachments.popitem(last=False)[1].close()
+    else:
+        _worker_attachments.move_to_end(name)
+    return shared
+
+
+def _pool_worker(A_handle, B_handle, C_handle, num_cols_A, num_cols_B, row_start_C, row_end_C):
+    A, B, C = _attach_cached(A_handle), _attach_cached(B_handle), _attach_cached(C_handle)
+    matmul_rows(A.view, B.view, C.view, num_cols_A, num_cols_B, row_start_C, row_end_C)
+
+
+def _warm_up(delay):
+    # sleeping keeps each worker busy long enough for the pool to start all of them
+    time.sleep(delay)
+
+
+class _ScratchSlot:
+    """ shared memory for the operands and result of one job in flight """
+
+    def __init__(self):
+        self.A = self.B = self.C = None
+
+    def reserve(self, size_A, size_B, size_C):
+        """ grows the blocks to at least the given number of elements """
+        self.A = self._grow(self.A, size_A)
+        self.B = self._grow(self.B, size_B)
+        self.C = self._grow(self.C, size_C)
+
+    @staticmethod
+    def _grow(shared, size):
+        if shared is not None and len(shared) >= size:
+            return shared
+        if shared is not None:
+            shared.close()
+        return SharedArray('d', size)
+
+    def close(self):
+        for shared in (self.A, self.B, self.C):
+            if shared is not None:
+                shared.close()
+
+
+class PooledMatrixMultiplier:
+    """ multiplies a stream of matrices on a warm pool of processes
+
+        with PooledMatrixMultiplier() as multiplier:
+            futures = [multiplier.submit(A, B) for A, B in jobs]
+            products = [f.result() for f in futures]
+    """
+
+    def __init__(self, workers=None, depth=2, cost_model=None):
+        self.num_workers = workers or effective_cpu_count()
+        self.depth = depth
+        self.cost_model = cost_model or MatmulCostModel.load()
+        self._pool = ProcessPoolExecutor(max_workers=self.num_workers)
+        list(self._pool.map(_warm_up, [0.05] * self.num_workers))
+        self._slots = [_ScratchSlot() for i in range(depth)]
+        self._free_slots = queue.Queue()
+        for slot in self._slots:
+            self._free_slots.put(slot)
+
+    def multiply(self, A, B, as_list=False):
+        return self.submit(A, B, as_list).result()
+
+    def submit(self, A, B, as_list=False):
+        """ schedules C = A*B and returns a Future of C
+            C is an ndarray (a typed memoryview without NumPy), or a list-of-lists if as_list=True """
+        num_rows_A, num_cols_A = len(A), len(A[0])
+        num_rows_B, num_cols_B = len(B), len(B[0])
+        if num_cols_A != num_rows_B:
+            raise ArithmeticError(
+                f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
+
+        # small jobs are computed right here, the cost model says the pool would be slower
+        if not self.cost_model.should_parallelize(num_rows_A, num_cols_A, num_cols_B, self.num_workers,
+                                                  pooled=True):
+            C_1D = array('d', bytes(8 * num_rows_A * num_cols_B))
+            matmul_rows(flatten_rows(A), flatten_rows(B), C_1D, num_cols_A, num_cols_B, 0, num_rows_A)
+            future = Future()
+            future.set_result(result_view(C_1D, (num_rows_A, num_cols_B), as_list))
+            return future
+
+        # blocks while depth jobs are already in flight
+        slot = self._free_slots.get()
+        try:
+            slot.reserve(num_rows_A * num_cols_A, num_rows_B * num_cols_B, num_rows_A * num_cols_B)
+            slot.A.load(flatten_rows(A))
+            slot.B.load(flatten_rows(B))
+        except BaseException:
+            self._free_slots.put(slot)
+            raise
+
+        chunk_size = math.ceil(num_rows_A / self.num_workers)
+        chunk_futures = [self._pool.submit(_pool_worker, slot.A.handle, slot.B.handle, slot.C.handle,
+                                           num_cols_A, num_cols_B, row, min(row + chunk_size, num_rows_A))
+                         for row in range(0, num_rows_A, chunk_size)]
+        job = Future()
+        remaining = [len(chunk_futures)]
+        lock = threading.Lock()
+
+        def chunk_done(chunk_future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                for f in chunk_futures:
+                    f.result()
+                # the slot is reused by later jobs, so the result has to be copied out of it
+                C_1D = array('d', slot.C.view[:num_rows_A * num_cols_B])
+            except BaseException as e:
+                job.set_exception(e)
+            else:
+                job.set_result(result_view(C_1D, (num_rows_A, num_cols_B), as_list))
+            finally:
+                self._free_slots.put(slot)
+
+        for f in chunk_futures:
+            f.add_done_callback(chunk_done)
+        return job
+
+    def map(self, pairs, as_list=False):
+        """ multiplies every (A, B) pair of an iterable, yielding the products in order """
+        pending = deque()
+        for A, B in pairs:
+            pending.append(self.submit(A, B, as_list))
+            if len(pending) > self.depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self._pool.shutdown()
+        for slot in self._slots:
+            slot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    from base_modules.matrix_multiplier import par_matrix_multiply
+
+    NUM_JOBS = 20
+    SIZE = 150
+    jobs = [([[random.random() for i in range(SIZE)] for j in range(SIZE)],
+             [[random.random() for i in range(SIZE)] for j in range(SIZE)]) for n in range(NUM_JOBS)]
+
+    print(f'Evaluating par_matrix_multiply on {NUM_JOBS} jobs of {SIZE}x{SIZE}...')
+    start = time.perf_counter()
+    fresh_results = [par_matrix_multiply(A, B, as_list=True) for A, B in jobs]
+    fresh_time = time.perf_counter() - start
+
+    print(f'Evaluating PooledMatrixMultiplier on {NUM_JOBS} jobs of {SIZE}x{SIZE}...')
+    with PooledMatrixMultiplier() as multiplier:
+        start = time.perf_counter()
+        pooled_results = list(multiplier.map(jobs, as_list=True))
+        pooled_time = time.perf_counter() - start
+
+    if fresh_results != pooled_results:
+        raise Exception('fresh and pooled results do not match.')
+    print('Average par_matrix_multiply Time: {:.2f} ms'.format(fresh_time / NUM_JOBS * 1000))
+    print('Average PooledMatrixMultiplier Time: {:.2f} ms'.format(pooled_time / NUM_JOBS * 1000))
+    print('Speedup: {:.2f}'.format(fresh_time / pooled_time))
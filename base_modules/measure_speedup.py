@@ -46,9 +46,26 @@ are utilized. We can get a rough calculation for efficiency by dividing the spee
 
 """ Measure the speedup of a parallel algorithm """
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import multiprocessing as mp
+"""
+Granularity of par_sum
+----------------------
+par_sum used to split the range recursively down to 100,000 numbers, so summing 100,000,000 numbers meant about
+1,000 futures, each paying a round trip to a worker, all collected by the parent. It now submits a few chunks per
+worker: each worker reduces its chunk locally with sum, and the few partial sums are combined pairwise with
+tree_reduce. The extra chunks per worker keep the workers busy when one chunk finishes late.
+
+The number of chunks, and the number of workers when none is given, come from the calibrated MachineProfile of this
+machine, which also decides when a range is too small to be worth a pool at all.
+"""
+
+import operator
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+from base_modules.calibration import MachineProfile
+from base_modules.divide_and_conquer import tree_reduce
+from base_modules.parallelism import effective_cpu_count
 
 
 # sequential implementation
@@ -57,61 +74,53 @@ def seq_sum(lo, hi):
 
 
 # parallel implementation
-def par_sum(lo, hi, pool=None):
+def par_sum(lo, hi, pool=None, workers=None):
+    profile = MachineProfile.load()
+    if workers:
+        num_workers, num_chunks = workers, profile.chunks(hi - lo, workers, 'sum')
+    else:
+        # let the machine profile pick the workers and chunks, or decide that a pool does not pay off
+        plan = profile.plan(hi - lo, 'sum', pooled=pool is not None)
+        if not plan.parallel:
+            return seq_sum(lo, hi)
+        num_workers, num_chunks = plan.workers, plan.num_chunks
     # if the pool argument is None, this indicates intial call to the function
-    # if pool is None the condition evaluates to true and we create ProcessPool Executor
-    # not None == Not False == True
     if not pool:
-        with ProcessPoolExecutor() as executor:
-            futures = par_sum(lo, hi, pool=executor)
-            # Retrive the individual results and sum them
-            # summing over all sub-divided results in the
-            # as_completed() returns a iterator that yields futures from
-            # the list of futures as the complete
-            return sum(f.result() for f in as_completed(futures))
-    else:
-        # base case threshold
-        # Base Case => Increase => Parallel efficiency Increase
-        # Base Case => Decrease => Parallel efficiency Decrease
-        if hi - lo <= 100_000:
-            return [pool.submit(sum, range(lo, hi))]
-        else:
-            mid = (hi + lo) // 2  # middle index for splitting
-            left = par_sum(lo, mid, pool=pool)
-            right = par_sum(mid, hi, pool=pool)
-            return left + right
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return par_sum(lo, hi, pool=executor, workers=num_workers)
+    # a few chunks per worker, each reduced locally in the worker
+    bounds = [lo + (hi - lo) * c // num_chunks for c in range(num_chunks + 1)]
+    futures = [pool.submit(sum, range(start, end)) for start, end in zip(bounds, bounds[1:])]
+    # combine the partial sums pairwise
+    return tree_reduce(operator.add, [f.result() for f in futures])
 
 
 if __name__ == '__main__':
     NUM_EVAL_RUNS = 1
-    SUM_VALUE = 100_000_000
-
-    print('Evaluating Sequential Implementation...')
-
-    # "warm up"
-    sequential_result = seq_sum(1, SUM_VALUE)
-
-    sequential_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        # sequential summing
-        seq_sum(1, SUM_VALUE)
-        sequential_time += time.perf_counter() - start
-    sequential_time /= NUM_EVAL_RUNS
-
-    print('Evaluating Parallel Implementation...')
-    # "warm up"
-    parallel_result = par_sum(1, SUM_VALUE)
-    parallel_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        par_sum(1, SUM_VALUE)
-        parallel_time += time.perf_counter() - start
-    parallel_time /= NUM_EVAL_RUNS
-
-    if sequential_result != parallel_result:
-        raise Exception('sequential_result and parallel_result do not match.')
-    print('Average Sequential Time: {:.2f} ms'.format(sequential_time * 1000))
-    print('Average Parallel Time: {:.2f} ms'.format(parallel_time * 1000))
-    print('Speedup: {:.2f}'.format(sequential_time / parallel_time))
-    print('Efficiency: {:.2f}%'.format(100 * (sequential_time / parallel_time) / mp.cpu_count()))
+    # sizes to sum, e.g. python -m base_modules.measure_speedup 1e6 1e8
+    SUM_VALUES = [int(float(arg)) for arg in sys.argv[1:]] or [10 ** 6, 10 ** 8, 10 ** 10]
+    NUM_WORKERS = effective_cpu_count()
+
+    print('{:>15} {:>14} {:>14} {:>9} {:>11}'.format('size', 'sequential', 'parallel', 'speedup', 'efficiency'))
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        for SUM_VALUE in SUM_VALUES:
+            # "warm up"
+            sequential_result = seq_sum(1, SUM_VALUE)
+            parallel_result = par_sum(1, SUM_VALUE, pool=pool, workers=NUM_WORKERS)
+            if sequential_result != parallel_result:
+                raise Exception('sequential_result and parallel_result do not match.')
+
+            sequential_time = parallel_time = 0
+            for i in range(NUM_EVAL_RUNS):
+                start = time.perf_counter()
+                seq_sum(1, SUM_VALUE)
+                sequential_time += time.perf_counter() - start
+                start = time.perf_counter()
+                par_sum(1, SUM_VALUE, pool=pool, workers=NUM_WORKERS)
+                parallel_time += time.perf_counter() - start
+            sequential_time /= NUM_EVAL_RUNS
+            parallel_time /= NUM_EVAL_RUNS
+
+            speedup = sequential_time / parallel_time
+            print('{:>15,} {:>11.2f} ms {:>11.2f} ms {:>9.2f} {:>10.2f}%'.format(
+                SUM_VALUE, sequential_time * 1000, parallel_time * 1000, speedup, 100 * speedup / NUM_WORKERS))
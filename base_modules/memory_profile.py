@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+""" Peak memory of a call, in the parent and in every child process """
+
+"""
+Memory profile
+
+Wall-clock time is only half of the cost of a parallel implementation. par_matrix_multiply used to build full
+list-of-lists copies of its operands, merge allocates temporary lists, and every worker process has its own
+interpreter, so a version that is faster can still be the one that runs out of memory in production.
+profile_memory runs a function once and measures:
+
+    1. peak RSS of the parent - read from VmHWM in /proc/self/status. The high-water mark is reset first by
+                                writing 5 to /proc/self/clear_refs, so it belongs to this call only
+    2. peak RSS of the children - a sampler thread walks the descendants of the parent every interval seconds and
+                                keeps the largest VmHWM seen for each, and the largest sum of their VmRSS. Shared
+                                memory a child has touched counts towards its RSS, so the children's total can
+                                count a SharedArray more than once. The report also shows the largest peak of
+                                any single child and how many children were seen. A child that starts and exits
+                                between two samples is never seen, so very short-lived workers can be missed
+    3. Python allocations      - tracemalloc's peak of traced memory during the call (the most the call had
+                                allocated at once, on top of what was live before), and the top allocation sites
+                                of a snapshot the sampler takes whenever the traced memory reaches a new high.
+                                This is a peak, not the total number of bytes allocated over the call: memory that
+                                is freed and allocated again counts once, and tracemalloc keeps no running total
+
+Without /proc (macOS, for example) the peaks come from resource.getrusage instead. Its RUSAGE_CHILDREN figure is
+the largest RSS of any child that has been waited for, ever, so it can include children from earlier calls.
+
+tracemalloc slows allocation-heavy code down a lot, so the profile comes from an extra, untimed run.
+"""
+
+import os
+import random
+import threading
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SAMPLE_INTERVAL = 0.01
+TOP_SITES = 5
+# a new tracemalloc snapshot is taken when traced memory grows by this factor over the last one
+SNAPSHOT_GROWTH = 1.1
+
+
+def _status_bytes(pid, field):
+    """ a size field such as VmHWM or VmRSS of /proc/<pid>/status in bytes, or None if it cannot be read """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _descendants(pid):
+    """ pids of every process below pid, from the parent pid field of /proc/<pid>/stat """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command name in parentheses can hold spaces, so split after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def _rusage_bytes(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+class MemorySampler:
+    """ samples the peak RSS of this process and its descendants, and optionally the tracemalloc peaks,
+        on a background thread while the with block runs
+
+        with MemorySampler(trace=True) as sampler:
+            par_merge_sort(values)
+        print(sampler.result()) """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, trace=False, top=TOP_SITES):
+        self.interval = interval
+        self.trace = trace
+        self.top = top
+        self.use_proc = _status_bytes(os.getpid(), 'VmHWM') is not None
+        self.children = {}
+        self.children_total = 0
+        self._snapshot = None
+        self._snapshot_size = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        if self.use_proc:
+            total = 0
+            for pid in _descendants(os.getpid()):
+                peak, rss = _status_bytes(pid, 'VmHWM'), _status_bytes(pid, 'VmRSS')
+                if peak is not None:
+                    self.children[pid] = max(self.children.get(pid, 0), peak)
+                total += rss or 0
+            self.children_total = max(self.children_total, total)
+        if self.trace:
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self._snapshot_size * SNAPSHOT_GROWTH:
+                self._snapshot = tracemalloc.take_snapshot()
+                self._snapshot_size = current
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        if self.use_proc:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+            except OSError:
+                pass
+        if self.trace:
+            self._was_tracing = tracemalloc.is_tracing()
+            if not self._was_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._traced_start = tracemalloc.get_traced_memory()[0]
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        if self.trace:
+            self.traced_peak = tracemalloc.get_traced_memory()[1] - self._traced_start
+            if not self._was_tracing:
+                tracemalloc.stop()
+
+    def result(self):
+        """ the measurements as a dict of byte counts, with the top allocation sites as (site, bytes) pairs
+            traced_peak is the peak of traced memory during the call, not its total bytes allocated """
+        if self.use_proc:
+            result = {'source': 'proc', 'parent_peak_rss': _status_bytes(os.getpid(), 'VmHWM'),
+                      'children_peak_rss': self.children_total, 'child_peaks': dict(self.children),
+                      'max_child_peak_rss': max(self.children.values(), default=None),
+                      'num_children': len(self.children)}
+        elif resource is not None:
+            # RUSAGE_CHILDREN is already the largest peak of any child, and cannot tell how many there were
+            children_peak = _rusage_bytes(resource.RUSAGE_CHILDREN)
+            result = {'source': 'rusage', 'parent_peak_rss': _rusage_bytes(resource.RUSAGE_SELF),
+                      'children_peak_rss': children_peak, 'child_peaks': {}, 'max_child_peak_rss': children_peak,
+                      'num_children': None}
+        else:
+            result = {'source': None, 'parent_peak_rss': None, 'children_peak_rss': None, 'child_peaks': {},
+                      'max_child_peak_rss': None, 'num_children': None}
+        if self.trace:
+            statistics = []
+            if self._snapshot is not None:
+                # leave out the sampler's own allocations
+                snapshot = self._snapshot.filter_traces([tracemalloc.Filter(False, module.__file__)
+                                                         for module in (tracemalloc, threading)] +
+                                                        [tracemalloc.Filter(False, __file__)])
+                statistics = snapshot.statistics('lineno')[:self.top]
+            result['traced_peak'] = self.traced_peak
+            result['top_sites'] = [(f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', stat.size)
+                                   for stat in statistics]
+        return result
+
+
+def profile_memory(func, *args, interval=SAMPLE_INTERVAL, top=TOP_SITES, **kwargs):
+    """ calls func(*args, **kwargs) once under a tracing MemorySampler; returns the sampler's result """
+    with MemorySampler(interval, trace=True, top=top) as sampler:
+        func(*args, **kwargs)
+    return sampler.result()
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return '-'
+    return f'{num_bytes / 2 ** 20:.1f} MB'
+
+
+if __name__ == '__main__':
+    from base_modules.merge_sort import par_merge_sort, seq_merge_sort
+
+    SIZE = 1_000_000
+    values = [random.randint(0, 10_000) for i in range(SIZE)]
+    for name, func in (('seq_merge_sort', seq_merge_sort), ('par_merge_sort', par_merge_sort)):
+        profile = profile_memory(func, values.copy())
+        print(f'{name}: parent peak RSS {format_bytes(profile["parent_peak_rss"])}, children peak RSS '
+              f'{format_bytes(profile["children_peak_rss"])} (largest child '
+              f'{format_bytes(profile["max_child_peak_rss"])} of {profile["num_children"]}), traced peak '
+              f'{format_bytes(profile["traced_peak"])}')
+        for site, size in profile['top_sites']:
+            print(f'    {format_bytes(size):>10}  {site}')
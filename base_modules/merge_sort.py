@@ -1,10 +1,81 @@
 #!/usr/bin/env python3
 """ Solution: Sort an array of random integers with merge sort """
 
+"""
+Parallel merge sort on a worker pool
+
+The first parallel version spawned a new process at every level of the recursion until the depth reached
+log2(cpu_count). Every call paid for starting processes, and all the merges above that depth ran one after another
+in the parent.
+
+par_merge_sort now uses a pool of worker processes that can be kept running between calls. The array is copied
+once into shared memory, and each worker sorts one contiguous run of it. The sorted runs are then combined by a
+merge tree. Each level merges neighbouring pairs of runs in parallel, from one shared buffer into a second one, and
+the two buffers swap roles for the next level. Nothing is joined recursively and no array is pickled. Every task
+carries only the buffer names and its run bounds.
+
+Parallel merge
+
+Near the root of the merge tree there are fewer merges than workers, and the last one merges the whole array on a
+single core. By Amdahl's law that serial step caps the speedup however many cores there are.
+
+Each merge is therefore split into independent sub-merges. To give output positions k_start..k_end of the merged
+run to one worker, we need to know how many of the first k elements come from each input run. This co-rank is found
+by a binary search over the two runs (co_rank). Each worker then merges its two input slices straight into its own
+slice of the output buffer, so no worker depends on another and the final merge phase scales with the cores too.
+
+Buffered merge sort
+
+seq_merge_sort copies both halves into new lists on every merge, which adds up to O(n log n) temporary elements
+over a sort. It also recurses all the way down to single elements. buffered_merge_sort is the version the workers
+use:
+    1. it scans the input for natural runs that are already in order, and reverses strictly descending runs
+    2. runs shorter than MIN_RUN are extended with insertion sort, which beats merging for a handful of elements
+    3. the runs are merged bottom-up between the input and a single auxiliary buffer, which swap roles after
+       every pass, so the merges themselves allocate nothing
+An already sorted or reversed input is a single run and needs no merging at all.
+
+Typed and keyed sorting
+
+The shared buffers can hold any fixed-width numeric typecode of the array module. The typecode is taken from an
+array.array, memoryview or ndarray input, and a list is stored as 64-bit integers if every element is an int and as
+doubles otherwise. A value that does not fit the typecode raises an error instead of being truncated. That includes
+an int in a list of ints and floats that a double cannot hold exactly. Such a mixed list is put back in order from
+its original objects, so its ints stay ints.
+
+With NumPy installed, the workers sort and merge the shared buffers as ndarrays, so no element is ever turned into
+a Python object. A merge computes the output position of every element with np.searchsorted instead of comparing
+elements one at a time.
+
+To sort records (dicts, tuples or a structured ndarray) by one field, the keys are extracted into the shared buffer
+along with a second buffer holding their original positions. The merges move both. The positions that come out
+are the permutation that sorts the records, which argsort=True returns directly.
+"""
+
 import random
+import sys
 import time
-import multiprocessing as mp
 import math
+import tracemalloc
+from array import array as typed_array
+from concurrent.futures import Future, ProcessPoolExecutor
+from operator import itemgetter, neg
+
+from base_modules.calibration import MachineProfile
+from base_modules.parallelism import effective_cpu_count, placed_process_pool
+from base_modules.shared_arrays import SharedArray
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; runs are sorted and merged in pure Python without it
+    np = None
+
+# fixed-width numeric typecodes par_merge_sort can keep in shared memory
+TYPECODES = 'bBhHiIlLqQfd'
+# merges are not split into sub-merges of fewer elements than this
+MIN_MERGE_PART = 4096
+# runs shorter than this are extended with insertion sort; picked with the benchmark at the bottom of this module
+MIN_RUN = 16
 
 
 def seq_merge_sort(array, *args):
@@ -65,62 +136,443 @@ def merge(array, left, mid, right):
         merge_index += 1
 
 
-def par_merge_sort(array, *args):
-    """ parallel implementation of merge sort """
-    if not args:  # first call
-        shared_array = mp.RawArray('i', array)
-        # Initial Recursive Call
-        # The following function does not return any value
-        # It mutates the array/list
-        # Final argument is dept of recursion
-        par_merge_sort(shared_array, 0, len(array) - 1, 0)
-        # insert result into original array
-        array[:] = shared_array
+def insertion_sort(array, left, right, sorted_end=None):
+    """ sorts array[left:right] in place; array[left:sorted_end] may already be known to be sorted """
+    for i in range(sorted_end or left + 1, right):
+        value = array[i]
+        j = i - 1
+        # shift the larger elements one place to the right to open a gap for value
+        while j >= left and array[j] > value:
+            array[j + 1] = array[j]
+            j -= 1
+        array[j + 1] = value
+
+
+def _natural_runs(array, min_run):
+    """ splits array into sorted runs in place and returns the end index of each run
+        descending runs are reversed, and runs shorter than min_run are extended with insertion sort """
+    run_ends = []
+    start = 0
+    while start < len(array):
+        end = start + 1
+        if end < len(array) and array[end] < array[start]:
+            # strictly descending, so that reversing it cannot reorder equal elements
+            while end < len(array) and array[end] < array[end - 1]:
+                end += 1
+            i, j = start, end - 1
+            while i < j:
+                array[i], array[j] = array[j], array[i]
+                i += 1
+                j -= 1
+        else:
+            while end < len(array) and array[end] >= array[end - 1]:
+                end += 1
+        if end - start < min_run:
+            stop = min(start + min_run, len(array))
+            insertion_sort(array, start, stop, sorted_end=end)
+            end = stop
+        run_ends.append(end)
+        start = end
+    return run_ends
+
+
+def _merge_into(src, dst, a_start, a_end, b_start, b_end, out_start):
+    """ stable merge of the sorted runs src[a_start:a_end] and src[b_start:b_end] into dst from out_start
+        writes element by element, so no temporary lists are created """
+    i, j = a_start, b_start
+    for k in range(out_start, out_start + (a_end - a_start) + (b_end - b_start)):
+        if j >= b_end or (i < a_end and src[i] <= src[j]):
+            dst[k] = src[i]
+            i += 1
+        else:
+            dst[k] = src[j]
+            j += 1
+
+
+def buffered_merge_sort(array, min_run=MIN_RUN):
+    """ bottom-up merge sort that allocates a single auxiliary buffer
+        sorts a list, array.array or memoryview in place and returns it """
+    run_ends = _natural_runs(array, min_run)
+    if len(run_ends) <= 1:
         return array
+    # the one auxiliary buffer; every pass merges from src into dst and then the two swap roles
+    if isinstance(array, list):
+        aux = [None] * len(array)
+    elif isinstance(array, memoryview):
+        aux = memoryview(typed_array(array.format, array))
     else:
-        left, right, depth = args
-        # If the recursion depth is >= the number of processors
-        # then use the sequential merge sort algorithm
-        if depth >= math.log(mp.cpu_count(), 2):
-            seq_merge_sort(array, left, right)
-        elif left < right:
-            # find the middle point
-            mid = (left + right) // 2
-            left_proc = mp.Process(target=par_merge_sort, args=(array, left, mid, depth + 1))
-            left_proc.start()
-            # Uses current process to recursively sort the right half
-            par_merge_sort(array, mid + 1, right, depth + 1)
-            left_proc.join()
-            # merge the two sorted halves
-            merge(array, left, mid, right)
+        aux = typed_array(array.typecode, array)
+    src, dst = array, aux
+    bounds = [0] + run_ends
+    while len(bounds) > 2:
+        next_bounds = [0]
+        for r in range(0, len(bounds) - 1, 2):
+            left, mid = bounds[r], bounds[r + 1]
+            right = bounds[r + 2] if r + 2 < len(bounds) else mid
+            if right == mid or src[mid - 1] <= src[mid]:
+                # there is no right run, or the two runs are already in order
+                dst[left:right] = src[left:right]
+            else:
+                _merge_into(src, dst, left, mid, mid, right, left)
+            next_bounds.append(right)
+        src, dst = dst, src
+        bounds = next_bounds
+    if src is not array:
+        array[:] = src
+    return array
+
+
+def _merge_into_with_index(src, dst, src_index, dst_index, a_start, a_end, b_start, b_end, out_start):
+    """ _merge_into that moves an index buffer along with the keys """
+    i, j = a_start, b_start
+    for k in range(out_start, out_start + (a_end - a_start) + (b_end - b_start)):
+        if j >= b_end or (i < a_end and src[i] <= src[j]):
+            dst[k], dst_index[k] = src[i], src_index[i]
+            i += 1
+        else:
+            dst[k], dst_index[k] = src[j], src_index[j]
+            j += 1
+
+
+def _sort_run(keys, index, start, end):
+    """ pool worker: sorts keys[start:end] in place, moving index[start:end] along when there is an index """
+    if np is not None:
+        # NumPy sorts the shared memory directly, without turning elements into Python objects
+        run = keys.as_ndarray()[start:end]
+        if index is None:
+            run.sort(kind='stable')
+        else:
+            order = np.argsort(run, kind='stable')
+            run[:] = run[order]
+            index_run = index.as_ndarray()[start:end]
+            index_run[:] = index_run[order]
+            del index_run
+        del run
+    elif index is None:
+        run = keys.view[start:end].tolist()
+        buffered_merge_sort(run)
+        keys.load(run, offset=start)
+    else:
+        # the original position breaks ties between equal keys, which keeps the sort stable
+        run = list(zip(keys.view[start:end].tolist(), index.view[start:end].tolist()))
+        buffered_merge_sort(run)
+        keys.load([key for key, position in run], offset=start)
+        index.load([position for key, position in run], offset=start)
+
+
+def _merge_runs(src, dst, a_start, a_end, b_start, b_end, out_start):
+    """ pool worker: merges the sorted runs src[a_start:a_end] and src[b_start:b_end] into dst from out_start
+        src and dst are (keys, index) pairs of buffers; index is None unless the sort carries an index """
+    (src_keys, src_index), (dst_keys, dst_index) = src, dst
+    if np is not None:
+        A = src_keys.as_ndarray()[a_start:a_end]
+        B = src_keys.as_ndarray()[b_start:b_end]
+        # an element's output position is its position in its own run plus the number of elements of the
+        # other run that come before it; equal keys of the left run come first
+        A_positions = np.arange(len(A)) + np.searchsorted(B, A, side='left') + out_start
+        B_positions = np.arange(len(B)) + np.searchsorted(A, B, side='right') + out_start
+        out = dst_keys.as_ndarray()
+        out[A_positions] = A
+        out[B_positions] = B
+        if src_index is not None:
+            index, out_index = src_index.as_ndarray(), dst_index.as_ndarray()
+            out_index[A_positions] = index[a_start:a_end]
+            out_index[B_positions] = index[b_start:b_end]
+            del index, out_index
+        del A, B, out
+    elif src_index is None:
+        _merge_into(src_keys.view, dst_keys.view, a_start, a_end, b_start, b_end, out_start)
+    else:
+        _merge_into_with_index(src_keys.view, dst_keys.view, src_index.view, dst_index.view,
+                               a_start, a_end, b_start, b_end, out_start)
+
+
+def co_rank(k, values, left, mid, right):
+    """ splits the merge of the sorted runs values[left:mid] and values[mid:right] after k output elements
+        returns i such that the first k merged elements are values[left:left+i] and values[mid:mid+k-i]
+        ties are taken from the left run first, which keeps the merge stable """
+    lo = max(0, k - (right - mid))
+    hi = min(k, mid - left)
+    # binary search for the smallest i where the i-th element of the left run comes after the
+    # (k-i-1)-th element of the right run
+    while lo < hi:
+        i = (lo + hi) // 2
+        if values[left + i] <= values[mid + k - i - 1]:
+            lo = i + 1
+        else:
+            hi = i
+    return lo
+
+
+def _submit_merge(pool, src, dst, left, mid, right, parts):
+    """ submits the merge of src[left:mid] and src[mid:right] into dst as up to parts independent sub-merges """
+    parts = max(1, min(parts, (right - left) // MIN_MERGE_PART))
+    futures = []
+    k_start, i_start = 0, 0
+    for part in range(1, parts + 1):
+        k_end = (right - left) * part // parts
+        i_end = co_rank(k_end, src[0].view, left, mid, right)
+        # output positions k_start..k_end-1 come from i_start..i_end-1 of the left run and
+        # k_start-i_start..k_end-i_end-1 of the right run
+        futures.append(pool.submit(_merge_runs, src, dst, left + i_start, left + i_end,
+                                   mid + k_start - i_start, mid + k_end - i_end, left + k_start))
+        k_start, i_start = k_end, i_end
+    return futures
+
+
+class _InlineExecutor:
+    """ runs submitted calls right away in this process; used for arrays too small for a pool """
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def _typecode_of(values):
+    """ the typecode values already have, or 'q' for a list of ints and 'd' for anything else
+        raises ValueError for a list of ints and floats with an int that a double cannot hold exactly """
+    if isinstance(values, typed_array):
+        return values.typecode
+    if isinstance(values, memoryview):
+        return values.format
+    if np is not None and isinstance(values, np.ndarray):
+        if values.dtype.kind in 'mM':
+            # datetimes and timedeltas are sorted by their 64-bit integer representation
+            return 'q'
+        if values.dtype.char not in TYPECODES:
+            raise TypeError(f'cannot sort an ndarray of {values.dtype} by value')
+        return values.dtype.char
+    if all(isinstance(value, int) for value in values):
+        return 'q'
+    for value in values:
+        # ints are compared as doubles alongside the floats, which is only exact if the conversion keeps them
+        if isinstance(value, int) and not _exact_double(value):
+            raise ValueError(f'{value} cannot be sorted exactly as a double among floats')
+    return 'd'
+
+
+def _exact_double(value):
+    try:
+        return float(value) == value
+    except OverflowError:
+        return False
+
+
+def sort_plan(num_keys, typecode, workers=None, pooled=False):
+    """ the MachineProfile plan for sorting num_keys keys of typecode, which are copied into shared memory and
+        back out again """
+    profile = MachineProfile.load()
+    transfer_cost = 2 * profile.shm_cost * typed_array(typecode).itemsize
+    return profile.plan(num_keys, 'sort', transfer_cost, workers or effective_cpu_count(), pooled)
+
+
+def _par_sort(keys, typecode, with_index, pool, num_workers):
+    """ sorts keys on the pool; returns (sorted keys, original positions or None) copied out of shared memory """
+    if np is not None and isinstance(keys, np.ndarray) and keys.dtype.kind in 'mM':
+        keys = keys.view('i8')
+    # the keys and a second buffer of the same size; each level of the merge tree reads one and writes the other
+    src = (SharedArray(typecode, keys), SharedArray('q', range(len(keys))) if with_index else None)
+    dst = (SharedArray(typecode, len(keys)), SharedArray('q', len(keys)) if with_index else None)
+    try:
+        # every worker sorts one contiguous run of the shared array
+        bounds = [len(keys) * w // num_workers for w in range(num_workers + 1)]
+        runs = list(zip(bounds, bounds[1:]))
+        for f in [pool.submit(_sort_run, *src, start, end) for start, end in runs]:
+            f.result()
+
+        # merge tree: each level merges neighbouring pairs of runs in parallel, halving the number of runs
+        while len(runs) > 1:
+            merges = []
+            next_runs = []
+            # near the root there are fewer merges than workers, so each merge is split into sub-merges
+            parts = math.ceil(num_workers / (len(runs) // 2))
+            for r in range(0, len(runs), 2):
+                left, mid = runs[r]
+                # a run without a partner is merged with an empty run, which copies it to dst
+                right = runs[r + 1][1] if r + 1 < len(runs) else mid
+                merges += _submit_merge(pool, src, dst, left, mid, right, parts)
+                next_runs.append((left, right))
+            for f in merges:
+                f.result()
+            src, dst = dst, src
+            runs = next_runs
+
+        sorted_keys = typed_array(typecode, src[0].view)
+        positions = typed_array('q', src[1].view) if with_index else None
+    finally:
+        for shared in src + dst:
+            if shared is not None:
+                shared.close()
+    if np is not None:
+        sorted_keys = np.frombuffer(sorted_keys, dtype=typecode)
+        positions = np.frombuffer(positions, dtype='q') if with_index else None
+    return sorted_keys, positions
+
+
+def par_merge_sort(array, pool=None, workers=None, typecode=None, key=None, argsort=False, placement=None):
+    """ parallel implementation of merge sort on a pool of worker processes
+        sorts a list, array.array, memoryview or ndarray in place and returns it
+        typecode  - any fixed-width numeric array typecode; inferred from the input by default
+        key       - sorts records by one of their fields: a callable, a dict key or tuple index,
+                    or a field name of a structured ndarray
+        argsort   - leaves the input alone and returns the permutation that sorts it
+        placement - pins the workers of the pool started here with a parallelism.PLACEMENTS policy
+        pass pool to reuse a running ProcessPoolExecutor """
+    if key is not None:
+        if np is not None and isinstance(array, np.ndarray) and array.dtype.names:
+            keys = array[key]
+        else:
+            get_key = key if callable(key) else itemgetter(key)
+            keys = [get_key(record) for record in array]
+    else:
+        keys = array
+    typecode = typecode or _typecode_of(keys)
+    if typecode not in TYPECODES:
+        raise ValueError(f'typecode must be one of {TYPECODES!r}, not {typecode!r}')
+
+    # a list mixing ints and floats is put back in order from the original objects, so its ints stay ints
+    keep_objects = key is None and isinstance(array, list) and typecode in 'fd' and \
+        any(isinstance(value, int) for value in array)
+    own_pool = pool is None
+    plan = sort_plan(len(keys), typecode, workers, pooled=not own_pool)
+    num_workers = workers or plan.workers
+    if not plan.parallel:
+        # the machine profile predicts that the work does not pay for the workers
+        own_pool, pool, num_workers = False, _InlineExecutor(), 1
+    elif own_pool:
+        pool = placed_process_pool(num_workers, placement)
+    try:
+        sorted_keys, positions = _par_sort(keys, typecode, key is not None or argsort or keep_objects, pool,
+                                           num_workers)
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    if argsort:
+        return positions
+    # insert result into original array
+    if key is not None or keep_objects:
+        if isinstance(array, list):
+            array[:] = [array[i] for i in positions]
+        elif isinstance(array, (typed_array, memoryview)):
+            # only ndarrays can be indexed with a list of positions, so gather into a typed copy first
+            view = memoryview(array)
+            reordered = typed_array(view.format, (view[i] for i in positions))
+            view.cast('B')[:] = memoryview(reordered).cast('B')
+        else:
+            array[...] = array[positions]
+    elif isinstance(array, list):
+        array[:] = sorted_keys.tolist()
+    elif isinstance(array, (typed_array, memoryview)):
+        memoryview(array).cast('B')[:] = memoryview(sorted_keys).cast('B')
+    elif array.dtype.kind in 'mM':
+        array.view('i8')[:] = sorted_keys
+    else:
+        array[:] = sorted_keys
+    return array
 
 
 if __name__ == '__main__':
     NUM_EVAL_RUNS = 1
-    print('Generating Random Array...')
-    array = [random.randint(0, 10_000) for i in range(1_000_000)]
-
-    print('Evaluating Sequential Implementation...')
-    sequential_result = seq_merge_sort(array.copy())
-    sequential_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        seq_merge_sort(array.copy())
-        sequential_time += time.perf_counter() - start
-    sequential_time /= NUM_EVAL_RUNS
-
-    print('Evaluating Parallel Implementation...')
-    parallel_result = par_merge_sort(array.copy())
-    parallel_time = 0
-    for i in range(NUM_EVAL_RUNS):
-        start = time.perf_counter()
-        par_merge_sort(array.copy())
-        parallel_time += time.perf_counter() - start
-    parallel_time /= NUM_EVAL_RUNS
-
-    if sequential_result != parallel_result:
-        raise Exception('sequential_result and parallel_result do not match.')
-    print('Average Sequential Time: {:.2f} ms'.format(sequential_time * 1000))
-    print('Average Parallel Time: {:.2f} ms'.format(parallel_time * 1000))
-    print('Speedup: {:.2f}'.format(sequential_time / parallel_time))
-    print('Efficiency: {:.2f}%'.format(100 * (sequential_time / parallel_time) / mp.cpu_count()))
+    # pass sizes on the command line to run a subset; 10^8 elements need a few GB of memory and a long time
+    SIZES = [int(float(size)) for size in sys.argv[1:]] or [10 ** 6, 10 ** 7, 10 ** 8]
+    NUM_CPUS = effective_cpu_count()
+    WORKER_COUNTS = sorted({2 ** i for i in range(int(math.log2(NUM_CPUS)) + 1)} | {NUM_CPUS})
+    ALLOCATION_SIZE = 100_000
+    NUM_CONVERSIONS = 1_000_000
+
+    def time_it(func, values, *args):
+        elapsed = 0
+        for i in range(NUM_EVAL_RUNS):
+            values_copy = values.copy()
+            start = time.perf_counter()
+            func(values_copy, *args)
+            elapsed += time.perf_counter() - start
+        return elapsed / NUM_EVAL_RUNS
+
+    def peak_memory(func, values):
+        values_copy = values.copy()
+        tracemalloc.start()
+        func(values_copy)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    print(f'Comparing seq_merge_sort and buffered_merge_sort on {ALLOCATION_SIZE:,} elements...')
+    random_values = [random.randint(0, 10_000) for i in range(ALLOCATION_SIZE)]
+    inputs = {'random': random_values, 'sorted': sorted(random_values),
+              'reversed': sorted(random_values, reverse=True)}
+    print('{:>9} {:>12} {:>12} {:>9} {:>11} {:>11}'.format(
+        'input', 'seq', 'buffered', 'speedup', 'seq peak', 'buf peak'))
+    for name, values in inputs.items():
+        if seq_merge_sort(values.copy()) != buffered_merge_sort(values.copy()):
+            raise Exception('seq_merge_sort and buffered_merge_sort results do not match.')
+        seq_time = time_it(seq_merge_sort, values)
+        buffered_time = time_it(buffered_merge_sort, values)
+        print('{:>9} {:>9.2f} ms {:>9.2f} ms {:>9.2f} {:>8.2f} MB {:>8.2f} MB'.format(
+            name, seq_time * 1000, buffered_time * 1000, seq_time / buffered_time,
+            peak_memory(seq_merge_sort, values) / 2 ** 20, peak_memory(buffered_merge_sort, values) / 2 ** 20))
+
+    print('Tuning MIN_RUN on random input...')
+    for min_run in (8, 16, 32, 64, 128):
+        print('{:>9} {:>9.2f} ms'.format(min_run, time_it(buffered_merge_sort, random_values, min_run) * 1000))
+
+    print(f'Sorting {NUM_CONVERSIONS:,} conversion rows by postbackTimestamp...')
+    # one month of epoch timestamps
+    conversions = [{'postbackTimestamp': random.randint(1_583_020_800, 1_585_699_200), 'transactionId': i}
+                   for i in range(NUM_CONVERSIONS)]
+    start = time.perf_counter()
+    sorted_result = sorted(conversions, key=itemgetter('postbackTimestamp'))
+    builtin_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parallel_result = par_merge_sort(conversions.copy(), key='postbackTimestamp')
+    keyed_time = time.perf_counter() - start
+    if sorted_result != parallel_result:
+        raise Exception('sorted() and par_merge_sort results do not match.')
+    print('sorted(): {:.2f} ms, par_merge_sort: {:.2f} ms'.format(builtin_time * 1000, keyed_time * 1000))
+
+    # keyed sorts of typed inputs are reordered in place, and mixed lists keep their ints exact
+    for values in (typed_array('q', [5, 3, 1, 4]), memoryview(typed_array('d', [0.5, -2.0, 3.25]))):
+        expected = sorted(values.tolist(), reverse=True)
+        if par_merge_sort(values, key=neg, workers=2).tolist() != expected:
+            raise Exception('par_merge_sort with key= did not reorder a typed input.')
+    mixed_result = par_merge_sort([2 ** 52 + 1, 0.5, 2 ** 52], workers=2)
+    if mixed_result != [0.5, 2 ** 52, 2 ** 52 + 1] or not isinstance(mixed_result[2], int):
+        raise Exception('par_merge_sort changed the ints of a list of ints and floats.')
+    try:
+        par_merge_sort([2 ** 60 + 1, 0.5, 2 ** 60], workers=2)
+        raise Exception('par_merge_sort sorted ints that a double cannot hold exactly.')
+    except ValueError:
+        pass
+
+    for size in SIZES:
+        print(f'Generating Random Array of {size:,} elements...')
+        array = [random.randint(0, 10_000) for i in range(size)]
+
+        print('Evaluating Sequential Implementation...')
+        sequential_result = seq_merge_sort(array.copy())
+        sequential_time = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            seq_merge_sort(array.copy())
+            sequential_time += time.perf_counter() - start
+        sequential_time /= NUM_EVAL_RUNS
+        print('Average Sequential Time: {:.2f} ms'.format(sequential_time * 1000))
+
+        print('{:>8} {:>14} {:>9} {:>11}'.format('workers', 'parallel', 'speedup', 'efficiency'))
+        for num_workers in WORKER_COUNTS:
+            # the pool is started once and reused by every run, so process start-up is not timed
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                parallel_result = par_merge_sort(array.copy(), pool=pool, workers=num_workers)
+                if sequential_result != parallel_result:
+                    raise Exception('sequential_result and parallel_result do not match.')
+                parallel_time = 0
+                for i in range(NUM_EVAL_RUNS):
+                    start = time.perf_counter()
+                    par_merge_sort(array.copy(), pool=pool, workers=num_workers)
+                    parallel_time += time.perf_counter() - start
+                parallel_time /= NUM_EVAL_RUNS
+            speedup = sequential_time / parallel_time
+            print('{:>8} {:>11.2f} ms {:>9.2f} {:>10.2f}%'.format(
+                num_workers, parallel_time * 1000, speedup, 100 * speedup / num_workers))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+""" Out-of-core matrix multiplication over memory-mapped files """
+
+"""
+Out-of-core multiplication
+
+seq_matrix_multiply and par_matrix_multiply need A, B and C in memory as lists of Python floats, which costs more
+than 24 bytes per element. A 20,000 x 20,000 matrix is 3.2 GB of raw doubles and well over 10 GB as Python
+objects.
+
+Here the operands and the result live in binary matrix files: a 16 byte header with the number of rows and columns,
+followed by the elements as row-major doubles. A file is memory-mapped rather than read, so the operating system
+pages tiles in and out of the page cache as needed. Only the tiles being worked on take up memory.
+
+C is computed one tile at a time:
+
+    C[I, J] = sum over K of A[I, K] * B[K, J]
+
+Each C tile is one task on a process pool. A worker maps the three files itself, reads the A and B tiles for every
+K straight from the page cache, and writes its finished C tile into the mapped C file. The C tiles are disjoint, so
+workers never write to the same place.
+
+A dedicated I/O thread in the parent walks the task list ahead of the workers. For each upcoming tile it asks the
+operating system to start reading the pages it needs (madvise WILLNEED), then puts the task on a bounded queue. The
+main thread takes tasks off the queue and submits them to the pool. Disk reads for the next tasks therefore overlap
+with computation on the current ones. The queue bound limits how far ahead the thread reads, which keeps the
+prefetched data within the page cache.
+
+Tasks go through C one column panel at a time, so the panel of B a task needs is usually still cached from the
+previous task.
+"""
+
+import mmap
+import os
+import queue
+import random
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from operator import add
+
+from base_modules.matrix_kernels import matmul_rows
+from base_modules.parallelism import effective_cpu_count
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; tiles are multiplied with the tiled pure-Python kernel without it
+    np = None
+
+# number of rows and columns at the start of every matrix file
+HEADER = struct.Struct('<qq')
+# C, A and B tiles are TILE_SIZE x TILE_SIZE elements
+TILE_SIZE = 512 if np is not None else 128
+# tasks per worker the I/O thread may prefetch ahead of the workers
+PREFETCH_DEPTH = 2
+
+
+def create_matrix_file(path, num_rows, num_cols):
+    """ creates a matrix file of zeros without writing them; the file is sparse on most file systems """
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(num_rows, num_cols))
+        f.truncate(HEADER.size + 8 * num_rows * num_cols)
+
+
+def write_matrix_file(path, rows):
+    """ writes an iterable of equal-length rows to a matrix file, one row at a time """
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(0, 0))
+        num_rows, num_cols = 0, None
+        for row in rows:
+            row = array('d', row)
+            if num_cols is None:
+                num_cols = len(row)
+            elif len(row) != num_cols:
+                raise ValueError(f'row {num_rows} has {len(row)} elements, expected {num_cols}')
+            row.tofile(f)
+            num_rows += 1
+        f.seek(0)
+        f.write(HEADER.pack(num_rows, num_cols or 0))
+
+
+def random_matrix_file(path, num_rows, num_cols, seed=0):
+    """ writes a matrix of random numbers without ever holding more than one row in memory """
+    rng = random.Random(seed)
+    write_matrix_file(path, ([rng.random() for j in range(num_cols)] for i in range(num_rows)))
+
+
+def read_matrix_file(path):
+    """ loads a whole matrix file as a list-of-lists; only sensible for small matrices """
+    with MappedMatrix(path) as M:
+        return M.tolist()
+
+
+class MappedMatrix:
+    """ a matrix file mapped into memory
+
+        with MappedMatrix('A.mat') as A:
+            tile = A.tile(0, 64, 0, 64)
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self.num_rows, self.num_cols = HEADER.unpack(self._file.read(HEADER.size))
+        self.mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)[HEADER.size:].cast('d')
+
+    @property
+    def shape(self):
+        return self.num_rows, self.num_cols
+
+    def tile(self, row_start, row_end, col_start, col_end):
+        """ copies a tile out of the file; an ndarray, or a flat row-major array('d') without NumPy """
+        if np is not None:
+            M = np.frombuffer(self.mmap, offset=HEADER.size, count=self.num_rows * self.num_cols)
+            return M.reshape(self.num_rows, self.num_cols)[row_start:row_end, col_start:col_end].copy()
+        tile = array('d')
+        for i in range(row_start, row_end):
+            tile.extend(self.view[i * self.num_cols + col_start:i * self.num_cols + col_end])
+        return tile
+
+    def write_tile(self, row_start, col_start, tile, num_rows, num_cols):
+        """ writes a num_rows x num_cols tile whose top left corner is (row_start, col_start) """
+        if np is not None:
+            M = np.frombuffer(self.mmap, offset=HEADER.size, count=self.num_rows * self.num_cols)
+            M.reshape(self.num_rows, self.num_cols)[row_start:row_start + num_rows,
+                                                   col_start:col_start + num_cols] = tile
+            return
+        for i in range(num_rows):
+            start = (row_start + i) * self.num_cols + col_start
+            self.view[start:start + num_cols] = tile[i * num_cols:(i + 1) * num_cols]
+
+    def prefetch(self, row_start, row_end, col_start, col_end):
+        """ asks the operating system to start reading the pages of a tile into the page cache """
+        page = mmap.PAGESIZE
+        ranges = []
+        for i in range(row_start, row_end):
+            start = HEADER.size + 8 * (i * self.num_cols + col_start)
+            end = HEADER.size + 8 * (i * self.num_cols + col_end)
+            start -= start % page
+            # rows of a tile that share pages are merged into a single request
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        for start, end in ranges:
+            if hasattr(self.mmap, 'madvise'):
+                self.mmap.madvise(mmap.MADV_WILLNEED, start, end - start)
+            else:
+                # without madvise, touching one byte per page reads it in
+                for position in range(start, end, page):
+                    self.mmap[position]
+
+    def tolist(self):
+        return [self.view[i * self.num_cols:(i + 1) * self.num_cols].tolist() for i in range(self.num_rows)]
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _tile_product(A, B, row_start, row_end, col_start, col_end, tile_size):
+    """ C[I, J] = sum over K of A[I, K] * B[K, J], reading one K tile of A and B at a time """
+    C_tile = None
+    for k_start in range(0, A.num_cols, tile_size):
+        k_end = min(k_start + tile_size, A.num_cols)
+        A_tile = A.tile(row_start, row_end, k_start, k_end)
+        B_tile = B.tile(k_start, k_end, col_start, col_end)
+        if np is not None:
+            P = A_tile @ B_tile
+            C_tile = P if C_tile is None else C_tile + P
+        else:
+            P = array('d', bytes(8 * (row_end - row_start) * (col_end - col_start)))
+            matmul_rows(A_tile, B_tile, P, k_end - k_start, col_end - col_start, 0, row_end - row_start)
+            C_tile = P if C_tile is None else array('d', map(add, C_tile, P))
+    return C_tile
+
+
+# matrix files each worker keeps mapped for the lifetime of its pool
+_worker_matrices = {}
+
+
+def _mapped(path, writable=False):
+    M = _worker_matrices.get((path, writable))
+    if M is None:
+        M = _worker_matrices[(path, writable)] = MappedMatrix(path, writable)
+    return M
+
+
+def _par_worker(A_path, B_path, C_path, row_start, row_end, col_start, col_end, tile_size):
+    A, B, C = _mapped(A_path), _mapped(B_path), _mapped(C_path, writable=True)
+    C_tile = _tile_product(A, B, row_start, row_end, col_start, col_end, tile_size)
+    C.write_tile(row_start, col_start, C_tile, row_end - row_start, col_end - col_start)
+
+
+def _open_operands(A_path, B_path, C_path):
+    """ maps A and B, checks their dimensions and creates the C file """
+    # creating C truncates it, which would destroy an operand before it is read
+    if os.path.exists(C_path) and any(os.path.samefile(C_path, path) for path in (A_path, B_path)):
+        raise ValueError(f'C_path {C_path!r} must not be the file of one of the operands')
+    A, B = MappedMatrix(A_path), MappedMatrix(B_path)
+    if A.num_cols != B.num_rows:
+        A.close()
+        B.close()
+        raise ArithmeticError(
+            f"Invalid dimensions; Cannot multiply {A.num_rows}x{A.num_cols}*{B.num_rows}x{B.num_cols}")
+    create_matrix_file(C_path, A.num_rows, B.num_cols)
+    return A, B
+
+
+def _tiles(num_rows, num_cols, tile_size):
+    """ C tiles in column panel order, so consecutive tiles share their panel of B """
+    return [(i, min(i + tile_size, num_rows), j, min(j + tile_size, num_cols))
+            for j in range(0, num_cols, tile_size) for i in range(0, num_rows, tile_size)]
+
+
+def seq_out_of_core_multiply(A_path, B_path, C_path, tile_size=TILE_SIZE):
+    """ multiplies the matrix files A and B into the matrix file C, one tile at a time
+        returns C as a read-only MappedMatrix """
+    A, B = _open_operands(A_path, B_path, C_path)
+    try:
+        with MappedMatrix(C_path, writable=True) as C:
+            for row_start, row_end, col_start, col_end in _tiles(A.num_rows, B.num_cols, tile_size):
+                C_tile = _tile_product(A, B, row_start, row_end, col_start, col_end, tile_size)
+                C.write_tile(row_start, col_start, C_tile, row_end - row_start, col_end - col_start)
+            C.flush()
+    finally:
+        A.close()
+        B.close()
+    return MappedMatrix(C_path)
+
+
+def par_out_of_core_multiply(A_path, B_path, C_path, tile_size=TILE_SIZE, workers=None, prefetch=PREFETCH_DEPTH):
+    """ multiplies the matrix files A and B into the matrix file C on a process pool,
+        with an I/O thread prefetching the tiles of upcoming tasks
+        returns C as a read-only MappedMatrix """
+    num_workers = workers or effective_cpu_count()
+    A, B = _open_operands(A_path, B_path, C_path)
+    tasks = queue.Queue(maxsize=prefetch * num_workers)
+    stop = threading.Event()
+    # an exception of the I/O thread, re-raised in the main thread
+    errors = []
+
+    def put(tile):
+        # waits while the queue is full, unless the main thread has given up
+        while not stop.is_set():
+            try:
+                tasks.put(tile, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def prefetch_tiles():
+        panel = None
+        try:
+            for tile in _tiles(A.num_rows, B.num_cols, tile_size):
+                row_start, row_end, col_start, col_end = tile
+                A.prefetch(row_start, row_end, 0, A.num_cols)
+                if panel != (col_start, col_end):
+                    panel = (col_start, col_end)
+                    B.prefetch(0, B.num_rows, col_start, col_end)
+                put(tile)
+        except BaseException as exc:
+            errors.append(exc)
+        finally:
+            # the sentinel is queued however the thread ends
+            put(None)
+
+    def next_tile():
+        # polls, so that the main thread cannot wait forever on a thread that is gone
+        while True:
+            try:
+                tile = tasks.get(timeout=0.1)
+            except queue.Empty:
+                if io_thread.is_alive() or not tasks.empty():
+                    continue
+                tile = None
+            if tile is None and errors:
+                raise errors[0]
+            return tile
+
+    io_thread = threading.Thread(target=prefetch_tiles)
+    io_thread.start()
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            in_flight = set()
+            tile = next_tile()
+            while tile is not None:
+                in_flight.add(pool.submit(_par_worker, A_path, B_path, C_path, *tile, tile_size))
+                # keeps a bounded number of tasks submitted, so the pool does not run ahead of the I/O thread
+                if len(in_flight) >= 2 * num_workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        f.result()
+                tile = next_tile()
+            for f in in_flight:
+                f.result()
+    finally:
+        stop.set()
+        io_thread.join()
+        A.close()
+        B.close()
+    # the workers wrote through their own mappings; make sure the result reaches the disk
+    with open(C_path, 'r+b') as f:
+        os.fsync(f.fileno())
+    return MappedMatrix(C_path)
+
+
+if __name__ == '__main__':
+    NUM_EVAL_RUNS = 1
+    SIZE = 2048 if np is not None else 256
+    TILE = TILE_SIZE if np is not None else 64
+
+    with tempfile.TemporaryDirectory() as directory:
+        A_path, B_path = os.path.join(directory, 'A.mat'), os.path.join(directory, 'B.mat')
+        C_seq_path, C_par_path = os.path.join(directory, 'C_seq.mat'), os.path.join(directory, 'C_par.mat')
+        random_matrix_file(A_path, SIZE, SIZE, seed=1)
+        random_matrix_file(B_path, SIZE, SIZE, seed=2)
+        data_mb = 3 * 8 * SIZE * SIZE / 2 ** 20
+
+        print(f'Evaluating Sequential Out-of-Core Implementation on {SIZE}x{SIZE} ({data_mb:.0f} MB of files)...')
+        sequential_time = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            seq_out_of_core_multiply(A_path, B_path, C_seq_path, tile_size=TILE).close()
+            sequential_time += time.perf_counter() - start
+        sequential_time /= NUM_EVAL_RUNS
+
+        print(f'Evaluating Parallel Out-of-Core Implementation on {SIZE}x{SIZE}...')
+        parallel_time = 0
+        for i in range(NUM_EVAL_RUNS):
+            start = time.perf_counter()
+            par_out_of_core_multiply(A_path, B_path, C_par_path, tile_size=TILE).close()
+            parallel_time += time.perf_counter() - start
+        parallel_time /= NUM_EVAL_RUNS
+
+        with MappedMatrix(C_seq_path) as C_seq, MappedMatrix(C_par_path) as C_par:
+            # both compute every tile with the same kernel in the same K order
+            if C_seq.view != C_par.view:
+                raise Exception('sequential_result and parallel_result do not match.')
+        print('Average Sequential Time: {:.2f} ms ({:.1f} MB/s)'.format(
+            sequential_time * 1000, data_mb / sequential_time))
+        print('Average Parallel Time: {:.2f} ms ({:.1f} MB/s)'.format(parallel_time * 1000, data_mb / parallel_time))
+        print('Speedup: {:.2f}'.format(sequential_time / parallel_time))
+        print('Efficiency: {:.2f}%'.format(100 * (sequential_time / parallel_time) / effective_cpu_count()))
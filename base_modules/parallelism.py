@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+""" How many workers this process can really use """
+
+"""
+Effective parallelism
+
+mp.cpu_count() is the number of CPUs of the host. A Kubernetes pod limited to 4 CPUs on a 64-core node still sees 64,
+so a pool sized from it starts 64 busy processes that share 4 CPUs of quota. The kernel then throttles the whole
+cgroup for most of every scheduling period, which is far slower than running 4 workers. The executor defaults
+are sized from the same number and have the same problem.
+
+effective_cpu_count() takes the smallest of:
+    1. the CPUs this process may run on, from os.sched_getaffinity (taskset, cpusets)
+    2. the CPU quota of its cgroup, rounded down and at least 1:
+           cgroup v2 - cpu.max holds "<quota> <period>", or "max <period>" when there is no limit
+           cgroup v1 - cpu.cfs_quota_us / cpu.cfs_period_us of the cpu controller, where -1 means no limit
+       The cgroup of this process comes from /proc/self/cgroup. Every ancestor cgroup up to the root is checked,
+       since a limit on any of them applies
+and the MTP_NUM_WORKERS environment variable overrides all of it when it is set.
+
+Every pool and benchmark in this project sizes itself with effective_cpu_count(), and thread pools use
+thread_pool_workers(), the ThreadPoolExecutor default computed from the effective count.
+
+Worker placement
+----------------
+Left alone, the scheduler moves worker processes between cores. A worker that moves leaves its cache behind, and
+two workers that land on the hyperthread siblings of one core share its execution units while another core idles.
+A placement pins worker i to one CPU with os.sched_setaffinity, using the topology in /sys/devices/system/cpu:
+    compact  - fill one core after another, hyperthread siblings next to each other, one package at a time, so
+               workers share caches
+    scatter  - round-robin over packages and then cores, using hyperthread siblings only once every core has a
+               worker, so workers get as much cache and memory bandwidth each as possible
+    physical - one hyperthread of each physical core only; more workers than cores wrap around
+Only CPUs in the affinity mask of this process are used. A worker pins itself before it does any work, so the pages
+it touches first and the caches it warms are those of its own CPU. placed_process_pool() pins the workers of a
+ProcessPoolExecutor through its initializer, and any function that takes a pool accepts one. placed_process()
+does the same for a single mp.Process. par_merge_sort, par_matrix_multiply and BSPEngine.par also take a placement
+argument directly.
+"""
+
+import functools
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+ENV_VAR = 'MTP_NUM_WORKERS'
+CGROUP_ROOT = '/sys/fs/cgroup'
+CPU_ROOT = '/sys/devices/system/cpu'
+PLACEMENTS = ('compact', 'scatter', 'physical')
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_paths():
+    """ {controller: path} of this process from /proc/self/cgroup; the cgroup v2 path is under the key '' """
+    paths = {}
+    for line in (_read('/proc/self/cgroup') or '').splitlines():
+        hierarchy_id, controllers, path = line.split(':', 2)
+        for controller in controllers.split(','):
+            paths[controller] = path
+    return paths
+
+
+def _ancestors(mount, path):
+    """ the directories of a cgroup and of every ancestor up to the mount point, most specific first """
+    directories = []
+    path = path.strip('/')
+    while True:
+        directory = os.path.join(mount, path) if path else mount
+        if os.path.isdir(directory):
+            directories.append(directory)
+        if not path:
+            return directories
+        path = os.path.dirname(path)
+
+
+def _v2_limit(path):
+    limits = []
+    for directory in _ancestors(CGROUP_ROOT, path):
+        fields = (_read(os.path.join(directory, 'cpu.max')) or '').split()
+        if len(fields) == 2 and fields[0] != 'max':
+            limits.append(int(fields[0]) / int(fields[1]))
+    return min(limits, default=None)
+
+
+def _v1_limit(path):
+    limits = []
+    for mount in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        for directory in _ancestors(os.path.join(CGROUP_ROOT, mount), path):
+            quota = _read(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(directory, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0:
+                limits.append(int(quota) / int(period))
+    return min(limits, default=None)
+
+
+@functools.lru_cache(maxsize=None)
+def cgroup_cpu_limit():
+    """ the CPU quota of this process's cgroup in CPUs (2.5 for 250ms per 100ms period), or None if unlimited """
+    paths = _cgroup_paths()
+    limits = []
+    if '' in paths:
+        limits.append(_v2_limit(paths['']))
+    if 'cpu' in paths:
+        limits.append(_v1_limit(paths['cpu']))
+    return min((limit for limit in limits if limit is not None), default=None)
+
+
+def affinity_cpu_count():
+    """ the number of CPUs this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def effective_cpu_count():
+    """ the number of CPUs this process can keep busy: MTP_NUM_WORKERS if it is set, otherwise the smaller of the
+        affinity mask and the cgroup CPU quota """
+    override = os.environ.get(ENV_VAR)
+    if override:
+        try:
+            count = int(override)
+        except ValueError:
+            raise ValueError(f'{ENV_VAR} must be a positive integer, not {override!r}') from None
+        if count < 1:
+            raise ValueError(f'{ENV_VAR} must be a positive integer, not {override!r}')
+        return count
+    count = affinity_cpu_count()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, max(1, int(limit)))
+    return count
+
+
+def thread_pool_workers():
+    """ ThreadPoolExecutor's default worker count, min(32, cpus + 4), computed from the effective CPU count """
+    return min(32, effective_cpu_count() + 4)
+
+
+def cpu_topology():
+    """ (cpu, package, core, thread) of every CPU this process may run on; thread numbers the hyperthread
+        siblings of a core from 0. Without sysfs every CPU is its own core in package 0 """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    cores = {}
+    for cpu in cpus:
+        topology = os.path.join(CPU_ROOT, f'cpu{cpu}', 'topology')
+        package = _read(os.path.join(topology, 'physical_package_id'))
+        core = _read(os.path.join(topology, 'core_id'))
+        key = (int(package), int(core)) if package is not None and core is not None else (0, cpu)
+        cores.setdefault(key, []).append(cpu)
+    return sorted((cpu, package, core, thread) for (package, core), siblings in cores.items()
+                  for thread, cpu in enumerate(sorted(siblings)))
+
+
+def placement_cpus(placement):
+    """ the CPUs, in the order workers 0, 1, 2 ... are pinned to them, for one of PLACEMENTS """
+    if placement not in PLACEMENTS:
+        raise ValueError(f'Unknown placement {placement!r}; expected one of {PLACEMENTS}')
+    topology = cpu_topology()
+    if placement == 'compact':
+        order = sorted(topology, key=lambda t: (t[1], t[2], t[3]))
+    else:
+        # number the cores within each package, so that scatter can alternate packages core by core
+        core_ranks = {}
+        for cpu, package, core, thread in sorted(topology, key=lambda t: (t[1], t[2])):
+            core_ranks.setdefault((package, core), len([key for key in core_ranks if key[0] == package]))
+        order = sorted(topology, key=lambda t: (t[3], core_ranks[t[1], t[2]], t[1]))
+        if placement == 'physical':
+            order = [t for t in order if t[3] == 0]
+    return [t[0] for t in order]
+
+
+def pin_process(pid, index, cpus):
+    """ pins process pid, worker number index, to its CPU in a placement_cpus list """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, {cpus[index % len(cpus)]})
+
+
+def _pin_worker(cpus, counter):
+    """ pool initializer: pins each new worker to the next CPU of the placement """
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    pin_process(0, index, cpus)
+
+
+def _placed_target(target, index, cpus, *args):
+    """ process target: pins this process, then runs the real target """
+    pin_process(0, index, cpus)
+    return target(*args)
+
+
+def placed_process(target, args=(), index=0, placement=None):
+    """ an mp.Process running target(*args) that first pins itself to the CPU of worker number index in the
+        placement; placement=None leaves it to the scheduler """
+    if placement is None:
+        return mp.Process(target=target, args=args)
+    return mp.Process(target=_placed_target, args=(target, index, placement_cpus(placement)) + tuple(args))
+
+
+def placed_process_pool(max_workers=None, placement=None):
+    """ a ProcessPoolExecutor of max_workers workers (effective_cpu_count() by default), each pinned to one
+        CPU by the placement; placement=None leaves them to the scheduler """
+    max_workers = max_workers or effective_cpu_count()
+    if placement is None:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=_pin_worker,
+                               initargs=(placement_cpus(placement), mp.Value('i', 0)))
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from base_modules.matrix_multiplier import par_matrix_multiply
+    from base_modules.merge_sort import par_merge_sort
+
+    NUM_EVAL_RUNS = 3
+    NUM_WORKERS = effective_cpu_count()
+    MATRIX_SIZE = 300
+    SORT_SIZE = 1_000_000
+
+    limit = cgroup_cpu_limit()
+    print(f'{"host CPUs":>20}: {os.cpu_count()}')
+    print(f'{"affinity":>20}: {affinity_cpu_count()}')
+    print(f'{"cgroup quota":>20}: {"unlimited" if limit is None else f"{limit:g} CPUs"}')
+    print(f'{ENV_VAR:>20}: {os.environ.get(ENV_VAR, "not set")}')
+    print(f'{"effective":>20}: {effective_cpu_count()}')
+    for placement in PLACEMENTS:
+        print(f'{placement:>20}: CPUs {placement_cpus(placement)}')
+
+    A = [[random.random() for i in range(MATRIX_SIZE)] for j in range(MATRIX_SIZE)]
+    values = [random.randint(0, 10_000) for i in range(SORT_SIZE)]
+    workloads = (('matmul', lambda placement: par_matrix_multiply(A, A, workers=NUM_WORKERS, placement=placement)),
+                 ('sort', lambda placement: par_merge_sort(values.copy(), workers=NUM_WORKERS, placement=placement)))
+    print(f'{"placement":>10} ' + ' '.join(f'{name:>12}' for name, run in workloads))
+    for placement in (None,) + PLACEMENTS:
+        times = []
+        for name, run in workloads:
+            run(placement)  # "warm up"
+            start = time.perf_counter()
+            for i in range(NUM_EVAL_RUNS):
+                run(placement)
+            times.append((time.perf_counter() - start) / NUM_EVAL_RUNS)
+        print(f'{placement or "none":>10} ' + ' '.join(f'{elapsed * 1000:9.2f} ms' for elapsed in times))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+""" Parallel inclusive and exclusive scans (prefix sums) over shared arrays """
+
+"""
+Prefix sum
+
+divide_and_conquer.py reduces many values to one. A scan keeps every intermediate result instead: cumulative revenue
+per day, a running count of conversions. The inclusive scan of x0, x1, x2 ... with an operator op is
+    x0, op(x0, x1), op(op(x0, x1), x2) ...
+which is what itertools.accumulate returns. The exclusive scan starts from an initial value and leaves each element
+out of its own result:
+    initial, op(initial, x0), op(op(initial, x0), x1) ...
+
+Each output depends on all the inputs before it, so a scan looks sequential, but for an associative operator it can
+be done in two parallel passes over blocks of the array:
+    1. local scan  - every worker scans its own block into the output and returns the block's total. An exclusive
+                     scan writes its block one place to the right, so no pass has to shift the results
+    2. offsets     - the parent scans the few block totals, which gives the combined total of everything before
+                     each block
+    3. fix up      - every worker combines the offset of its block into its local results; an exclusive scan also
+                     puts the offset in the first place of the block
+Both passes read and write the input and output in shared memory, so only the block totals travel between processes.
+An offset that is the identity of op (0 for add, 1 for mul) leaves a block as it is. The sequential version scans
+one block straight from the initial value, in a single pass, so it also accepts an operator that is not associative.
+The parallel version touches every element twice, which makes its best speedup on p workers about p/2 for a
+memory-bound operator like add.
+
+Input and output are SharedArrays; anything else is copied into one first. With NumPy, add, mul, max, min and the
+bitwise operators run as ufunc accumulates; any other operator, and everything without NumPy, runs through
+itertools.accumulate. Integer results are exactly those of itertools.accumulate, provided they fit in the typecode.
+Floating point results can differ in the last bits, because the offsets are added to each block separately.
+"""
+
+import operator
+import random
+import time
+from array import array as typed_array
+from itertools import accumulate
+
+from base_modules.calibration import MachineProfile
+from base_modules.merge_sort import _InlineExecutor, _typecode_of
+from base_modules.parallelism import effective_cpu_count, placed_process_pool
+from base_modules.shared_arrays import SharedArray
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; blocks are scanned with itertools.accumulate without it
+    np = None
+
+# operators that run as NumPy ufuncs
+UFUNCS = {operator.add: 'add', operator.mul: 'multiply', max: 'maximum', min: 'minimum',
+          operator.and_: 'bitwise_and', operator.or_: 'bitwise_or', operator.xor: 'bitwise_xor'}
+# initial values of exclusive scans when none is given
+IDENTITIES = {operator.add: 0, operator.mul: 1, operator.or_: 0, operator.xor: 0}
+
+
+def _ufunc(op):
+    name = UFUNCS.get(op) if np is not None else None
+    return getattr(np, name) if name is not None else None
+
+
+def _local_scan(src, dst, start, end, op, inclusive, initial=None):
+    """ pool worker: scan of src[start:end] into dst[start:end]; returns the block total
+        the inclusive scan of the block goes to dst[start:end]; an exclusive scan writes it one place to the right,
+        to dst[start + 1:end], and leaves dst[start] to the second pass
+        with initial, the block is scanned from initial like itertools.accumulate and needs no second pass; seq_scan
+        scans its one block this way, so any op gives accumulate's result """
+    ufunc = _ufunc(op)
+    if ufunc is not None and initial is not None:
+        # ufuncs are associative, so combining initial afterwards gives the same result
+        total = _local_scan(src, dst, start, end, op, inclusive)
+        _add_offset(dst, start, end, op, initial, inclusive)
+        return op(initial, total)
+    if ufunc is not None:
+        block, out = src.as_ndarray()[start:end], dst.as_ndarray()[start:end]
+        if inclusive:
+            ufunc.accumulate(block, out=out)
+            total = out[-1].item()
+        else:
+            # read the last element first, since out can be the same memory as block
+            last = block[-1].item()
+            ufunc.accumulate(block[:-1], out=out[1:])
+            total = op(out[-1].item(), last) if end - start > 1 else last
+        del block, out
+        return total
+    values = list(accumulate(src.view[start:end].tolist(), op, initial=initial))
+    if initial is not None:
+        # accumulate starts with initial itself
+        dst.view[start:end] = typed_array(dst.typecode, values[1:] if inclusive else values[:-1])
+    elif inclusive:
+        dst.view[start:end] = typed_array(dst.typecode, values)
+    else:
+        dst.view[start + 1:end] = typed_array(dst.typecode, values[:-1])
+    return values[-1]
+
+
+def _add_offset(dst, start, end, op, offset, inclusive):
+    """ pool worker: combines offset, the total of everything before the block, into the local scan of the block;
+        an exclusive scan also starts the block with offset """
+    first = start
+    if not inclusive:
+        dst.view[start] = offset
+        first = start + 1
+    if op in IDENTITIES and offset == IDENTITIES[op]:
+        return
+    ufunc = _ufunc(op)
+    if ufunc is not None:
+        out = dst.as_ndarray()[first:end]
+        ufunc(offset, out, out=out)
+        del out
+        return
+    dst.view[first:end] = typed_array(dst.typecode, [op(offset, value) for value in dst.view[first:end].tolist()])
+
+
+def _scan(values, op, inclusive, initial, typecode, out, as_list, pool, num_blocks):
+    if not inclusive and initial is None:
+        if op not in IDENTITIES:
+            raise ValueError('an exclusive scan with this operator needs an initial value')
+        initial = IDENTITIES[op]
+    typecode = typecode or (values.typecode if isinstance(values, SharedArray) else _typecode_of(values))
+    size = len(values)
+    own_src, own_dst = not isinstance(values, SharedArray), out is None
+    src = SharedArray(typecode, values) if own_src else values
+    dst = SharedArray(typecode, size) if own_dst else out
+    try:
+        if size:
+            bounds = [size * b // num_blocks for b in range(num_blocks + 1)]
+            blocks = [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+        if size and len(blocks) == 1:
+            # a single block is scanned straight from initial, without a second pass
+            pool.submit(_local_scan, src, dst, 0, size, op, inclusive, initial).result()
+        elif size:
+            # 1. local scans, one block per task
+            totals = [f.result() for f in [pool.submit(_local_scan, src, dst, start, end, op, inclusive)
+                                           for start, end in blocks]]
+            # 2. the offset of each block is the exclusive scan of the block totals
+            offsets = [initial]
+            for total in totals[:-1]:
+                offsets.append(total if offsets[-1] is None else op(offsets[-1], total))
+            # 3. fix up every block that has something before it
+            for f in [pool.submit(_add_offset, dst, start, end, op, offset, inclusive)
+                      for (start, end), offset in zip(blocks, offsets) if offset is not None]:
+                f.result()
+        if not own_dst:
+            return out
+        result = typed_array(typecode, dst.view)
+    finally:
+        if own_src:
+            src.close()
+        if own_dst:
+            dst.close()
+    if as_list:
+        return result.tolist()
+    return np.frombuffer(result, dtype=typecode) if np is not None else result
+
+
+def seq_scan(values, op=operator.add, inclusive=True, initial=None, typecode=None, out=None, as_list=False):
+    """ scan of values with op in this process; op can be any function of two arguments, as in
+        itertools.accumulate, while par_scan needs an associative one
+        inclusive - True for itertools.accumulate(values, op, initial=initial) without its leading initial,
+                    False for the exclusive scan, which starts with initial (the identity of op by default)
+        typecode  - typecode of the results; inferred from the input by default
+        out       - a SharedArray to write the results to, returned instead of a new array; may be values itself
+        returns an ndarray, or an array.array without NumPy, or a list if as_list=True """
+    return _scan(values, op, inclusive, initial, typecode, out, as_list, _InlineExecutor(), 1)
+
+
+def par_scan(values, op=operator.add, inclusive=True, initial=None, typecode=None, out=None, as_list=False,
+             pool=None, workers=None, placement=None):
+    """ two-pass blocked scan of values with op on a pool of worker processes; op must be associative
+        takes the same arguments as seq_scan; pass pool to reuse a running ProcessPoolExecutor, or placement to
+        pin the workers of the pool started here """
+    typecode = typecode or (values.typecode if isinstance(values, SharedArray) else _typecode_of(values))
+    profile = MachineProfile.load()
+    if workers:
+        num_workers, num_blocks = workers, profile.chunks(len(values), workers, 'scan')
+    else:
+        # copying a list in and the results out of shared memory is part of the parallel cost
+        transfer_cost = 0 if isinstance(values, SharedArray) else 2 * profile.shm_cost * typed_array(typecode).itemsize
+        plan = profile.plan(len(values), 'scan', transfer_cost, effective_cpu_count(), pooled=pool is not None)
+        if not plan.parallel:
+            return seq_scan(values, op, inclusive, initial, typecode, out, as_list)
+        num_workers, num_blocks = plan.workers, plan.num_chunks
+    if pool is not None:
+        return _scan(values, op, inclusive, initial, typecode, out, as_list, pool, num_blocks)
+    with placed_process_pool(num_workers, placement) as pool:
+        return _scan(values, op, inclusive, initial, typecode, out, as_list, pool, num_blocks)
+
+
+if __name__ == '__main__':
+    NUM_EVAL_RUNS = 3
+    SIZE = 10 ** 8 if np is not None else 10 ** 6
+    CHECK_SIZE = 10 ** 6
+    NUM_WORKERS = effective_cpu_count()
+
+    print(f'Generating {SIZE:,} random daily revenues in shared memory...')
+    revenues = SharedArray('q', SIZE)
+    if np is not None:
+        revenues.as_ndarray()[:] = np.random.default_rng().integers(0, 1000, SIZE)
+    else:
+        revenues.load([random.randint(0, 1000) for i in range(SIZE)])
+    cumulative = SharedArray('q', SIZE)
+
+    # correctness against itertools.accumulate on a prefix
+    sample = revenues.view[:CHECK_SIZE].tolist()
+    for inclusive in (True, False):
+        for op in (operator.add, max):
+            expected = list(accumulate(sample, op, initial=None if inclusive else 0))
+            expected = expected if inclusive else expected[:-1]
+            if par_scan(sample, op, inclusive, 0 if not inclusive else None, as_list=True,
+                        workers=max(2, NUM_WORKERS)) != expected:
+                raise Exception('par_scan and itertools.accumulate results do not match.')
+
+    for inclusive in (True, False):
+        name = 'inclusive' if inclusive else 'exclusive'
+        print(f'Evaluating {name} scans...')
+        timings = {}
+        results = {}
+        with placed_process_pool(NUM_WORKERS) as pool:
+            for engine, func, kwargs in (('sequential', seq_scan, {}),
+                                         ('parallel', par_scan, {'pool': pool, 'workers': NUM_WORKERS})):
+                func(revenues, inclusive=inclusive, out=cumulative, **kwargs)  # "warm up"
+                start = time.perf_counter()
+                for i in range(NUM_EVAL_RUNS):
+                    func(revenues, inclusive=inclusive, out=cumulative, **kwargs)
+                timings[engine] = (time.perf_counter() - start) / NUM_EVAL_RUNS
+                results[engine] = cumulative.view[-CHECK_SIZE:].tolist()
+        if results['sequential'] != results['parallel']:
+            raise Exception('sequential_result and parallel_result do not match.')
+        print('Average Sequential Time: {:.2f} ms'.format(timings['sequential'] * 1000))
+        print('Average Parallel Time: {:.2f} ms'.format(timings['parallel'] * 1000))
+        print('Speedup: {:.2f}'.format(timings['sequential'] / timings['parallel']))
+        print('Efficiency: {:.2f}%'.format(100 * (timings['sequential'] / timings['parallel']) / NUM_WORKERS))
+    revenues.close()
+    cumulative.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+""" Parallel counting and LSD radix sort for bounded integer keys """
+
+"""
+Radix sort
+
+The merge_sort.py benchmark sorts a million integers between 0 and 10,000. A comparison sort needs about
+n log2(n) = 20 million comparisons for that, no matter how few distinct values there are. When the keys are integers
+in a known range, a sort can count them instead of comparing them.
+
+Counting sort (the whole key range fits in one digit of RADIX_BITS bits):
+    1. histogram - every worker counts how often each key occurs in its chunk of the shared input
+    2. prefix sum - the parent adds up the histograms; the running total of the counts is where each key starts
+    3. fill       - the output is split into ranges of keys holding about the same number of elements, and every
+                    worker writes each key of its range count times, straight into the shared output
+
+LSD radix sort (wider key ranges):
+The keys, minus the smallest key, are split into digits of RADIX_BITS bits, and the array is sorted by one digit per
+pass, least significant first. Each pass:
+    1. histogram - every worker counts the digits of its chunk
+    2. prefix sum - the parent turns the per-worker histograms into a write position for every (worker, digit):
+                    all smaller digits of all workers come first, then the same digit of all earlier workers
+    3. scatter    - every worker moves its elements to their positions in the other shared buffer, in order, so
+                    each pass is stable and the order established by earlier digits is kept
+The two buffers swap roles after every pass.
+
+par_sort is the dispatcher. It uses the radix engine for integer keys whose range needs few enough passes for the
+size of the input, and par_merge_sort otherwise. Integers come out in exactly the order seq_merge_sort gives.
+"""
+
+import math
+import random
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+from base_modules.merge_sort import _InlineExecutor, par_merge_sort, seq_merge_sort, sort_plan
+from base_modules.shared_arrays import SharedArray
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; histograms and scatters run in pure Python without it
+    np = None
+
+RADIX_BITS = 16
+# a radix pass costs about as much as this many levels of merging
+PASS_COST = 4
+
+
+def _digits(values, lo, shift, mask):
+    if np is not None:
+        return ((values - lo) >> shift) & mask
+    return [((value - lo) >> shift) & mask for value in values]
+
+
+def _histogram(src, start, end, lo, shift, mask):
+    """ pool worker: counts the digits of src[start:end] """
+    if np is not None:
+        chunk = src.as_ndarray()[start:end]
+        counts = np.bincount(_digits(chunk, lo, shift, mask), minlength=mask + 1)
+        del chunk
+        return counts
+    counts = [0] * (mask + 1)
+    for digit, count in Counter(_digits(src.view[start:end].tolist(), lo, shift, mask)).items():
+        counts[digit] = count
+    return counts
+
+
+def _scatter(src, dst, start, end, lo, shift, mask, positions):
+    """ pool worker: stably moves src[start:end] to dst, starting each digit at its position """
+    if np is not None:
+        chunk = src.as_ndarray()[start:end]
+        digits = _digits(chunk, lo, shift, mask)
+        order = np.argsort(digits, kind='stable')
+        sorted_digits = digits[order]
+        # rank of every element among the elements of this chunk with the same digit
+        counts = np.bincount(digits, minlength=mask + 1)
+        ranks = np.arange(len(chunk)) - (np.cumsum(counts) - counts)[sorted_digits]
+        out = dst.as_ndarray()
+        out[np.asarray(positions)[sorted_digits] + ranks] = chunk[order]
+        del chunk, out
+        return
+    positions = list(positions)
+    out = dst.view
+    for value in src.view[start:end].tolist():
+        digit = ((value - lo) >> shift) & mask
+        out[positions[digit]] = value
+        positions[digit] += 1
+
+
+def _fill(dst, lo, first_key, counts, out_start):
+    """ pool worker: writes key lo + first_key + b counts[b] times for every b, from out_start onwards """
+    if np is not None:
+        out = dst.as_ndarray()
+        values = np.repeat(np.arange(first_key, first_key + len(counts), dtype='q') + lo, counts)
+        out[out_start:out_start + len(values)] = values
+        del out
+        return
+    position = out_start
+    for key, count in enumerate(counts, lo + first_key):
+        if count:
+            dst.view[position:position + count] = array('q', [key]) * count
+            position += count
+
+
+def radix_passes(lo, hi):
+    """ the number of RADIX_BITS digit passes needed for keys in lo..hi """
+    return max(1, math.ceil((hi - lo).bit_length() / RADIX_BITS))
+
+
+def _key_range(array_):
+    """ (lo, hi) of the keys as Python ints, so that hi - lo neither overflows nor lacks int methods """
+    if np is not None and isinstance(array_, np.ndarray):
+        return int(array_.min()), int(array_.max())
+    return int(min(array_)), int(max(array_))
+
+
+def _is_integer_array(array_):
+    if isinstance(array_, array):
+        return array_.typecode in 'bBhHiIlLqQ'
+    if np is not None and isinstance(array_, np.ndarray):
+        return array_.dtype.kind in 'iu'
+    return all(isinstance(value, int) for value in array_)
+
+
+def _radix_sort(array_, pool, num_workers):
+    if not len(array_):
+        return array_
+    lo, hi = _key_range(array_)
+    if hi - lo >= 2 ** 63:
+        raise ValueError('radix sort needs keys that fit in a signed 64-bit range')
+    src = SharedArray('q', array_)
+    dst = SharedArray('q', len(array_))
+    try:
+        bounds = [len(array_) * w // num_workers for w in range(num_workers + 1)]
+        chunks = list(zip(bounds, bounds[1:]))
+        mask = 2 ** RADIX_BITS - 1
+        passes = radix_passes(lo, hi)
+        for digit in range(passes):
+            shift = digit * RADIX_BITS
+            histograms = [f.result() for f in [pool.submit(_histogram, src, start, end, lo, shift, mask)
+                                               for start, end in chunks]]
+            # prefix sum: the first output position of every digit
+            if np is not None:
+                histograms = np.array(histograms)
+                totals = histograms.sum(axis=0)
+                digit_starts = np.cumsum(totals) - totals
+            else:
+                totals = [sum(counts) for counts in zip(*histograms)]
+                digit_starts = [0] + list(accumulate(totals))[:-1]
+
+            if passes == 1:
+                # counting sort: split the keys into ranges of about len/num_workers elements and fill them
+                ranges = []
+                key_start = 0
+                ends = list(accumulate(totals))
+                for w in range(1, num_workers + 1):
+                    target = len(array_) * w // num_workers
+                    key_end = key_start
+                    while key_end < len(totals) and (key_end == key_start or ends[key_end - 1] < target):
+                        key_end += 1
+                    if w == num_workers:
+                        key_end = len(totals)
+                    if key_end > key_start:
+                        ranges.append((key_start, key_end, digit_starts[key_start]))
+                    key_start = key_end
+                for f in [pool.submit(_fill, dst, lo, key_start, totals[key_start:key_end], out_start)
+                          for key_start, key_end, out_start in ranges]:
+                    f.result()
+            else:
+                # each worker's digit d starts after all smaller digits and after digit d of earlier workers
+                if np is not None:
+                    positions = digit_starts + np.cumsum(histograms, axis=0) - histograms
+                else:
+                    positions = []
+                    running = list(digit_starts)
+                    for counts in histograms:
+                        positions.append(list(running))
+                        running = [position + count for position, count in zip(running, counts)]
+                for f in [pool.submit(_scatter, src, dst, start, end, lo, shift, mask, worker_positions)
+                          for (start, end), worker_positions in zip(chunks, positions)]:
+                    f.result()
+            src, dst = dst, src
+
+        # insert result into original array
+        if isinstance(array_, list):
+            array_[:] = src.view.tolist()
+        elif isinstance(array_, array):
+            array_[:] = array(array_.typecode, src.view)
+        else:
+            array_[:] = src.as_ndarray()
+    finally:
+        src.close()
+        dst.close()
+    return array_
+
+
+def seq_radix_sort(array_):
+    """ counting or LSD radix sort of integers in this process; sorts in place and returns the array """
+    return _radix_sort(array_, _InlineExecutor(), 1)
+
+
+def par_radix_sort(array_, pool=None, workers=None):
+    """ counting or LSD radix sort of integers on a pool of worker processes
+        sorts a list, array.array or ndarray in place and returns it; pass pool to reuse a running
+        ProcessPoolExecutor """
+    plan = sort_plan(len(array_), 'q', workers, pooled=pool is not None)
+    num_workers = workers or plan.workers
+    if not plan.parallel:
+        return seq_radix_sort(array_)
+    if pool is not None:
+        return _radix_sort(array_, pool, num_workers)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return _radix_sort(array_, pool, num_workers)
+
+
+def choose_sort_engine(array_):
+    """ 'radix' for integer keys whose range needs few passes for the input size, otherwise 'merge' """
+    if len(array_) < 2 or not _is_integer_array(array_):
+        return 'merge'
+    lo, hi = _key_range(array_)
+    if hi - lo >= 2 ** 63:
+        return 'merge'
+    # merging needs about log2(n) levels over the data, radix sort one pass per digit
+    if radix_passes(lo, hi) * PASS_COST <= math.log2(len(array_)):
+        return 'radix'
+    return 'merge'
+
+
+def par_sort(array_, pool=None, workers=None):
+    """ sorts in place with par_radix_sort or par_merge_sort, whichever choose_sort_engine picks """
+    if choose_sort_engine(array_) == 'radix':
+        return par_radix_sort(array_, pool=pool, workers=workers)
+    return par_merge_sort(array_, pool=pool, workers=workers)
+
+
+if __name__ == '__main__':
+    NUM_EVAL_RUNS = 1
+    SIZE = 1_000_000
+    KEY_RANGES = (10_000, 2 ** 32, 2 ** 62)
+
+    # integer ndarrays, including narrow dtypes whose key range would overflow in their own type
+    if np is not None:
+        for dtype in ('int64', 'int32', 'uint8'):
+            info = np.iinfo(dtype)
+            keys = np.random.default_rng().integers(info.min // 2, info.max // 2, 10_000, dtype=dtype)
+            expected = np.sort(keys)
+            for func in (seq_radix_sort, par_sort):
+                if not np.array_equal(func(keys.copy()), expected):
+                    raise Exception(f'{func.__name__} did not sort an ndarray of {dtype}.')
+            if not np.array_equal(par_radix_sort(keys.copy(), workers=2), expected):
+                raise Exception(f'par_radix_sort did not sort an ndarray of {dtype}.')
+
+    for key_range in KEY_RANGES:
+        print(f'Generating Random Array of {SIZE:,} keys in [0, {key_range:,}]...')
+        values = [random.randint(0, key_range) for i in range(SIZE)]
+        print('engine picked by par_sort:', choose_sort_engine(values))
+
+        print('Evaluating Sequential Merge Sort...')
+        sequential_result = seq_merge_sort(values.copy())
+        timings = {}
+        for name, func in (('seq_merge_sort', seq_merge_sort), ('seq_radix_sort', seq_radix_sort),
+                           ('par_merge_sort', par_merge_sort), ('par_radix_sort', par_radix_sort),
+                           ('par_sort', par_sort)):
+            timings[name] = 0
+            for i in range(NUM_EVAL_RUNS):
+                values_copy = values.copy()
+                start = time.perf_counter()
+                func(values_copy)
+                timings[name] += time.perf_counter() - start
+                if values_copy != sequential_result:
+                    raise Exception(f'seq_merge_sort and {name} results do not match.')
+            timings[name] /= NUM_EVAL_RUNS
+        for name, elapsed in timings.items():
+            print('{:>15}: {:10.2f} ms  speedup {:6.2f}'.format(
+                name, elapsed * 1000, timings['seq_merge_sort'] / elapsed))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+""" Strong and weak scaling sweeps for any seq/par pair, with an Amdahl fit """
+
+"""
+Scaling benchmark
+
+measure_speedup.py explains strong scaling, weak scaling, Amdahl's law and efficiency, but its benchmark runs a single
+configuration once. This harness measures the curves those terms describe, for any pair of functions where
+par(*args, workers=p) computes the same thing as seq(*args):
+
+    strong scaling - a fixed total problem size, solved with 1, 2, 4 ... workers
+    weak scaling   - a fixed problem size per worker, so the total grows with the number of workers
+
+Every configuration gets warmup runs (pools started, pages touched, caches filled) and then several timed runs, each
+on a freshly generated input since sorts and the like work in place. Each time is reported as the mean, the standard
+deviation and a 95% confidence interval of the mean from Student's t distribution.
+
+Speedup is the mean sequential time over the mean parallel time, and efficiency is speedup divided by workers.
+From the speedups:
+    Karp-Flatt metric - the serial fraction e = (1/S - 1/p) / (1 - 1/p) measured at each p. If e grows with p, the
+                        loss comes from parallel overhead rather than from a fixed serial part
+    Amdahl fit        - the serial fraction f of 1/S = f + (1 - f)/p, least squares over all the strong points;
+                        the speedup can never exceed 1/f
+    Gustafson fit     - the serial fraction s of the scaled speedup S = p - s(p - 1) over the weak points
+
+Results are plain dicts, written with save_json, and ascii_chart draws the measured speedup next to the ideal one.
+"""
+
+import copy
+import json
+import math
+import random
+import statistics
+import sys
+import time
+
+from base_modules.parallelism import effective_cpu_count
+
+# two sided 95% critical values of Student's t distribution for 1..30 degrees of freedom
+T_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+        2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+NUM_RUNS = 5
+NUM_WARMUP = 1
+
+
+def default_worker_counts(max_workers=None):
+    """ 1, 2, 4 ... up to max_workers (the CPU count by default), always including max_workers itself """
+    max_workers = max_workers or effective_cpu_count()
+    counts = [2 ** i for i in range(max_workers.bit_length()) if 2 ** i <= max_workers]
+    return counts if counts[-1] == max_workers else counts + [max_workers]
+
+
+def summarize(times):
+    """ mean, stdev and 95% confidence interval of the mean of a list of run times """
+    mean = statistics.fmean(times)
+    stdev = statistics.stdev(times) if len(times) > 1 else 0.0
+    t = T_95[min(len(times) - 1, len(T_95)) - 1] if len(times) > 1 else 0.0
+    half_width = t * stdev / math.sqrt(len(times))
+    return {'mean': mean, 'stdev': stdev, 'ci_low': mean - half_width, 'ci_high': mean + half_width,
+            'runs': len(times), 'times': times}
+
+
+def time_runs(func, make_input, size, runs=NUM_RUNS, warmup=NUM_WARMUP, **kwargs):
+    """ summary of func(*make_input(size), **kwargs) timed runs times after warmup untimed calls
+        every call gets a fresh input """
+    for i in range(warmup):
+        func(*make_input(size), **kwargs)
+    times = []
+    for i in range(runs):
+        args = make_input(size)
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def karp_flatt(speedup, workers):
+    """ experimentally determined serial fraction for a speedup on workers processors """
+    if workers < 2:
+        return None
+    return (1 / speedup - 1 / workers) / (1 - 1 / workers)
+
+
+def amdahl_fit(points):
+    """ least squares serial fraction f of 1/S = f + (1 - f)/p over (workers, speedup) points """
+    pairs = [(1 - 1 / p, 1 / s - 1 / p) for p, s in points if p > 1]
+    denominator = sum(x * x for x, y in pairs)
+    if not denominator:
+        return None
+    return min(1.0, max(0.0, sum(x * y for x, y in pairs) / denominator))
+
+
+def gustafson_fit(points):
+    """ least squares serial fraction s of the scaled speedup S = p - s(p - 1) over (workers, speedup) points """
+    pairs = [(p - 1, p - s) for p, s in points if p > 1]
+    denominator = sum(x * x for x, y in pairs)
+    if not denominator:
+        return None
+    return min(1.0, max(0.0, sum(x * y for x, y in pairs) / denominator))
+
+
+def _point(workers, sequential, parallel):
+    speedup = sequential['mean'] / parallel['mean']
+    return {'workers': workers, 'sequential': sequential, 'parallel': parallel, 'speedup': speedup,
+            'efficiency': speedup / workers, 'karp_flatt': karp_flatt(speedup, workers)}
+
+
+def _check(seq, par, make_input, size, workers):
+    """ runs seq and par on copies of the same input and compares the results """
+    args = make_input(size)
+    if seq(*copy.deepcopy(args)) != par(*copy.deepcopy(args), workers=workers):
+        raise Exception(f'{par.__name__}: sequential and parallel results do not match with {workers} workers.')
+
+
+def strong_scaling(seq, par, make_input, size, worker_counts=None, runs=NUM_RUNS, warmup=NUM_WARMUP, check=True):
+    """ times par(*make_input(size), workers=p) for every p in worker_counts against seq on the same size
+        make_input(size) returns the argument tuple; with check, seq and par must give equal results on it """
+    worker_counts = worker_counts or default_worker_counts()
+    sequential = time_runs(seq, make_input, size, runs, warmup)
+    points = []
+    for workers in worker_counts:
+        if check:
+            _check(seq, par, make_input, size, workers)
+        parallel = time_runs(par, make_input, size, runs, warmup, workers=workers)
+        points.append(_point(workers, sequential, parallel))
+    return {'kind': 'strong', 'seq': seq.__name__, 'par': par.__name__, 'size': size, 'points': points,
+            'serial_fraction': amdahl_fit([(point['workers'], point['speedup']) for point in points])}
+
+
+def weak_scaling(seq, par, make_input, size_per_worker, worker_counts=None, runs=NUM_RUNS, warmup=NUM_WARMUP,
+                 check=True):
+    """ times par with workers=p on a problem of size_per_worker * p for every p in worker_counts,
+        against seq on the same size; weak_efficiency compares each parallel time with the one for one worker """
+    worker_counts = worker_counts or default_worker_counts()
+    points = []
+    for workers in worker_counts:
+        size = size_per_worker * workers
+        if check:
+            _check(seq, par, make_input, size, workers)
+        sequential = time_runs(seq, make_input, size, runs, warmup)
+        parallel = time_runs(par, make_input, size, runs, warmup, workers=workers)
+        point = _point(workers, sequential, parallel)
+        point['size'] = size
+        point['weak_efficiency'] = points[0]['parallel']['mean'] / parallel['mean'] if points else 1.0
+        points.append(point)
+    return {'kind': 'weak', 'seq': seq.__name__, 'par': par.__name__, 'size_per_worker': size_per_worker,
+            'points': points,
+            'serial_fraction': gustafson_fit([(point['workers'], point['speedup']) for point in points])}
+
+
+def save_json(results, path):
+    """ writes a list of strong_scaling and weak_scaling results to path """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def report(result):
+    """ a table of one scaling result """
+    lines = ['{} scaling of {} against {} ({})'.format(
+        result['kind'], result['par'], result['seq'],
+        f"size {result['size']:,}" if result['kind'] == 'strong' else
+        f"{result['size_per_worker']:,} per worker")]
+    lines.append('{:>7} {:>12} {:>22} {:>12} {:>9} {:>11} {:>11}'.format(
+        'workers', 'seq mean', 'par mean (95% CI)', 'par stdev', 'speedup', 'efficiency', 'karp-flatt'))
+    for point in result['points']:
+        parallel = point['parallel']
+        lines.append('{:>7} {:>9.2f} ms {:>9.2f} ms [{:.2f}, {:.2f}] {:>9.2f} ms {:>9.2f} {:>10.2f}% {:>11}'.format(
+            point['workers'], point['sequential']['mean'] * 1000, parallel['mean'] * 1000, parallel['ci_low'] * 1000,
+            parallel['ci_high'] * 1000, parallel['stdev'] * 1000, point['speedup'], 100 * point['efficiency'],
+            '-' if point['karp_flatt'] is None else f"{point['karp_flatt']:.3f}"))
+    if result['serial_fraction'] is not None:
+        law = 'Amdahl' if result['kind'] == 'strong' else 'Gustafson'
+        fraction = result['serial_fraction']
+        limit = f', speedup limit {1 / fraction:.1f}' if fraction and result['kind'] == 'strong' else ''
+        lines.append(f'{law} serial fraction: {fraction:.3f}{limit}')
+    return '\n'.join(lines)
+
+
+def ascii_chart(result, width=50):
+    """ horizontal bars of the measured speedup ('#') against the ideal speedup ('|') for each worker count """
+    points = result['points']
+    top = max(max(point['speedup'] for point in points), max(point['workers'] for point in points))
+    lines = [f"{result['kind']} scaling speedup of {result['par']}, '#' measured, '|' ideal"]
+    for point in points:
+        # width + 1 slots, so the ideal mark fits even when the measured bar is empty
+        bar = ['#'] * round(width * point['speedup'] / top) + [' '] * (width + 1)
+        ideal = min(width, round(width * point['workers'] / top))
+        bar[ideal] = '|'
+        lines.append('{:>4} {} {:.2f}'.format(point['workers'], ''.join(bar[:width + 1]), point['speedup']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from base_modules.measure_speedup import par_sum, seq_sum
+    from base_modules.merge_sort import par_merge_sort, seq_merge_sort
+
+    # python -m base_modules.scaling_benchmark [results.json]
+    JSON_PATH = sys.argv[1] if len(sys.argv) > 1 else 'scaling_benchmark.json'
+    NUM_EVAL_RUNS = 3
+
+    def sum_input(size):
+        return 1, size
+
+    def sort_input(size):
+        return [random.randint(0, 10_000) for i in range(size)],
+
+    results = [strong_scaling(seq_sum, par_sum, sum_input, 20_000_000, runs=NUM_EVAL_RUNS),
+               weak_scaling(seq_sum, par_sum, sum_input, 10_000_000, runs=NUM_EVAL_RUNS),
+               strong_scaling(seq_merge_sort, par_merge_sort, sort_input, 200_000, runs=NUM_EVAL_RUNS)]
+    for result in results:
+        print(report(result))
+        print(ascii_chart(result))
+        print()
+    save_json(results, JSON_PATH)
+    print('Results written to', JSON_PATH)
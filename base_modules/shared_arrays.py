@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+""" Flat typed arrays in multiprocessing.shared_memory that pickle by name """
+
+"""
+Shared arrays
+
+Arguments passed to a worker process are normally pickled, sent down a pipe and unpickled again, so every worker
+ends up with its own private copy of the data. For large operands that copy costs more than the computation.
+
+multiprocessing.shared_memory lets one process create a named block of memory that other processes attach to.
+SharedArray puts a flat array of a single C type (an array module typecode such as 'd' or 'q') into such a block.
+When a SharedArray is pickled, only its name, typecode and length are sent; unpickling it in the worker attaches to
+the existing block. So passing a SharedArray to a process or a process pool gives the worker a zero-copy typed view
+of the same memory.
+
+The process that creates a SharedArray owns it. Calling close() in the owner also unlinks the block, and the
+operating system frees it once every process has closed its view. Views handed out with as_ndarray() point into the
+block, so they must not outlive the SharedArray they came from.
+
+flatten_rows and result_view are shared by the matrix modules: the first turns a list of rows into the flat
+row-major buffer a SharedArray is loaded from, the second gives a flat result buffer its shape again.
+"""
+
+import math
+import os
+import sys
+from array import array
+from itertools import chain
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; views are plain memoryviews without it
+    np = None
+
+# set in processes that attach to blocks through a resource tracker of their own
+_private_tracker_pid = None
+
+
+class SharedArray:
+    """ a flat, typed array placed once in multiprocessing.shared_memory """
+
+    def __init__(self, typecode, size_or_initializer):
+        self.typecode = typecode
+        itemsize = array(typecode).itemsize
+        data = None
+        if isinstance(size_or_initializer, int):
+            self.length = size_or_initializer
+        else:
+            data = _as_buffer(typecode, size_or_initializer)
+            self.length = len(data) // itemsize
+        # shared memory blocks cannot be empty
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, self.length) * itemsize)
+        self._owner = True
+        self.view = self._shm.buf.cast(typecode)[:self.length]
+        if data is not None:
+            self._shm.buf[:len(data)] = data
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def _attach(cls, name, typecode, length):
+        """ attaches to a block created by another process; used when unpickling """
+        self = cls.__new__(cls)
+        self.typecode = typecode
+        self.length = length
+        if sys.version_info >= (3, 13):
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # a process forked before the owner started its resource tracker starts a private tracker of its
+            # own, which would unlink the owner's block when this process exits; only the owner should
+            global _private_tracker_pid
+            if resource_tracker._resource_tracker._fd is None:
+                _private_tracker_pid = os.getpid()
+            self._shm = shared_memory.SharedMemory(name=name)
+            if _private_tracker_pid == os.getpid():
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._owner = False
+        self.view = self._shm.buf.cast(typecode)[:length]
+        return self
+
+    @property
+    def handle(self):
+        """ picklable (name, typecode, length) tuple for workers that cache their own attach() results """
+        return self.name, self.typecode, self.length
+
+    def __reduce__(self):
+        return SharedArray._attach, self.handle
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.view[index]
+
+    def __setitem__(self, index, value):
+        self.view[index] = value
+
+    def tolist(self):
+        return self.view.tolist()
+
+    def load(self, values, offset=0):
+        """ copies values into the block starting at element offset; returns the number of elements copied """
+        data = _as_buffer(self.typecode, values)
+        start = offset * self.view.itemsize
+        if start + len(data) > self.length * self.view.itemsize:
+            raise ValueError(f"{len(data) // self.view.itemsize} values do not fit at offset {offset} "
+                             f"of a SharedArray of length {self.length}")
+        self._shm.buf[start:start + len(data)] = data
+        return len(data) // self.view.itemsize
+
+    def as_ndarray(self, shape=None):
+        """ zero-copy ndarray over the block, or a typed memoryview when NumPy is not installed """
+        if np is None:
+            return self.view if shape is None else self.view.cast('B').cast(self.typecode, shape)
+        arr = np.frombuffer(self._shm.buf, dtype=self.typecode, count=self.length)
+        return arr if shape is None else arr.reshape(shape)
+
+    def close(self):
+        """ detaches this process; the owner also unlinks the block """
+        if self._shm is None:
+            return
+        # unlink first, so the name is freed even if an exported view keeps the mapping alive
+        if self._owner:
+            self._shm.unlink()
+            self._owner = False
+        self.view.release()
+        self._shm.close()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except (BufferError, AttributeError):
+            # an exported view is still alive, or __init__ never finished
+            pass
+
+
+def attach(handle):
+    """ attaches to the block described by SharedArray.handle """
+    return SharedArray._attach(*handle)
+
+
+def flatten_rows(rows):
+    """ row-major doubles of a list of rows or an ndarray: a flat ndarray with NumPy, otherwise an array('d') """
+    if np is not None and isinstance(rows, np.ndarray):
+        return np.ascontiguousarray(rows, dtype=np.float64).ravel()
+    return array('d', chain.from_iterable(rows))
+
+
+def result_view(flat, shape, as_list=False):
+    """ the row-major doubles in a flat buffer as an array of the given shape, without copying them
+        an ndarray with NumPy, otherwise a typed memoryview; nested lists with as_list=True """
+    if np is not None:
+        view = np.frombuffer(flat).reshape(shape)
+        return view.tolist() if as_list else view
+    if not as_list:
+        return memoryview(flat).cast('B').cast('d', shape)
+    values = memoryview(flat).cast('B').cast('d').tolist()
+    for axis in range(len(shape) - 1, 0, -1):
+        size = shape[axis]
+        values = [values[i * size:(i + 1) * size] for i in range(math.prod(shape[:axis]))]
+    return values
+
+
+def _as_buffer(typecode, values):
+    """ returns the values as a contiguous byte buffer of the given typecode """
+    if isinstance(values, array) and values.typecode == typecode:
+        return memoryview(values).cast('B')
+    if np is not None and isinstance(values, np.ndarray):
+        return memoryview(np.ascontiguousarray(values.ravel(), dtype=typecode)).cast('B')
+    return memoryview(array(typecode, values)).cast('B')
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+""" Sparse matrices in compressed sparse row (CSR) and column (CSC) form """
+
+"""
+Sparse matrix multiplication
+
+When more than 95% of the elements are zero, a dense kernel spends more than 95% of its multiply-adds on zeros.
+The compressed sparse row (CSR) format stores only the non-zero elements, in three flat typed arrays:
+    1. data    - the non-zero values, row by row
+    2. indices - the column of each value in data
+    3. indptr  - indptr[i]:indptr[i + 1] is the slice of data and indices that belongs to row i
+
+For example, [[5, 0, 0], [0, 0, 7], [1, 2, 0]] is stored as data=[5, 7, 1, 2], indices=[0, 2, 0, 1] and
+indptr=[0, 1, 2, 4]. The compressed sparse column (CSC) format stores the same three arrays with the roles of
+rows and columns swapped, which is exactly the CSR form of the transpose.
+
+The work in a sparse product is proportional to the number of non-zeros rather than to the matrix dimensions:
+    - sparse x dense  (SpMM) - every non-zero A[i][k] adds A[i][k] times row k of B into row i of C
+    - sparse x vector (SpMV) - every row of C is the dot product of the non-zeros of row i with x
+    - sparse x sparse (SpGEMM) - Gustavson's algorithm merges the sparse rows of B selected by row i of A
+
+Rows of the result are still independent, so the parallel versions use the same row agglomeration as
+par_matrix_multiply. Real sparse matrices are rarely uniform, though. One dense row can hold more non-zeros than a
+thousand others, so the rows are split into chunks with equal numbers of non-zeros rather than equal numbers of
+rows. The CSR arrays and any dense operand are placed once in shared memory, and the workers attach to them by name.
+"""
+
+import random
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+from base_modules.parallelism import effective_cpu_count
+from base_modules.shared_arrays import SharedArray, flatten_rows, result_view
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; dense results are typed memoryviews without it
+    np = None
+
+INDEX_TYPECODE = 'q'
+
+
+class CSRMatrix:
+    """ compressed sparse row matrix stored in typed arrays """
+
+    def __init__(self, data, indices, indptr, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(shape)
+        if len(indptr) != self.shape[0] + 1 or len(data) != len(indices) or indptr[-1] != len(data):
+            raise ValueError(f"Inconsistent CSR arrays for a {self.shape[0]}x{self.shape[1]} matrix")
+
+    @classmethod
+    def from_dense(cls, M):
+        """ builds a CSR matrix from a list-of-lists or a 2D ndarray """
+        num_cols = len(M[0]) if len(M) else 0
+        data = array('d')
+        indices = array(INDEX_TYPECODE)
+        indptr = array(INDEX_TYPECODE, [0])
+        for row in M:
+            for j, value in enumerate(row):
+                if value:
+                    indices.append(j)
+                    data.append(value)
+            indptr.append(len(data))
+        return cls(data, indices, indptr, (len(M), num_cols))
+
+    @classmethod
+    def random(cls, num_rows, num_cols, density, seed=None):
+        """ random matrix with roughly density * num_rows * num_cols non-zeros """
+        rand = random.Random(seed)
+        # rows get the whole part of density * num_cols non-zeros, plus one more with the fractional probability
+        whole, fraction = divmod(min(1.0, max(0.0, density)) * num_cols, 1)
+        data = array('d')
+        indices = array(INDEX_TYPECODE)
+        indptr = array(INDEX_TYPECODE, [0])
+        for i in range(num_rows):
+            nnz_in_row = min(num_cols, int(whole) + (rand.random() < fraction))
+            columns = sorted(rand.sample(range(num_cols), nnz_in_row))
+            indices.extend(columns)
+            data.extend(rand.random() for j in columns)
+            indptr.append(len(data))
+        return cls(data, indices, indptr, (num_rows, num_cols))
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def density(self):
+        return self.nnz / max(1, self.shape[0] * self.shape[1])
+
+    def row(self, i):
+        """ (columns, values) of the non-zeros of row i """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def to_dense(self):
+        """ returns a list-of-lists """
+        num_rows, num_cols = self.shape
+        dense = [[0.0] * num_cols for i in range(num_rows)]
+        for i in range(num_rows):
+            dense_row = dense[i]
+            for j, value in zip(*self.row(i)):
+                dense_row[j] = value
+        return dense
+
+    def transpose(self):
+        """ CSR form of the transpose, computed with a counting sort over the column indices """
+        num_rows, num_cols = self.shape
+        counts = [0] * (num_cols + 1)
+        for j in self.indices:
+            counts[j + 1] += 1
+        indptr = array(INDEX_TYPECODE, counts)
+        for j in range(num_cols):
+            indptr[j + 1] += indptr[j]
+        next_slot = indptr[:-1].tolist()
+        data = array('d', bytes(8 * self.nnz))
+        indices = array(INDEX_TYPECODE, bytes(indptr.itemsize * self.nnz))
+        for i in range(num_rows):
+            for j, value in zip(*self.row(i)):
+                slot = next_slot[j]
+                indices[slot] = i
+                data[slot] = value
+                next_slot[j] = slot + 1
+        return CSRMatrix(data, indices, indptr, (num_cols, num_rows))
+
+    def tocsc(self):
+        transposed = self.transpose()
+        return CSCMatrix(transposed.data, transposed.indices, transposed.indptr, self.shape)
+
+    def __eq__(self, other):
+        return (isinstance(other, CSRMatrix) and self.shape == other.shape and self.indptr == other.indptr
+                and self.indices == other.indices and self.data == other.data)
+
+
+class CSCMatrix:
+    """ compressed sparse column matrix; the arrays are those of the CSR form of the transpose """
+
+    def __init__(self, data, indices, indptr, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, M):
+        return CSRMatrix.from_dense(M).tocsc()
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def tocsr(self):
+        return CSRMatrix(self.data, self.indices, self.indptr, self.shape[::-1]).transpose()
+
+    def to_dense(self):
+        return self.tocsr().to_dense()
+
+
+def _check_dimensions(A, num_rows_B, num_cols_B):
+    num_rows_A, num_cols_A = A.shape
+    if num_cols_A != num_rows_B:
+        raise ArithmeticError(
+            f"Invalid dimensions; Cannot multiply {num_rows_A}x{num_cols_A}*{num_rows_B}x{num_cols_B}")
+
+
+def _dense_shape(A, B):
+    """ the shape of a dense operand B, checked against A; an empty list of rows has no columns """
+    if np is not None and isinstance(B, np.ndarray):
+        num_rows_B, num_cols_B = B.shape
+    else:
+        num_rows_B, num_cols_B = len(B), len(B[0]) if len(B) else 0
+    _check_dimensions(A, num_rows_B, num_cols_B)
+    return num_rows_B, num_cols_B
+
+
+def _as_csr(M):
+    if isinstance(M, CSCMatrix):
+        return M.tocsr()
+    return M
+
+
+def _spmm_rows(data, indices, indptr, B, C, num_cols_B, row_start, row_end):
+    """ C[row_start:row_end] = A[row_start:row_end] * B for CSR arrays of A and a flat dense B """
+    for i in range(row_start, row_end):
+        acc = [0.0] * num_cols_B
+        for p in range(indptr[i], indptr[i + 1]):
+            k = indices[p]
+            a = data[p]
+            acc = [c + a * b for c, b in zip(acc, B[k * num_cols_B:(k + 1) * num_cols_B])]
+        C[i * num_cols_B:(i + 1) * num_cols_B] = array('d', acc)
+
+
+def _spgemm_rows(data_A, indices_A, indptr_A, data_B, indices_B, indptr_B, row_start, row_end):
+    """ Gustavson's algorithm for rows row_start..row_end-1; returns (row lengths, indices, data) """
+    lengths = array(INDEX_TYPECODE)
+    indices = array(INDEX_TYPECODE)
+    data = array('d')
+    for i in range(row_start, row_end):
+        acc = {}
+        for p in range(indptr_A[i], indptr_A[i + 1]):
+            a = data_A[p]
+            for q in range(indptr_B[indices_A[p]], indptr_B[indices_A[p] + 1]):
+                j = indices_B[q]
+                acc[j] = acc.get(j, 0.0) + a * data_B[q]
+        columns = sorted(acc)
+        lengths.append(len(columns))
+        indices.extend(columns)
+        data.extend(acc[j] for j in columns)
+    return lengths, indices, data
+
+
+def seq_sparse_multiply(A, B, as_list=False):
+    """ sequential A*B for a CSR (or CSC) matrix A
+        B may be a sparse matrix (returns CSR), a flat vector (returns a list) or a dense
+        list-of-lists / ndarray (returns a 2D view, or a list-of-lists if as_list=True) """
+    A = _as_csr(A)
+    if isinstance(B, (CSRMatrix, CSCMatrix)):
+        B = _as_csr(B)
+        _check_dimensions(A, *B.shape)
+        lengths, indices, data = _spgemm_rows(A.data, A.indices, A.indptr, B.data, B.indices, B.indptr,
+                                              0, A.shape[0])
+        return _assemble_csr([(lengths, indices, data)], (A.shape[0], B.shape[1]))
+    if _is_vector(B):
+        _check_dimensions(A, len(B), 1)
+        return [sum(a * B[k] for k, a in zip(*A.row(i))) for i in range(A.shape[0])]
+    num_rows_B, num_cols_B = _dense_shape(A, B)
+    C = array('d', bytes(8 * A.shape[0] * num_cols_B))
+    _spmm_rows(A.data, A.indices, A.indptr, flatten_rows(B), C, num_cols_B, 0, A.shape[0])
+    return result_view(C, (A.shape[0], num_cols_B), as_list)
+
+
+def par_sparse_multiply(A, B, as_list=False, workers=None):
+    """ parallel A*B; rows of A are split across processes into chunks with equal numbers of non-zeros
+        accepts and returns the same types as seq_sparse_multiply """
+    A = _as_csr(A)
+    num_workers = workers or effective_cpu_count()
+    row_bounds = _balanced_row_bounds(A.indptr, num_workers)
+    shared_A = [SharedArray('d', A.data), SharedArray(INDEX_TYPECODE, A.indices),
+                SharedArray(INDEX_TYPECODE, A.indptr)]
+    shared = list(shared_A)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            if isinstance(B, (CSRMatrix, CSCMatrix)):
+                B = _as_csr(B)
+                _check_dimensions(A, *B.shape)
+                shared += [SharedArray('d', B.data), SharedArray(INDEX_TYPECODE, B.indices),
+                           SharedArray(INDEX_TYPECODE, B.indptr)]
+                futures = [pool.submit(_par_spgemm_worker, *shared, start, end)
+                           for start, end in zip(row_bounds, row_bounds[1:])]
+                return _assemble_csr([f.result() for f in futures], (A.shape[0], B.shape[1]))
+
+            if _is_vector(B):
+                _check_dimensions(A, len(B), 1)
+                num_rows_B, num_cols_B = len(B), 1
+            else:
+                num_rows_B, num_cols_B = _dense_shape(A, B)
+            shared.append(SharedArray('d', B if _is_vector(B) else flatten_rows(B)))
+            C = SharedArray('d', A.shape[0] * num_cols_B)
+            shared.append(C)
+            futures = [pool.submit(_par_spmm_worker, *shared, num_cols_B, start, end)
+                       for start, end in zip(row_bounds, row_bounds[1:])]
+            for f in futures:
+                f.result()
+            # copy the result out, the shared block is released below
+            C_1D = array('d', C.view)
+        if _is_vector(B):
+            return C_1D.tolist()
+        return result_view(C_1D, (A.shape[0], num_cols_B), as_list)
+    finally:
+        for s in shared:
+            s.close()
+
+
+def _par_spmm_worker(data, indices, indptr, B, C, num_cols_B, row_start, row_end):
+    _spmm_rows(data.view, indices.view, indptr.view, B.view, C.view, num_cols_B, row_start, row_end)
+
+
+def _par_spgemm_worker(data_A, indices_A, indptr_A, data_B, indices_B, indptr_B, row_start, row_end):
+    return _spgemm_rows(data_A.view, indices_A.view, indptr_A.view, data_B.view, indices_B.view, indptr_B.view,
+                        row_start, row_end)
+
+
+def _balanced_row_bounds(indptr, num_chunks):
+    """ row boundaries that give every chunk roughly the same number of non-zeros """
+    num_rows, nnz = len(indptr) - 1, indptr[-1]
+    bounds = [0]
+    for w in range(1, num_chunks):
+        row = min(num_rows, bisect_left(indptr, w * nnz / num_chunks))
+        bounds.append(max(row, bounds[-1]))
+    bounds.append(num_rows)
+    return bounds
+
+
+def _assemble_csr(pieces, shape):
+    """ concatenates per-chunk (row lengths, indices, data) into one CSRMatrix """
+    indptr = array(INDEX_TYPECODE, [0])
+    indices = array(INDEX_TYPECODE)
+    data = array('d')
+    for lengths, chunk_indices, chunk_data in pieces:
+        for length in lengths:
+            indptr.append(indptr[-1] + length)
+        indices.extend(chunk_indices)
+        data.extend(chunk_data)
+    return CSRMatrix(data, indices, indptr, shape)
+
+
+def _is_vector(B):
+    if np is not None and isinstance(B, np.ndarray):
+        return B.ndim == 1
+    return len(B) > 0 and not hasattr(B[0], '__len__')
+
+
+if __name__ == '__main__':
+    from base_modules.matrix_kernels import tiled_matrix_multiply
+
+    SIZE = 400
+    DENSITIES = (0.001, 0.01, 0.05, 0.2)
+
+    def time_it(func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    B_dense = [[random.random() for i in range(SIZE)] for j in range(SIZE)]
+    dense_time = None
+    print('{:>8} {:>8} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'density', 'nnz', 'dense tiled', 'seq SpMM', 'par SpMM', 'seq SpGEMM', 'par SpGEMM'))
+    for density in DENSITIES:
+        A = CSRMatrix.random(SIZE, SIZE, density, seed=1)
+        B = CSRMatrix.random(SIZE, SIZE, density, seed=2)
+        if dense_time is None:
+            # dense work does not depend on the density, so it is measured once
+            dense_result, dense_time = time_it(tiled_matrix_multiply, A.to_dense(), B_dense)
+        seq_spmm, seq_spmm_time = time_it(seq_sparse_multiply, A, B_dense, as_list=True)
+        par_spmm, par_spmm_time = time_it(par_sparse_multiply, A, B_dense, as_list=True)
+        seq_spgemm, seq_spgemm_time = time_it(seq_sparse_multiply, A, B)
+        par_spgemm, par_spgemm_time = time_it(par_sparse_multiply, A, B)
+        if seq_spmm != par_spmm or seq_spgemm != par_spgemm:
+            raise Exception('sequential and parallel sparse results do not match.')
+        print('{:>8} {:>8} {:>9.2f} ms {:>9.2f} ms {:>9.2f} ms {:>9.2f} ms {:>9.2f} ms'.format(
+            density, A.nnz, dense_time * 1000, seq_spmm_time * 1000, par_spmm_time * 1000,
+            seq_spgemm_time * 1000, par_spgemm_time * 1000))
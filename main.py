@@ -1,6 +1,7 @@
 import concurrent.futures
 import time
 from functools import partial
+from base_modules.parallelism import effective_cpu_count, thread_pool_workers
 from base_modules.utils import gen_date_intervals
 from base_modules.voluum_api import extract_conversions_data, fetch_columns
 from base_modules.config import credentials
@@ -15,7 +16,7 @@ if __name__ == "__main__":
                                            credentials=credentials,
                                            filter_by_col='campaignName',
                                            predicate='Google Ads')
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_pool_workers()) as executor:
         executor.map(p_extract_voluum_conversions, backfill_dates)
 
     t2 = time.perf_counter()
@@ -29,7 +30,7 @@ if __name__ == "__main__":
                                            credentials=credentials,
                                            filter_by_col='campaignName',
                                            predicate='Google Ads')
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=effective_cpu_count()) as executor:
         executor.map(p_extract_voluum_conversions, backfill_dates)
 
     t2 = time.perf_counter()